@@ -0,0 +1,182 @@
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+try:
+    from urllib.request import urlretrieve
+except ImportError:
+    from urllib import urlretrieve
+from extensions import valid_poster_extensions
+from preemption import privateDirectory, makePrivate
+
+
+def safeName(name):
+    # Whether a name read from the index is a plain file name in the cache directory
+    return bool(name) and name not in ('.', '..') and '/' not in name and '\\' not in name
+
+
+class ArtworkCache:
+    """Content addressed cache for cover artwork.
+
+    Downloads are stored once under the SHA1 of their content and indexed by source URL, so every episode of a season
+    reuses one download. Covers can optionally be downscaled and recompressed with ffmpeg before embedding, and the
+    least recently used files are evicted before a new one would grow the cache past max_size bytes, never the file
+    being returned. The cache lives in a directory only the user can write to."""
+
+    def __init__(self, directory=None, max_size=200 * 1024 * 1024, max_dimension=None, quality=3, ttl=7 * 86400, ffmpeg='ffmpeg', logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.directory = directory or privateDirectory("mp4_automator-artwork")
+        self.max_size = max_size
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.ttl = ttl
+        self.ffmpeg = ffmpeg
+        self.lock = threading.RLock()
+        self.ready = False
+
+    def configure(self, ffmpeg=None, max_dimension=None, max_size=None):
+        # Apply the artwork settings from autoProcess.ini
+        if ffmpeg:
+            self.ffmpeg = ffmpeg
+        self.max_dimension = max_dimension
+        if max_size is not None:
+            self.max_size = max_size
+
+    def connect(self):
+        if not self.ready:
+            makePrivate(self.directory)
+        conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), timeout=30)
+        if not self.ready:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, name TEXT, stored REAL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, accessed REAL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed)")
+            self.ready = True
+        return conn
+
+    def hashFile(self, path):
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def extension(self, path, default='jpg'):
+        ext = os.path.splitext(path.split('?')[0])[1][1:].lower()
+        if ext == 'jpeg':
+            ext = 'jpg'
+        return ext if ext in valid_poster_extensions else default
+
+    def store(self, conn, path, name):
+        # Move path into the cache as name unless identical content is already there
+        target = os.path.join(self.directory, name)
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            shutil.move(path, target)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO files (name, size, accessed) VALUES (?, ?, ?)", (name, os.path.getsize(target), time.time()))
+        return target
+
+    def touch(self, conn, name):
+        with conn:
+            conn.execute("UPDATE files SET accessed = ? WHERE name = ?", (time.time(), name))
+
+    def fetch(self, url):
+        # Return a local path for the artwork at url, downloading it only if it is not cached
+        if not url:
+            return None
+        with self.lock:
+            try:
+                conn = self.connect()
+                row = conn.execute("SELECT name, stored FROM urls WHERE url = ?", (url,)).fetchone()
+                if row and safeName(row[0]) and time.time() - row[1] < self.ttl and os.path.exists(os.path.join(self.directory, row[0])):
+                    self.log.debug("Using cached artwork for %s." % url)
+                    self.touch(conn, row[0])
+                    return self.prepare(os.path.join(self.directory, row[0]), conn)
+
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                os.close(fd)
+                try:
+                    urlretrieve(url, tmp)
+                    name = "%s.%s" % (self.hashFile(tmp), self.extension(url))
+                    self.evict(conn, os.path.getsize(tmp), [name])
+                    path = self.store(conn, tmp, name)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO urls (url, name, stored) VALUES (?, ?, ?)", (url, name, time.time()))
+                return self.prepare(path, conn)
+            except Exception as e:
+                self.log.exception("Unable to cache artwork from %s." % url)
+                return None
+
+    def prepare(self, path, conn=None):
+        # Return a downscaled and recompressed copy of path if max_dimension is set and the copy is smaller, otherwise path
+        if not self.max_dimension or not path:
+            return path
+        with self.lock:
+            try:
+                conn = conn or self.connect()
+                name = "%s-%d.jpg" % (self.hashFile(path), self.max_dimension)
+                target = os.path.join(self.directory, name)
+                if os.path.exists(target):
+                    self.touch(conn, name)
+                    return target if os.path.getsize(target) < os.path.getsize(path) else path
+                fd, tmp = tempfile.mkstemp(suffix='.jpg', dir=self.directory)
+                os.close(fd)
+                try:
+                    scale = "scale='min(%d,iw)':'min(%d,ih)':force_original_aspect_ratio=decrease" % (self.max_dimension, self.max_dimension)
+                    cmd = [self.ffmpeg, '-y', '-v', 'error', '-i', path, '-vf', scale, '-q:v', str(self.quality), tmp]
+                    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    output, err = p.communicate()
+                    if p.returncode != 0 or os.path.getsize(tmp) == 0:
+                        self.log.debug("Unable to resize artwork %s: %s." % (path, err))
+                        return path
+                    self.evict(conn, os.path.getsize(tmp), [name, os.path.basename(path)])
+                    target = self.store(conn, tmp, name)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                self.log.debug("Resized artwork %s (%d bytes) to %s (%d bytes)." % (path, os.path.getsize(path), target, os.path.getsize(target)))
+                return target if os.path.getsize(target) < os.path.getsize(path) else path
+            except Exception as e:
+                self.log.exception("Unable to resize artwork %s." % path)
+                return path
+
+    def evict(self, conn, size=0, keep=()):
+        # Remove the least recently used files but keep until size more bytes fit in max_size
+        if not self.max_size:
+            return
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0] + size
+        if total <= self.max_size:
+            return
+        for name, used in conn.execute("SELECT name, size FROM files ORDER BY accessed").fetchall():
+            if total <= self.max_size:
+                break
+            if name in keep:
+                continue
+            if safeName(name):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+            with conn:
+                conn.execute("DELETE FROM files WHERE name = ?", (name,))
+                conn.execute("DELETE FROM urls WHERE name = ?", (name,))
+            total -= used
+            self.log.debug("Evicted cached artwork %s." % name)
+
+
+# Shared by the taggers, configured by ReadSettings
+artworkCache = ArtworkCache()
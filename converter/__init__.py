@@ -4,7 +4,7 @@ import os
 import sys
 from converter.avcodecs import video_codec_list, audio_codec_list, subtitle_codec_list
 from converter.formats import format_list
-from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError
+from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError, FFMpegStallError, FFMpegTimestampError
 
 
 class ConverterError(Exception):
@@ -163,7 +163,7 @@ class Converter(object):
 
         return optlist
 
-    def convert(self, infile, outfile, options, stop_event, twopass=False, timeout=10, preopts=None, postopts=None):
+    def convert(self, infile, outfile, options, stop_event, twopass=False, timeout=10, preopts=None, postopts=None, watchdog=None, resources=None, preemptor=None):
         """
         Convert media file (infile) according to specified options, and
         save it to outfile. For two-pass encoding, specify the pass (1 or 2)
@@ -191,10 +191,15 @@ class Converter(object):
         doesn't limit the total conversion time, just the amount of time
         Converter will wait for each update from ffmpeg. As it's usually
         less than a second, the default of 10 is a reasonable default. To
-        disable the timeout, set it to None. You may need to do this if
-        using Converter in a threading environment, since the way the
-        timeout is handled (using signals) has special restriction when
-        using threads.
+        disable the timeout, set it to None. The timeout is handled by a
+        reader thread rather than signals, so it is safe to convert from
+        several threads at once.
+
+        The optional watchdog (converter.watchdog.StallWatchdog) stops the
+        conversion with an FFMpegStallError when it becomes too slow, and
+        the optional resources (resource_classes.ResourceClass) sets the CPU
+        and I/O limits ffmpeg runs with. The optional preemptor
+        (preemption.Preemptor) suspends ffmpeg while higher class jobs run.
 
         >>> conv = Converter().convert('test1.ogg', '/tmp/output.mkv', {
         ...    'format': 'mkv',
@@ -207,7 +212,33 @@ class Converter(object):
         """
         if twopass and twopass is True:
             print("WE GOT TWOPASS WE GOT TWOPASS WE GOT TWOPASS WE GOT TWOPASS")
-            
+
+        options, info = self._prepare(infile, options)
+        myList = []
+        myLoop = 0
+        if twopass:
+            optlist1 = self.parse_options(options, 1)
+            for timecode in self.ffmpeg.convert(infile, outfile, optlist1, stop_event,
+                                                timeout=timeout, preopts=preopts, postopts=postopts, watchdog=watchdog, resources=resources, preemptor=preemptor):
+                    #yield int((50.0 * timecode) / info.format.duration)
+                    tc = round(((50.0 * timecode[0]) / info.format.duration), 2)
+                    yield [tc, timecode[1], timecode[2], timecode[3], timecode[4], timecode[5]]                 
+            optlist2 = self.parse_options(options, 2)
+            for timecode in self.ffmpeg.convert(infile, outfile, optlist2, stop_event,
+                                                timeout=timeout, preopts=preopts, postopts=postopts, watchdog=watchdog, resources=resources, preemptor=preemptor):                 
+                    #yield int(50.0 + (50.0 * timecode) / info.format.duration)
+                    tc = round((50.0 + (50.0 * timecode[0]) / info.format.duration), 2)
+                    yield [tc, timecode[1], timecode[2], timecode[3], timecode[4], timecode[5]]
+        else:
+            optlist = self.parse_options(options, twopass)
+            for timecode in self.ffmpeg.convert(infile, outfile, optlist, stop_event,
+                                                timeout=timeout, preopts=preopts, postopts=postopts, watchdog=watchdog, resources=resources, preemptor=preemptor):
+
+                tc = round(((100.0 * timecode[0]) / info.format.duration), 2)
+                yield [tc, timecode[1], timecode[2], timecode[3], timecode[4], timecode[5]]
+
+    def _prepare(self, infile, options):
+        # Probe the source and add its dimensions to the video options
         if not isinstance(options, dict):
             raise ConverterError('Invalid options')
 
@@ -229,28 +260,24 @@ class Converter(object):
 
         if info.format.duration < 0.01:
             raise ConverterError('Zero-length media')
-        myList = []
-        myLoop = 0
-        if twopass:
-            optlist1 = self.parse_options(options, 1)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist1, stop_event,
-                                                timeout=timeout, preopts=preopts, postopts=postopts):
-                    #yield int((50.0 * timecode) / info.format.duration)
-                    tc = round(((50.0 * timecode[0]) / info.format.duration), 2)
-                    yield [tc, timecode[1], timecode[2], timecode[3], timecode[4], timecode[5]]                 
-            optlist2 = self.parse_options(options, 2)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist2, stop_event,
-                                                timeout=timeout, preopts=preopts, postopts=postopts):                 
-                    #yield int(50.0 + (50.0 * timecode) / info.format.duration)
-                    tc = round((50.0 + (50.0 * timecode[0]) / info.format.duration), 2)
-                    yield [tc, timecode[1], timecode[2], timecode[3], timecode[4], timecode[5]]
-        else:
-            optlist = self.parse_options(options, twopass)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist, stop_event,
-                                                timeout=timeout, preopts=preopts, postopts=postopts):
+        return options, info
 
-                tc = round(((100.0 * timecode[0]) / info.format.duration), 2)
-                yield [tc, timecode[1], timecode[2], timecode[3], timecode[4], timecode[5]]
+    def commands(self, infile, outfile, options, twopass=False, preopts=None, postopts=None):
+        """
+        Build the ffmpeg command lines for a conversion without running
+        them, for callers that drive ffmpeg themselves. Returns the list
+        of commands (two for a two-pass encode) and the duration of the
+        source in seconds. Options are the same as for convert().
+
+        >>> commands, duration = Converter().commands('test1.ogg', '/tmp/output.mkv', {
+        ...    'format': 'mkv',
+        ...    'audio': { 'codec': 'aac' },
+        ...    'video': { 'codec': 'h264' }
+        ... })
+        """
+        options, info = self._prepare(infile, options)
+        passes = [1, 2] if twopass else [twopass]
+        return [self.ffmpeg.build_command(infile, outfile, self.parse_options(options, i), preopts, postopts) for i in passes], info.format.duration
 
     def probe(self, fname, posters_as_video=True):
         """
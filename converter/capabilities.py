@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+import tempfile
+import threading
+import subprocess
+from converter.avcodecs import video_codec_list, audio_codec_list, subtitle_codec_list
+
+logger = logging.getLogger(__name__)
+
+_which_cache = {}
+
+
+def which(name):
+    """
+    Locate an executable on the PATH. Results are remembered for the
+    lifetime of the process, so constructing many Converter objects
+    only scans the PATH once per name.
+    """
+    if name in _which_cache:
+        return _which_cache[name]
+    found = None
+    names = [name]
+    if os.name == 'nt' and not name.lower().endswith('.exe'):
+        names.append(name + '.exe')
+    for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        for n in names:
+            fpath = os.path.join(d, n)
+            if os.path.isfile(fpath) and os.access(fpath, os.X_OK):
+                found = fpath
+                break
+        if found:
+            break
+    _which_cache[name] = found
+    return found
+
+
+def encoder_name(codec):
+    """
+    Map a converter codec name (ie. 'h264', 'nvenc_h265') to the name
+    of the ffmpeg encoder it uses, or None for copy/unknown codecs.
+    """
+    for cls in video_codec_list + audio_codec_list + subtitle_codec_list:
+        if cls.codec_name == codec:
+            return cls.ffmpeg_codec_name
+    return None
+
+
+class Capabilities(object):
+    """
+    Encoders, decoders, filters and hardware accelerations supported by
+    one ffmpeg binary. When the binary could not be queried every check
+    succeeds, leaving it to ffmpeg to report the problem.
+    """
+
+    def __init__(self, version=None, encoders=None, decoders=None, filters=None, hwaccels=None):
+        self.version = version
+        self.known = encoders is not None
+        self.encoders = set(encoders or [])
+        self.decoders = set(decoders or [])
+        self.filters = set(filters or [])
+        self.hwaccels = set(hwaccels or [])
+
+    def has_encoder(self, name):
+        return not self.known or name in self.encoders
+
+    def has_decoder(self, name):
+        return not self.known or name in self.decoders
+
+    def has_filter(self, name):
+        return not self.known or name in self.filters
+
+    def has_hwaccel(self, name):
+        return not self.known or name in self.hwaccels
+
+    def supports(self, codec):
+        """
+        Check that the encoder behind a converter codec name is built in.
+        """
+        if codec is None or codec == 'copy':
+            return True
+        name = encoder_name(codec)
+        return name is None or self.has_encoder(name)
+
+    def to_dict(self):
+        return {'version': self.version,
+                'encoders': sorted(self.encoders),
+                'decoders': sorted(self.decoders),
+                'filters': sorted(self.filters),
+                'hwaccels': sorted(self.hwaccels)}
+
+
+class CapabilityRegistry(object):
+    """
+    Queries ffmpeg -encoders/-decoders/-filters/-hwaccels once per
+    binary and persists the result to a JSON file. Entries are keyed by
+    the binary's real path, size and modification time, so upgrading
+    ffmpeg queries the new version again.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(tempfile.gettempdir(), "mp4_automator-ffmpeg.json")
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.objects = {}
+        self.loaded = False
+
+    def fingerprint(self, ffmpeg):
+        if os.path.sep not in ffmpeg and '/' not in ffmpeg:
+            ffmpeg = which(ffmpeg) or ffmpeg
+        try:
+            real = os.path.realpath(ffmpeg)
+            st = os.stat(real)
+        except OSError:
+            return None
+        return "%s|%d|%d" % (real, st.st_size, int(st.st_mtime))
+
+    def load(self):
+        self.loaded = True
+        try:
+            with open(self.path, 'r') as f:
+                self.entries.update(json.load(f))
+        except (IOError, OSError):
+            pass
+        except ValueError:
+            logger.warning("Unable to read ffmpeg capability cache %s, ignoring it." % self.path)
+
+    def save(self):
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            if os.path.exists(self.path) and os.name == 'nt':
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            logger.exception("Unable to write ffmpeg capability cache %s." % self.path)
+
+    def _run(self, ffmpeg, flag):
+        p = subprocess.Popen([ffmpeg, '-hide_banner', flag], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, _ = p.communicate()
+        return output.decode('utf-8', errors='ignore')
+
+    @staticmethod
+    def parse_codecs(output):
+        """
+        Parse -encoders/-decoders output, the entries follow a '------' line.
+        """
+        names = []
+        started = False
+        for line in output.splitlines():
+            if not started:
+                started = line.strip().startswith('------')
+                continue
+            parts = line.split()
+            if len(parts) >= 2:
+                names.append(parts[1])
+        return names
+
+    @staticmethod
+    def parse_filters(output):
+        """
+        Parse -filters output, entries look like ' TSC scale  V->V  description'.
+        """
+        names = []
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) >= 3 and '->' in parts[2]:
+                names.append(parts[1])
+        return names
+
+    @staticmethod
+    def parse_hwaccels(output):
+        names = []
+        for line in output.splitlines():
+            line = line.strip()
+            if line and not line.endswith(':'):
+                names.append(line)
+        return names
+
+    def probe(self, ffmpeg):
+        version = self._run(ffmpeg, '-version').split('\n')[0].strip()
+        return Capabilities(version,
+                            self.parse_codecs(self._run(ffmpeg, '-encoders')),
+                            self.parse_codecs(self._run(ffmpeg, '-decoders')),
+                            self.parse_filters(self._run(ffmpeg, '-filters')),
+                            self.parse_hwaccels(self._run(ffmpeg, '-hwaccels')))
+
+    def get(self, ffmpeg):
+        """
+        Return the Capabilities of an ffmpeg binary, querying it only if
+        this version was never seen before.
+        """
+        key = self.fingerprint(ffmpeg)
+        if key is None:
+            return Capabilities()
+        with self.lock:
+            if key in self.objects:
+                return self.objects[key]
+            if not self.loaded:
+                self.load()
+            entry = self.entries.get(key)
+            if isinstance(entry, dict):
+                self.objects[key] = Capabilities(**entry)
+                return self.objects[key]
+            try:
+                capabilities = self.probe(ffmpeg)
+            except Exception:
+                logger.exception("Unable to query capabilities of %s." % ffmpeg)
+                return Capabilities()
+            logger.debug("Detected %d encoders, %d decoders, %d filters and %d hwaccels for %s." % (len(capabilities.encoders), len(capabilities.decoders), len(capabilities.filters), len(capabilities.hwaccels), capabilities.version))
+            self.entries[key] = capabilities.to_dict()
+            self.objects[key] = capabilities
+            self.save()
+            return capabilities
+
+
+registry = CapabilityRegistry()
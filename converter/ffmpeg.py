@@ -1,18 +1,21 @@
 #!/usr/bin/env python
 
-from inspect import getsourcefile
-from os.path import abspath
 import os.path
 import os
 import re
-import signal
 import subprocess
 import sys
+import threading
 from subprocess import Popen, PIPE
 import logging
 import locale
+from converter.capabilities import which
 import time
 from sys import platform
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
 logger = logging.getLogger(__name__)
 console_encoding = locale.getdefaultlocale()[1] or 'UTF-8'
@@ -55,7 +58,24 @@ class FFMpegConvertError(Exception):
         except Exception as e:
             print ("ERROR in FFMpegConvertError! %s %s" % (type(e),e))
         return s
-        
+
+
+class FFMpegStallError(FFMpegConvertError):
+    """
+    Raised when a StallWatchdog finds the conversion too slow. stats holds
+    the measured speed and frame rate and the expected speed.
+    """
+    def __init__(self, message, cmd, output, details=None, pid=0, stats=None):
+        super(FFMpegStallError, self).__init__(message, cmd, output, details, pid)
+        self.stats = stats or {}
+
+class FFMpegTimestampError(FFMpegConvertError):
+    """
+    Raised when ffmpeg reports non-monotonous DTS while remuxing, the
+    output would be out of sync unless the video is encoded as well.
+    """
+    pass
+
 class MediaFormatInfo(object):
     """
     Describes the media container format. The attributes are:
@@ -346,6 +366,123 @@ class MediaInfo(object):
         return result
 
 
+PROGRESS_PATTERNS = {'time': re.compile(r'time=([0-9.:]+) '),
+                     'frame': re.compile(r'frame=(\s*\d+) '),
+                     'fps': re.compile(r'fps=(\s*\d+) '),
+                     'q': re.compile(r'q=([\d*.]+) '),
+                     'speed': re.compile(r'speed=([\s*\d*.\d*x\s*]+) '),
+                     'bitrate': re.compile(r'bitrate=([\s*\d*.\d*\w*/\w*]+) ')}
+
+
+def parse_progress(line):
+    """
+    Parse one ffmpeg progress line (ie. 'frame= 100 fps= 50 ... time=00:00:04.00
+    bitrate= 800.0kbits/s speed=2.0x'). Returns a dict with the keys time
+    (seconds), frame, fps, q, speed and bitrate, None for the missing ones.
+    """
+    progress = {}
+    for key, pattern in PROGRESS_PATTERNS.items():
+        found = pattern.findall(line)
+        progress[key] = found[0].strip() if len(found) == 1 else None
+    if progress['frame'] is not None:
+        progress['frame'] = int(progress['frame'])
+    if progress['time'] is not None:
+        timecode = 0
+        for part in progress['time'].split(':'):
+            timecode = 60 * timecode + float(part)
+        progress['time'] = timecode
+    return progress
+
+
+class OutputReader(threading.Thread):
+    """
+    Reads the output of a process on a background thread, so the
+    conversion loop can wait for it with a timeout. Unlike SIGALRM this
+    has no process wide side effects, so any number of conversions can
+    run concurrently from threads.
+    """
+
+    def __init__(self, stream, chunk_size=4096):
+        super(OutputReader, self).__init__()
+        self.daemon = True
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.queue = Queue()
+
+    def run(self):
+        fd = self.stream.fileno()
+        while True:
+            try:
+                data = os.read(fd, self.chunk_size)
+            except (OSError, ValueError):
+                data = b''
+            self.queue.put(data)
+            if not data:
+                break
+
+    def read(self, timeout=None):
+        """
+        Return the next chunk of output, b'' once the stream is closed or
+        None if nothing arrived within timeout seconds.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+# Seconds ffmpeg may keep reporting the same frame before the source is considered corrupt
+FRAME_TIMEOUT = 600.0
+
+
+class OutputMonitor(object):
+    """
+    Watches the output of one ffmpeg run for the problems FFMpeg.convert
+    and the job runner both stop it for: non-monotonous DTS before the end
+    of the audio, and a single frame taking more than FRAME_TIMEOUT seconds
+    to render.
+    """
+
+    def __init__(self):
+        self.ignore_non_monotonous = False
+        self.frame = 0
+        self.since = None
+
+    def timestamps(self, text):
+        """
+        Return True when text reports non-monotonous DTS that needs the
+        video to be encoded.
+        """
+        # This warning tends to come up at the very end of a file, generally because the audio stream ends a few
+        # seconds before the video. The DTS warnings after it are during the credits and do not matter.
+        if 'Queue input is backward in time' in text:
+            self.ignore_non_monotonous = True
+        return 'Non-monotonous DTS' in text and not self.ignore_non_monotonous
+
+    def stuck(self, progress, now=None):
+        """
+        Return True once the frame of the progress lines has not changed
+        for FRAME_TIMEOUT seconds.
+        """
+        if progress['frame'] is None:
+            return False
+        now = now or time.time()
+        if self.frame != 0 and progress['frame'] == self.frame:
+            if self.since is None:
+                self.since = now
+            elif now - self.since > FRAME_TIMEOUT:
+                return True
+        else:
+            self.since = None
+        self.frame = progress['frame']
+        return False
+
+    def shift(self, seconds):
+        # Leave out time ffmpeg spent suspended
+        if self.since is not None:
+            self.since += seconds
+
+
 class FFMpeg(object):
     """
     FFMPeg wrapper object, takes care of calling the ffmpeg binaries,
@@ -361,14 +498,6 @@ class FFMpeg(object):
         the paths to ffmpeg and ffprobe utilities.
         """
 
-        def which(name):
-            path = os.environ.get('PATH', os.defpath)
-            for d in path.split(':'):
-                fpath = os.path.join(d, name)
-                if os.path.exists(fpath) and os.access(fpath, os.X_OK):
-                    return fpath
-            return None
-
         if ffmpeg_path is None:
             ffmpeg_path = 'ffmpeg'
 
@@ -390,7 +519,7 @@ class FFMpeg(object):
             raise FFMpegError("ffprobe binary not found: " + self.ffprobe_path)
 
     @staticmethod
-    def _spawn(cmds):
+    def _spawn(cmds, resources=None):
         clean_cmds = []
         try:
             for cmd in cmds:
@@ -410,7 +539,10 @@ class FFMpeg(object):
             kwargs.update(preexec_fn=os.setsid)
         else:  # Python 3.2+ and Unix
             kwargs.update(start_new_session=True)
-        return subprocess.Popen(cmds, stdin=PIPE, stdout=PIPE, stderr=PIPE, **kwargs )
+        p = subprocess.Popen(cmds, stdin=PIPE, stdout=PIPE, stderr=PIPE, **kwargs )
+        if resources:
+            resources.apply(p.pid)
+        return p
 
     def probe(self, fname, posters_as_video=True):
         """
@@ -453,7 +585,31 @@ class FFMpeg(object):
 
         return info
 
-    def convert(self, infile, outfile, opts, stop_event, timeout=10, preopts=None, postopts=None):
+    def build_command(self, infile, outfile, opts, preopts=None, postopts=None):
+        """
+        Build the ffmpeg command line converting infile to outfile with
+        opts (a list of ffmpeg switches as strings). Additional inputs in
+        opts are moved to the front of the line.
+        """
+        opts = list(opts)
+        cmds = [self.ffmpeg_path]
+        if preopts:
+            cmds.extend(preopts)
+        cmds.extend(['-i', infile])
+
+        # Move additional inputs to the front of the line
+        while '-i' in opts[:-1]:
+            ind = opts.index('-i')
+            cmds.extend(['-i', opts[ind + 1]])
+            del opts[ind:ind + 2]
+
+        cmds.extend(opts)
+        if postopts:
+            cmds.extend(postopts)
+        cmds.extend(['-y', outfile])
+        return cmds
+
+    def convert(self, infile, outfile, opts, stop_event, timeout=10, preopts=None, postopts=None, watchdog=None, resources=None, preemptor=None):
         """
         Convert the source media (infile) according to specified options
         (a list of ffmpeg switches as strings) and save it to outfile.
@@ -468,90 +624,88 @@ class FFMpeg(object):
         the documentation in Converter.convert() for more details about this
         option.
 
+        The optional watchdog is a converter.watchdog.StallWatchdog. It is
+        fed every progress update and ffmpeg is killed with an
+        FFMpegStallError once it reports a stall.
+
+        The optional resources is a resource_classes.ResourceClass whose
+        CPU and I/O limits are applied to ffmpeg as soon as it starts, and the
+        optional preemptor (preemption.Preemptor) suspends it while jobs of
+        a higher class run. Suspended time never counts towards the timeout
+        or a stall.
+
         >>> conv = FFMpeg().convert('test.ogg', '/tmp/output.mp3',
         ...    ['-acodec libmp3lame', '-vn'])
         >>> for timecode in conv:
         ...    pass # can be used to inform the user about conversion progress
 
         """
-        if os.name == 'nt':
-            timeout = 0
-
         if not os.path.exists(infile):
             raise FFMpegError("Input file doesn't exist: " + infile)
 
-        cmds = [self.ffmpeg_path]
-        if preopts:
-            cmds.extend(preopts)
-        cmds.extend(['-i', infile])
-
-        alreadykludged = False
-        # Move additional inputs to the front of the line
-        for ind, command in enumerate(opts):
-            if command == '-vcodec' and opts[ind + 1] != 'copy':
-                alreadykludged = True
-            if command == '-i':
-                cmds.extend(['-i', opts[ind + 1]])
-                del opts[ind]
-                del opts[ind]
-
-        cmds.extend(opts)
-        if postopts:
-            cmds.extend(postopts)
-        cmds.extend(['-y', outfile])
+        alreadykludged = any(command == '-vcodec' and opts[ind + 1] != 'copy' for ind, command in enumerate(opts[:-1]))
+        cmds = self.build_command(infile, outfile, opts, preopts, postopts)
 
-        if timeout:
-            def on_sigalrm(*_):
-                signal.signal(signal.SIGALRM, signal.SIG_DFL)
-                raise Exception('timed out while waiting for ffmpeg')
-
-            signal.signal(signal.SIGALRM, on_sigalrm)
         print("command is: %s" % (cmds))
         try:
-            p = self._spawn(cmds)
+            p = self._spawn(cmds, resources)
         except OSError:
             raise FFMpegError('Error while calling ffmpeg binary')
 
         yielded = False
         buf = ''
         total_output = ''
-        ctime = re.compile(r'time=([0-9.:]+) ')
-        cframe = re.compile(r'frame=(\s*\d+) ')
-        cfps = re.compile(r'fps=(\s*\d+) ')
-        cq = re.compile(r'q=([\d*.]+) ')
-        cspeed = re.compile(r'speed=([\s*\d*.\d*x\s*]+) ')
-        cbitrate = re.compile(r'bitrate=([\s*\d*.\d*\w*/\w*]+) ')
         frame = 0
-        starttime = time.time()
-        lastframetime = starttime
-        ignore_non_monotonous = False
+        monitor = OutputMonitor()
         timecode = 0
         fpsspec = 0
         cqspec = 0
         cspeedspec = 0
         bitratespec = 0
-        
-        while not stop_event.is_set():
-           
-            event_is_set = stop_event.wait(.1)
-            
-            if event_is_set:
-                pid = p.pid
 
+        # ffmpeg output is read on a watchdog thread, the loop only waits on it with a timeout
+        reader = OutputReader(p.stderr)
+        reader.start()
+        lastoutput = time.time()
+        if watchdog:
+            watchdog.start()
+        if preemptor:
+            preemptor.attach(p.pid)
+        suspended = False
+
+        while True:
+            if stop_event.is_set():
+                if preemptor:
+                    preemptor.resume()
                 try:
                     p.terminate()
                 except:
                     print ("Terminated gracefully")
                 return
 
-                    
-            if timeout:
-                signal.alarm(timeout)
+            ret = reader.read(.1)
 
-            ret = p.stderr.read(30)
+            if preemptor:
+                suspended = preemptor.poll()
+                paused = preemptor.elapsed()
+                if paused:
+                    lastoutput += paused
+                    monitor.shift(paused)
+                    if watchdog:
+                        watchdog.shift(paused)
 
-            if timeout:
-                signal.alarm(0)
+            if watchdog and not suspended:
+                stalled = watchdog.check()
+                if stalled:
+                    p.terminate()
+                    raise FFMpegStallError('Stalled conversion', ' '.join(cmds), total_output, stalled, pid=p.pid, stats=watchdog.last)
+
+            if ret is None:
+                if timeout and not suspended and ( time.time() - lastoutput ) > timeout:
+                    p.terminate()
+                    raise FFMpegConvertError('timed out while waiting for ffmpeg', ' '.join(cmds), total_output, pid=p.pid)
+                continue
+            lastoutput = time.time()
 
             if not ret:
                 # For small or very fast jobs, ffmpeg may never output a '\r'.  When EOF is reached, yield if we haven't yet.
@@ -577,74 +731,39 @@ class FFMpeg(object):
             # If the audio is being converted but the video is not, sometimes ffmpeg will spam warnings about 
             # how there is a "non-monotonous dts in output stream" -- This basically means that the sound is going
             # to be out of sync with the video and the only way to fix this it to re-encode the video along with the sound.
-            # I don't feel like reorganizing everything to support sending the same file back through ffmpeg with different commands
-            # Instead, we're going to close the current ffmpeg instance, and pipe the file through manual.py with a 
-            # new option to force re-encoding.
-            # The script will wait here until the subprocess is finished, in which it then exits this function and
-            # pretends that everything is a-okay so that sabn/nzbget/etc scripts will properly autoimport the file.
-
-            if 'Queue input is backward in time' in ret: # This warning tends to come up at the very end of a file
-                ignore_non_monotonous = True # generally it's because the audio stream ends a few seconds before the video.
-                # After this, it will spam warnings about non-monotonous DTS, but it doesn't matter since it's during the credits.
-                # So, we won't re-encode a video just because the last few seconds of audio are trash.
-
-            if 'Non-monotonous DTS' in ret and ignore_non_monotonous == False: #engage kludge... but don't do it at the end of the audio stream.
+            # The caller retries the conversion with the video encoded (see MkvtoMp4.reencodeOptions).
+
+            if monitor.timestamps(ret): #engage kludge... but don't do it at the end of the audio stream.
                 p.terminate()
                 if alreadykludged == False:
-                    for i in range( 3 ):
-                        try:
-                            os.remove(outfile)
-                            break
-                        except:
-                            time.sleep(10)
-                    os.chdir( os.path.dirname( abspath(getsourcefile(lambda:0)) ) ) #ugh, path problems.
-                    os.chdir( '..' )
-                    subprocess.call(["python", "manual.py", "-a", "-i", infile, "--forceConvert"])
-                    return
-
-            if '\r' in buf:
+                    raise FFMpegTimestampError('Non-monotonous DTS', ' '.join(cmds), total_output, pid=p.pid)
+
+            while '\r' in buf:
                 #print("in buf")
                 line, buf = buf.split('\r', 1)
 
-                tmptime = ctime.findall(line)
-                tmpframe = cframe.findall(line)
-                tmpcfps = cfps.findall(line)
-                tmpcq = cq.findall(line)
-                tmpcspeed = cspeed.findall(line)
-                tmpcbitrate = cbitrate.findall(line)
-
-                if len(tmpframe) == 1 and frame != 0 and frame == int( tmpframe[0] ):
-                    if starttime == lastframetime:
-                        lastframetime = time.time()
-                    elif ( time.time() - lastframetime ) > 600.0:
-                        cmd = ' '.join(cmds)
-                        p.terminate()
-                        raise FFMpegConvertError('Forcing ffmpeg to close due to taking more than 10 minutes to render a single frame. Source file may be corrupt.', cmd, total_output, "None", pid=p.pid)
-                else:
-                    starttime = time.time()
-                    lastframetime = starttime
-                if len( tmpframe ) == 1:
-                    frame = int( tmpframe[0] )
-                if len(tmptime) == 1:
-                    timespec = tmptime[0]
-                    if ':' in timespec:
-                        timecode = 0
-                        for part in timespec.split(':'):
-                            timecode = 60 * timecode + float(part)
-                    else:
-                        timecode = float(tmptime[0])
-                if len(tmpcfps) == 1:
-                    fpsspec = tmpcfps[0].strip()
-                if len(tmpcq) == 1:
-                    cqspec = tmpcq[0]
-                if len(tmpcspeed) == 1:
-                    cspeedspec = tmpcspeed[0].strip()
-                if len(tmpcbitrate) == 1:
-                    bitratespec = tmpcbitrate[0]
+                progress = parse_progress(line)
+
+                if monitor.stuck(progress):
+                    cmd = ' '.join(cmds)
+                    p.terminate()
+                    raise FFMpegConvertError('Forcing ffmpeg to close due to taking more than 10 minutes to render a single frame. Source file may be corrupt.', cmd, total_output, "None", pid=p.pid)
+                if progress['frame'] is not None:
+                    frame = progress['frame']
+                if progress['time'] is not None:
+                    timecode = progress['time']
+                if progress['fps'] is not None:
+                    fpsspec = progress['fps']
+                if progress['q'] is not None:
+                    cqspec = progress['q']
+                if progress['speed'] is not None:
+                    cspeedspec = progress['speed']
+                if progress['bitrate'] is not None:
+                    bitratespec = progress['bitrate']
+                if watchdog and (progress['time'] is not None or progress['frame'] is not None):
+                    watchdog.update(timecode, frame)
                 yielded = True                
                 yield [timecode, fpsspec, cqspec, cspeedspec, bitratespec, p.pid]
-        if timeout:
-            signal.signal(signal.SIGALRM, signal.SIG_DFL)
 
         p.communicate()  # wait for process to exit
 
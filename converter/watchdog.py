@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import time
+from converter.capabilities import encoder_name
+
+# Typical encode speed (media seconds per second) for 1080p sources, by ffmpeg encoder
+EXPECTED_SPEEDS = {
+    'copy': 30.0,
+    'libx264': 1.5,
+    'libx265': 0.4,
+    'nvenc_h264': 6.0,
+    'h264_nvenc': 6.0,
+    'hevc_nvenc': 4.0,
+    'h264_qsv': 4.0,
+    'hevc_qsv': 2.5,
+    'h264_vaapi': 4.0,
+}
+DEFAULT_SPEED = 1.0
+REFERENCE_PIXELS = 1920 * 1080
+
+
+def expected_speed(codec, width=None, height=None):
+    """
+    Estimate the encode speed for a converter codec name at a resolution.
+    Speeds scale with the pixel count relative to 1080p, within 4x either
+    way. Copies do not depend on the resolution.
+    """
+    if codec is None or codec == 'copy':
+        return EXPECTED_SPEEDS['copy']
+    speed = EXPECTED_SPEEDS.get(encoder_name(codec) or codec, DEFAULT_SPEED)
+    if width and height:
+        speed *= min(4.0, max(0.25, float(REFERENCE_PIXELS) / (width * height)))
+    return speed
+
+
+class StallWatchdog(object):
+    """
+    Tracks the encode speed and frame rate of a conversion over a sliding
+    window and flags it once its throughput drops below fraction of the
+    expected speed. Hard stalls, where ffmpeg stops reporting progress
+    entirely, show up as a speed of 0 once the window has passed.
+
+    >>> w = StallWatchdog(expected_speed('h264', 1920, 1080), fraction=0.1, window=120)
+    >>> w.start()
+    >>> w.update(timecode, frame)  # for every progress line
+    >>> reason = w.check()         # None while the conversion is healthy
+    """
+
+    def __init__(self, expected, fraction=0.1, window=120.0, clock=time.time):
+        self.expected = expected
+        self.fraction = fraction
+        self.window = window
+        self.clock = clock
+        self.start()
+
+    def start(self):
+        # Called when ffmpeg is spawned, the window only starts counting from here
+        self.started = self.clock()
+        self.samples = [(self.started, 0.0, 0)]
+        self.last = None
+
+    def trim(self, now):
+        # Keep the newest sample from before the window as the baseline to measure across all of it
+        while len(self.samples) > 1 and self.samples[1][0] <= now - self.window:
+            self.samples.pop(0)
+
+    def update(self, timecode, frame=None):
+        now = self.clock()
+        self.samples.append((now, float(timecode or 0), int(frame or 0)))
+        self.trim(now)
+
+    def shift(self, seconds):
+        # Leave out time ffmpeg spent suspended, as if every earlier sample had been taken that much later
+        self.started += seconds
+        self.samples = [(sampled + seconds, timecode, frame) for sampled, timecode, frame in self.samples]
+
+    def rates(self):
+        """
+        Return (speed, fps) over the current window.
+        """
+        now = self.clock()
+        self.trim(now)
+        first = self.samples[0]
+        last = self.samples[-1]
+        elapsed = now - first[0]
+        if elapsed <= 0:
+            return None, None
+        return (last[1] - first[1]) / elapsed, (last[2] - first[2]) / elapsed
+
+    def check(self):
+        """
+        Return a description of the stall, or None while the conversion is
+        healthy or still inside its first window.
+        """
+        if not self.fraction or not self.expected or not self.window:
+            return None
+        if self.clock() - self.started < self.window:
+            return None
+        speed, fps = self.rates()
+        if speed is None:
+            return None
+        self.last = {'speed': round(speed, 4), 'fps': round(fps, 2), 'expected_speed': round(self.expected, 4),
+                     'fraction': self.fraction, 'window': self.window}
+        if speed < self.expected * self.fraction:
+            return 'Encode speed %.3fx (%.1f fps) over the last %ds is below %d%% of the expected %.2fx' % (speed, fps, self.window, self.fraction * 100, self.expected)
+        return None
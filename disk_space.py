@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import logging
+import threading
+import itertools
+from preemption import privateDirectory, makePrivate, lockFile, unlock, held
+from scratch_area import freeSpace
+from option_planner import estimateVideoBitrate
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Container overhead on top of the stream bitrates of an output
+CONTAINER_OVERHEAD = 1.02
+# Kilobits per second of an audio channel whose source bitrate is unknown
+AUDIO_CHANNEL_RATE = 256
+# Seconds without a write to any path of a reservation before it no longer counts, its conversion is hung
+STALE_AFTER = 6 * 3600
+
+
+def parseRate(value):
+    # Bitrate option in kbps, "8000k" and "8M" strings as ffmpeg takes them, None if it is not a rate
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        text = str(value).strip().lower()
+        if text.endswith('k'):
+            return float(text[:-1])
+        if text.endswith('m'):
+            return float(text[:-1]) * 1000
+    except ValueError:
+        pass
+    return None
+
+
+def predictSize(options, info, sourceSize, log=None):
+    """Predict the bytes of the output of a conversion from its planned bitrates and the duration of the source. Copied
+    streams keep their source bitrate and a video encoded at constant quality is assumed no larger than its source,
+    so a plain remux is predicted at the size of the source."""
+    log = log or logging.getLogger(__name__)
+    duration = (info.format.duration if info is not None and info.format else None) or 0
+    video = options.get('video') or {}
+    audio = options.get('audio') or {}
+    if not duration or (video.get('codec') == 'copy' and all(a.get('codec') == 'copy' for a in audio.values())):
+        return sourceSize
+
+    try:
+        sourceVideo = estimateVideoBitrate(info, log)
+    except Exception:
+        sourceVideo = None
+    if video.get('codec') == 'copy':
+        vrate = sourceVideo
+    else:
+        # maxrate caps what a constant quality encode may use
+        vrate = parseRate(video.get('maxrate')) or parseRate(video.get('bitrate')) or sourceVideo
+    if vrate is None:
+        return sourceSize
+
+    sources = dict((a.index, a) for a in info.audio)
+    arate = 0.0
+    for a in audio.values():
+        source = sources.get(a.get('map'))
+        if a.get('codec') == 'copy':
+            rate = source.bitrate / 1000.0 if source is not None and source.bitrate else None
+        else:
+            rate = parseRate(a.get('bitrate'))
+        if not rate:
+            rate = (a.get('channels') or (source.audio_channels if source is not None else 2) or 2) * AUDIO_CHANNEL_RATE
+        arate += rate
+    return int((vrate + arate) * 1000 / 8 * duration * CONTAINER_OVERHEAD)
+
+
+def written(path, since):
+    # Bytes of path written since a time, a file that was there before is going to be replaced
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return 0
+    return st.st_size if st.st_mtime >= since - 1 else 0
+
+
+def mountOf(path):
+    # Device of the file system a path is or will be written on, and the closest existing directory of it
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    try:
+        return os.stat(path).st_dev, path
+    except OSError:
+        return None, path
+
+
+def spaceNeeds(size, moves, copies=(), rewrite=False):
+    """Bytes needed on every file system by an output of size bytes written at moves[0], moved through the other paths
+    of moves in turn and copied to every path of copies. A file moved within a file system needs its space there only
+    once, rewrite adds a temporary copy where it is first written (QT FastStart). Returns [path, device, size, since]
+    entries, the bytes written to path after since no longer count against the free space."""
+    since = time.time()
+    needs = []
+    devices = set()
+    for path in moves:
+        device, directory = mountOf(os.path.dirname(path))
+        if device in devices:
+            continue
+        devices.add(device)
+        needs.append([path, device, size, since])
+    if rewrite and moves:
+        needs.append([None, needs[0][1], size, since])
+    for path in copies:
+        needs.append([path, mountOf(os.path.dirname(path))[0], size, since])
+    return needs
+
+
+class SpaceLedger:
+    """Disk space reserved by the conversions of every process on the machine.
+
+    A conversion is only admitted once the predicted size of its output fits the free space of every file system it
+    will be written to, less the margin and less what other running conversions reserved there and have not written
+    yet. Each admitted conversion holds a locked file with its reservations until its output is delivered, written
+    under an exclusive lock so concurrent jobs cannot all pass the check on the same free space. A reservation whose
+    lock nobody holds was left by a process that died and is removed when it is found, one whose paths were not
+    written for STALE_AFTER seconds no longer counts. The files live in a directory only the user can write to."""
+
+    def __init__(self, path=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.path = path or privateDirectory("mp4_automator-space")
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # Open reservation files of this process, locked where file locks are available
+        self.files = {}
+
+    def locked(self, function, *args):
+        # Run function holding the lock of this process and, where there is one, the lock file shared by all of them
+        with self.lock:
+            makePrivate(self.path)
+            if fcntl is None:
+                return function(*args)
+            with open(os.path.join(self.path, '.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    return function(*args)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load(self, exclude=None):
+        # Entries of every live reservation but exclude, by device
+        reserved = {}
+        now = time.time()
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.startswith('.') or path == exclude:
+                continue
+            # Without file locks only the reservations of this process are known to be live
+            if not (held(path) if fcntl is not None else path in self.files):
+                self.remove(path)
+                continue
+            try:
+                with open(path, 'r') as f:
+                    entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            if now - self.activity(entries) > STALE_AFTER:
+                self.log.debug("Ignoring reservation %s, none of its paths were written for %d hours." % (name, STALE_AFTER // 3600))
+                continue
+            for entry in entries:
+                reserved.setdefault(entry[1], []).append(entry)
+        return reserved
+
+    def activity(self, entries):
+        # Last time a reservation was made or any of its paths was written
+        last = max([since for path, device, size, since in entries] or [0])
+        for path, device, size, since in entries:
+            try:
+                last = max(last, os.path.getmtime(path))
+            except (OSError, TypeError):
+                pass
+        return last
+
+    def pending(self, entries):
+        # Reserved bytes not written yet
+        return sum(max(0, size - written(path, since)) for path, device, size, since in entries)
+
+    def fits(self, needs, margin, label, reservation=None):
+        reserved = self.load(exclude=reservation)
+        wanted = {}
+        for entry in needs:
+            wanted.setdefault(entry[1], []).append(entry)
+        for device, entries in wanted.items():
+            if device is None:
+                continue
+            directory = mountOf(os.path.dirname(entries[0][0] or needs[0][0]))[1]
+            free = freeSpace(directory)
+            if free is None:
+                continue
+            other = self.pending(reserved.get(device, []))
+            need = self.pending(entries)
+            if free - margin - other < need:
+                self.log.error("Not enough free space on %s for %s: %dMB needed, %dMB free with %dMB reserved by other conversions and %dMB kept free." % (directory, label, need // 1048576, free // 1048576, other // 1048576, margin // 1048576))
+                return False
+        return True
+
+    def write(self, reservation, entries):
+        # Replace the entries in the open file of a reservation, creating and locking it first
+        f = self.files.get(reservation)
+        if f is None:
+            f = self.files[reservation] = lockFile(reservation) if fcntl is not None else open(reservation, 'w')
+        f.seek(0)
+        f.truncate()
+        json.dump(entries, f)
+        f.flush()
+
+    def reserve(self, needs, margin=0, label=''):
+        """Reserve the space of the entries of spaceNeeds, keeping margin bytes free on every file
+        system. Returns the reservation to release once the output is delivered, False when it does not fit and None
+        when the ledger cannot be used."""
+        def reserve():
+            if not self.fits(needs, margin, label):
+                return False
+            reservation = os.path.join(self.path, "%d-%d" % (os.getpid(), next(self.counter)))
+            self.write(reservation, needs)
+            return reservation
+        try:
+            return self.locked(reserve)
+        except (IOError, OSError):
+            self.log.exception("Unable to reserve disk space for %s, not checking the free space." % label)
+            return None
+
+    def amend(self, reservation, needs, margin=0, label=''):
+        # Replace the entries of a reservation once the paths of the output are known, False when they do not fit
+        def amend():
+            if not self.fits(needs, margin, label, reservation):
+                return False
+            self.write(reservation, needs)
+            return True
+        if not reservation:
+            return True
+        try:
+            return self.locked(amend)
+        except (IOError, OSError):
+            self.log.exception("Unable to amend the disk space reservation of %s." % label)
+            return True
+
+    def remove(self, reservation):
+        try:
+            os.remove(reservation)
+        except OSError:
+            pass
+
+    def release(self, reservation):
+        if not reservation:
+            return
+        with self.lock:
+            f = self.files.pop(reservation, None)
+        if f is None:
+            self.remove(reservation)
+        elif fcntl is not None:
+            unlock(f)
+        else:
+            f.close()
+            self.remove(reservation)
+
+
+# Shared by every MkvtoMp4 instance and runner in the process
+spaceLedger = SpaceLedger()
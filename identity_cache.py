@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import logging
+import threading
+
+
+class IdentityCache:
+    """Remembers how files were identified during a batch.
+
+    Filename guesses and (title, year) -> TVDB/TMDB id resolutions are kept in memory for the run, so every episode of a
+    series resolves the series once. Mappings the user confirmed are also written to a JSON file and reused by later runs."""
+
+    def __init__(self, path=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.path = path or os.path.join(os.path.dirname(sys.argv[0]), "identifications.json")
+        self.lock = threading.RLock()
+        self.guesses = {}
+        self.resolved = {'series': {}, 'movie': {}}
+        self.confirmed = {'series': {}, 'movie': {}}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def key(self, title, year=None):
+        # Titles are matched on their lowercase alphanumeric characters
+        title = ''.join(e for e in title if e.isalnum()).lower()
+        return "%s|%s" % (title, year or '')
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            for kind in self.confirmed:
+                self.confirmed[kind].update(data.get(kind, {}))
+            self.log.debug("Loaded %d confirmed identifications from %s." % (sum(len(v) for v in self.confirmed.values()), self.path))
+        except (IOError, OSError):
+            pass
+        except ValueError:
+            self.log.warning("Unable to read identification store %s, ignoring it." % self.path)
+
+    def save(self):
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.confirmed, f, indent=2, sort_keys=True)
+            if os.path.exists(self.path) and os.name == 'nt':
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            self.log.exception("Unable to write identification store %s." % self.path)
+
+    def guess(self, filename, guesser, kind='file'):
+        # Return the cached guess for filename, running guesser(filename) the first time
+        with self.lock:
+            if (kind, filename) not in self.guesses:
+                self.guesses[(kind, filename)] = guesser(filename)
+            return self.guesses[(kind, filename)]
+
+    def get(self, kind, title, year=None):
+        # Return the resolved {'id': ..., 'name': ...} for a title, confirmed mappings first
+        key = self.key(title, year)
+        with self.lock:
+            result = self.confirmed[kind].get(key) or self.resolved[kind].get(key)
+            if result:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return result
+
+    def set(self, kind, title, year, id, name=None, confirmed=False):
+        key = self.key(title, year)
+        with self.lock:
+            self.resolved[kind][key] = {'id': id, 'name': name}
+            if confirmed and self.confirmed[kind].get(key) != self.resolved[kind][key]:
+                self.confirmed[kind][key] = self.resolved[kind][key]
+                self.save()
+
+    def name(self, kind, id):
+        # Return a known display name for an id, if any title resolved to it
+        with self.lock:
+            for store in (self.confirmed[kind], self.resolved[kind]):
+                for value in store.values():
+                    if str(value['id']) == str(id) and value.get('name'):
+                        return value['name']
+        return None
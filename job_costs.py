@@ -0,0 +1,134 @@
+import logging
+import threading
+from converter.watchdog import expected_speed
+from job_events import jobEvents
+from option_planner import optionsPreset
+
+# Queue order of the priority classes, lower runs first
+PRIORITIES = {'hook': 0, 'interactive': 1, 'backfill': 2}
+# Finished jobs a feature combination needs before its own speed is trusted over a more general one
+MIN_SAMPLES = 3
+# Seconds every job spends outside of ffmpeg (probing, tagging, moving)
+JOB_OVERHEAD = 5.0
+
+
+def resolutionClass(width):
+    if not width:
+        return 'unknown'
+    if width <= 1024:
+        return 'sd'
+    if width <= 1920:
+        return 'hd'
+    return 'uhd'
+
+
+def jobFeatures(info, options=None):
+    """Describe a job by what drives its cost: source duration, resolution and codec, and the codec, preset and
+    hardware decoding of its conversion. A job without options (not planned yet) is described by its source only."""
+    video = info.video if info is not None else None
+    features = {'duration': (info.format.duration if info is not None and info.format else None) or 0.0,
+                'width': (video.video_width if video else None) or 0,
+                'height': (video.video_height if video else None) or 0,
+                'source_codec': video.codec if video else None,
+                'codec': None,
+                'copy': False,
+                'preset': None,
+                'hwaccel': False}
+    if options:
+        video_options = options.get('video') or {}
+        preopts = options.get('preopts') or []
+        features['codec'] = video_options.get('codec')
+        features['copy'] = features['codec'] == 'copy'
+        features['preset'] = optionsPreset(options)
+        features['hwaccel'] = '-hwaccel' in preopts or '-vcodec' in preopts or bool(video_options.get('nvenc_hwaccel_enabled'))
+    return features
+
+
+class CostModel:
+    """Estimates how long a conversion takes from the recorded wall time of finished jobs.
+
+    Every finished job adds its media duration and wall time to the speed of each of its feature combinations, from
+    the exact one (mode, source codec, resolution, preset, hardware decoding) down to the output mode alone. A new job
+    uses the most specific combination with enough history and falls back to the static speed table of the stall
+    watchdog when nothing similar ever ran."""
+
+    def __init__(self, events=None, history=1000, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.events = events or jobEvents
+        self.history = history
+        self.lock = threading.Lock()
+        self.speeds = None
+
+    def keys(self, features):
+        mode = 'copy' if features.get('copy') else (features.get('codec') or 'unknown')
+        resolution = resolutionClass(features.get('width'))
+        return [(mode, features.get('source_codec'), resolution, features.get('preset'), bool(features.get('hwaccel'))),
+                (mode, resolution, bool(features.get('hwaccel'))),
+                (mode, resolution),
+                (mode,)]
+
+    def load(self):
+        # Build the speed tables from the job history, once per process
+        with self.lock:
+            if self.speeds is not None:
+                return
+            self.speeds = {}
+            jobs = self.events.read('job')[-self.history:]
+        for event in jobs:
+            self.add(event.get('features') or {}, event.get('wall'))
+        self.log.debug("Loaded %d finished jobs into the cost model." % len(jobs))
+
+    def add(self, features, wall):
+        # Learn from a finished job
+        try:
+            duration = float(features.get('duration') or 0)
+            wall = float(wall or 0)
+        except (TypeError, ValueError):
+            return
+        if duration <= 0 or wall <= 0:
+            return
+        with self.lock:
+            if self.speeds is None:
+                self.speeds = {}
+            for key in self.keys(features):
+                entry = self.speeds.setdefault(key, [0.0, 0.0, 0])
+                entry[0] += duration
+                entry[1] += wall
+                entry[2] += 1
+
+    def record(self, inputfile, features, wall, **fields):
+        # Record a finished job in the job history and learn from it
+        self.load()
+        self.events.record('job', input=inputfile, features=features, wall=round(wall, 2), **fields)
+        self.add(features, wall)
+
+    def speed(self, features):
+        """Expected speed (media seconds per second) of a job."""
+        self.load()
+        with self.lock:
+            keys = self.keys(features)
+            for depth, key in enumerate(keys):
+                entry = self.speeds.get(key)
+                if entry and (entry[2] >= MIN_SAMPLES or depth == len(keys) - 1):
+                    return entry[0] / entry[1]
+        codec = 'copy' if features.get('copy') else features.get('codec')
+        return expected_speed(codec, features.get('width'), features.get('height'))
+
+    def estimate(self, features):
+        """Estimated wall time of a job in seconds."""
+        return JOB_OVERHEAD + float(features.get('duration') or 0) / self.speed(features)
+
+
+def formatEta(seconds):
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(max(0, seconds))
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+# Shared by every MkvtoMp4 instance and runner in the process
+costModel = CostModel()
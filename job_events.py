@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+
+
+class JobEvents:
+    """Append-only log of conversion events.
+
+    Every event is written as one JSON line with its kind and a timestamp, so the file can be appended to by several
+    processes at once and read back without loading a whole document."""
+
+    def __init__(self, path=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.path = path or os.path.join(os.path.dirname(sys.argv[0]), "job_events.jsonl")
+        self.lock = threading.Lock()
+
+    def record(self, kind, **fields):
+        # Append an event, failures are logged but never interrupt the job
+        fields['kind'] = kind
+        fields['time'] = time.time()
+        try:
+            line = json.dumps(fields, sort_keys=True, default=str)
+            with self.lock:
+                with open(self.path, 'a') as f:
+                    f.write(line + "\n")
+        except (IOError, OSError, TypeError, ValueError):
+            self.log.exception("Unable to record %s event in %s." % (kind, self.path))
+        return fields
+
+    def read(self, kind=None):
+        # Return the recorded events, oldest first, optionally only those of one kind
+        events = []
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if kind is None or event.get('kind') == kind:
+                        events.append(event)
+        except (IOError, OSError):
+            pass
+        return events
+
+
+# Shared by every MkvtoMp4 instance in the process
+jobEvents = JobEvents()
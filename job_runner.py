@@ -0,0 +1,489 @@
+import os
+import re
+import sys
+import time
+import heapq
+import asyncio
+import logging
+from subprocess import DEVNULL
+from converter import Converter, ConverterError, FFMpegConvertError, FFMpegStallError, FFMpegTimestampError
+from converter.ffmpeg import parse_progress, console_encoding, OutputMonitor
+from mkvtomp4 import MkvtoMp4
+from job_costs import PRIORITIES, formatEta
+from preset_ladder import ladderFromSettings
+from preemption import preemptionClaims
+from post_pipeline import PostPipeline
+
+# States of a job that is holding one of the runner's slots
+ACTIVE_STATES = ['preparing', 'staging', 'converting']
+# States of a converted job waiting for or running its post-encode steps
+POST_STATES = ['encoded', 'finishing']
+
+
+class Job:
+    """A file queued on a JobRunner and the progress of its conversion."""
+
+    def __init__(self, inputfile, tagdata=None, relativePath=None, priority='backfill', index=0):
+        self.inputfile = inputfile
+        self.tagdata = tagdata
+        self.relativePath = relativePath
+        self.priority = priority
+        self.index = index
+        self.name = os.path.basename(inputfile)
+        self.state = 'queued'
+        self.features = None
+        self.estimate = None
+        self.converting = None
+        self.percent = 0.0
+        self.fps = None
+        self.speed = None
+        self.pid = None
+        self.suspended = False
+        self.prefetched = False
+        self.started = None
+        self.finished = None
+        self.output = None
+        # Set when the post stage raised, the output may not have been delivered
+        self.postFailed = False
+        # Free for the begin and finish callbacks
+        self.context = None
+
+    def update(self, progress, duration, index=0, passes=1):
+        # Apply a parsed ffmpeg progress line, each pass of a two pass encode counts for an equal share
+        if progress['time'] is not None and duration:
+            self.percent = round(min(100.0, (100.0 * index + min(100.0, 100.0 * progress['time'] / duration)) / passes), 2)
+        if progress['fps'] is not None:
+            self.fps = progress['fps']
+        if progress['speed'] is not None:
+            self.speed = progress['speed']
+
+    def remaining(self, now=None):
+        # Estimated seconds until the job finishes, from its progress once ffmpeg reports some
+        now = now or time.time()
+        if self.state in ('done', 'failed'):
+            return 0.0
+        if self.state == 'converting' and self.converting and self.percent > 0:
+            return (now - self.converting) * (100.0 - self.percent) / self.percent
+        if self.estimate is None:
+            return None
+        if self.started:
+            return max(0.0, self.estimate - (now - self.started))
+        return self.estimate
+
+
+class JobRunner:
+    """Converts several files at once from a single process.
+
+    Up to `jobs` ffmpeg processes are driven concurrently with asyncio subprocesses and their progress is shown in one
+    combined view. Option generation and the post conversion steps run on the event loop's thread pool, and every job
+    shares the same settings object, so its compiled profile and the shared subtitle, artwork and capability caches
+    stay warm for the whole batch. begin(converter, job) and finish(converter, output, job) are optional callbacks run
+    on the thread pool when a job starts and after its file was converted. With deferMove the staged outputs are left
+    for finish to tag and replicate (see MkvtoMp4).
+
+    Before starting, every queued file is probed and planned to estimate its cost from the job history (see
+    job_costs.CostModel). Jobs run by priority class (hook, interactive, backfill) and within a class shortest job
+    first, or in the order they were added with order='fifo'. The estimates also give the ETAs of the progress view.
+
+    With a load_control.ConcurrencyController the number of jobs follows the load of the machine instead of `jobs`,
+    and copy-only remuxes may start beyond the encode limit.
+
+    A job gives up its slot as soon as ffmpeg exits. Its post-encode steps (complete and the finish callback) run on
+    the I/O workers of a post_pipeline.PostPipeline, whose queue depth is shown in the view."""
+
+    def __init__(self, settings, jobs=2, begin=None, finish=None, stop_event=None, order='sjf', priority='backfill', controller=None, deferMove=False, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.settings = settings
+        self.jobs = max(1, int(jobs))
+        self.begin = begin
+        self.finish = finish
+        self.deferMove = deferMove
+        self.stop_event = stop_event
+        self.order = order
+        self.priority = priority
+        self.queue = []
+        self.all = []
+        self.shown = 0
+        self.logged = 0
+        self.ladder = ladderFromSettings(settings, self.log)
+        self.controller = controller
+        self.controlled = None
+        self.converted = 0.0
+        self.scratch = None
+        self.post = None
+        self.postWorkers = getattr(settings, 'post_workers', 2)
+
+    def add(self, inputfile, tagdata=None, relativePath=None, priority=None):
+        priority = priority or self.priority
+        if priority not in PRIORITIES:
+            self.log.warning("Unknown priority class %s, using backfill." % priority)
+            priority = 'backfill'
+        job = Job(inputfile, tagdata, relativePath, priority, len(self.all))
+        self.queue.append(job)
+        self.all.append(job)
+        return job
+
+    def stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def run(self):
+        # Run every queued job, returns the list of jobs
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.main())
+        finally:
+            loop.close()
+        return self.all
+
+    def rank(self, job):
+        # Queue position of a job, jobs without an estimate go first as they usually fail fast
+        if self.order == 'sjf':
+            return (PRIORITIES[job.priority], job.estimate or 0.0, job.index)
+        return (PRIORITIES[job.priority], job.index)
+
+    async def estimate(self):
+        # Estimate the cost of every queued job and put the queue in order
+        async def estimateJob(job):
+            try:
+                job.features, job.estimate = await self.call(MkvtoMp4(self.settings, logger=self.log).estimateJob, job.inputfile)
+            except Exception:
+                self.log.debug("Unable to estimate %s." % job.inputfile, exc_info=True)
+        await asyncio.gather(*[estimateJob(job) for job in self.queue])
+        self.queue.sort(key=self.rank)
+        self.log.info("Queued %d jobs in %s order, estimated to take %s with %d at once." % (len(self.queue), self.order, formatEta(self.eta()), self.jobs))
+        for job in self.queue:
+            self.log.debug("%s [%s] estimated at %s." % (job.inputfile, job.priority, formatEta(job.estimate)))
+
+    def slots(self):
+        return self.controller.encodes if self.controller else self.jobs
+
+    def backlog(self):
+        # Estimated seconds of queued work per job slot
+        return sum(job.estimate or 0.0 for job in self.queue) / self.slots()
+
+    def eta(self):
+        # Seconds until the whole batch is done, placing each queued job on the slot that frees up first
+        now = time.time()
+        slots = [job.remaining(now) or 0.0 for job in self.all if job.state in ACTIVE_STATES]
+        slots.extend([0.0] * max(0, self.slots() - len(slots)))
+        heapq.heapify(slots)
+        for job in self.queue:
+            heapq.heappush(slots, heapq.heappop(slots) + (job.estimate or 0.0))
+        return max(slots) if slots else 0.0
+
+    async def main(self):
+        await self.estimate()
+        self.scratch = MkvtoMp4(self.settings, logger=self.log).scratchArea()
+        self.post = PostPipeline(self.postWorkers, logger=self.log)
+        view = asyncio.ensure_future(self.render())
+        tasks = set()
+        try:
+            while self.queue or tasks:
+                if self.stopped():
+                    if not tasks:
+                        break
+                else:
+                    self.control()
+                    job = self.nextJob()
+                    while job is not None:
+                        tasks.add(asyncio.ensure_future(self.work(job)))
+                        job = self.nextJob()
+                    self.prefetch()
+                if tasks:
+                    done, tasks = await asyncio.wait(tasks, timeout=1.0, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(1.0)
+        finally:
+            view.cancel()
+            await self.call(self.post.close)
+        self.show(final=True)
+
+    def isCopy(self, job):
+        return bool(job.features and job.features.get('copy'))
+
+    def nextJob(self):
+        # Take the first job in queue order that may start, a remux can pass encodes waiting for a slot
+        active = [job for job in self.all if job.state in ACTIVE_STATES]
+        copies = len([job for job in active if self.isCopy(job)])
+        encodes = len(active) - copies
+        self.queue.sort(key=self.rank)
+        for job in self.queue:
+            if self.controller is not None:
+                admitted = self.controller.admit(self.isCopy(job), encodes, copies) or not active
+            else:
+                admitted = len(active) < self.jobs
+            if admitted:
+                self.queue.remove(job)
+                # Counted as active right away, so the next pick sees it
+                job.state = 'preparing'
+                return job
+        return None
+
+    def prefetch(self):
+        # Copy the input of the next queued job to the scratch directory while the running ones convert
+        if self.scratch is None or not self.queue:
+            return
+        job = self.queue[0]
+        if not job.prefetched:
+            job.prefetched = True
+            self.scratch.prefetch(job.inputfile)
+
+    def control(self):
+        # Let the controller adjust the limits every interval from the load and the throughput since the last time
+        if self.controller is None:
+            return
+        now = time.time()
+        converted = sum((job.features or {}).get('duration', 0.0) * job.percent / 100.0 for job in self.all)
+        if self.controlled is not None and now - self.controlled < self.controller.interval:
+            return
+        throughput = (converted - self.converted) / (now - self.controlled) if self.controlled is not None else None
+        self.controlled = now
+        self.converted = converted
+        self.controller.update(throughput)
+
+    async def work(self, job):
+        try:
+            await self.runJob(job)
+        except Exception:
+            self.log.exception("Unexpected error processing %s." % job.inputfile)
+            job.state = 'failed'
+        if self.scratch is not None:
+            await self.call(self.scratch.discard, job.inputfile)
+        job.finished = time.time()
+
+    async def call(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def runJob(self, job):
+        job.started = time.time()
+        job.state = 'preparing'
+        converter = MkvtoMp4(self.settings, logger=self.log, deferMove=self.deferMove)
+        converter.priority = job.priority
+        if self.begin:
+            await self.call(self.begin, converter, job)
+
+        options = await self.call(converter.prepare, job.inputfile, self.stop_event)
+        if options is False:
+            job.state = 'failed'
+            return
+
+        inputfile = job.inputfile
+        outputfile = None
+        if options is not None:
+            if self.ladder is not None:
+                options = self.ladder.apply(job.inputfile, options, self.backlog())
+            if not await self.call(converter.admit, inputfile, options):
+                job.state = 'failed'
+                return
+            # Everything admit and stage reserved is released even when a step raises
+            source = staged = claim = None
+            outputfile = None
+            try:
+                destination, inputfile = await self.call(converter.outputPath, inputfile)
+                job.state = 'staging'
+                source, staged = await self.call(converter.stage, inputfile, destination)
+                job.state = 'converting'
+                claim = converter.claimPriority()
+                outputfile = await self.encode(job, converter, inputfile, staged, options, source)
+            finally:
+                preemptionClaims.release(claim)
+                await self.call(converter.unstage, inputfile, source, staged, outputfile is not None)
+            if not outputfile:
+                job.state = 'failed'
+                return
+
+        # The slot is free from here on
+        job.state = 'encoded'
+        job.percent = 100.0
+
+        def finishing():
+            job.state = 'finishing'
+            job.output = converter.complete(inputfile, outputfile, options)
+            if self.finish:
+                self.finish(converter, job.output, job)
+        try:
+            await self.postStage(job, finishing)
+        except Exception:
+            job.postFailed = True
+            raise
+        job.state = 'done'
+
+    async def postStage(self, job, function):
+        # Run function on the post pipeline and wait for it, raising its error
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def settle(result, error):
+            if future.cancelled():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        self.post.submit(job.name, function, (), lambda result, error: loop.call_soon_threadsafe(settle, result, error))
+        return await future
+
+    async def encode(self, job, converter, inputfile, outputfile, options, source=None):
+        # Run ffmpeg for a job reading source (its staged copy) or inputfile, retrying stalls with the fallback options. Returns the output file or None
+        source = source or inputfile
+        info = await self.call(converter.sourceInfo, source)
+        watchdog = converter.stallWatchdog(options, info)
+        resources = await self.call(converter.resourceClass)
+        preemptor = converter.preemptor()
+        attempt = 0
+        while True:
+            try:
+                job.converting = time.time()
+                job.percent = 0.0
+                commands, duration = await self.call(Converter(converter.FFMPEG_PATH, converter.FFPROBE_PATH).commands, source, outputfile, options, False, options['preopts'], options['postopts'])
+                for index, cmd in enumerate(commands):
+                    await self.ffmpeg(job, cmd, duration, index, len(commands), watchdog, resources, preemptor)
+                converter.recordJob(inputfile, options, info, time.time() - job.converting)
+            except FFMpegStallError as e:
+                options = await self.call(converter.stalled, inputfile, outputfile, options, e, attempt)
+                if options:
+                    attempt += 1
+                    continue
+                return None
+            except FFMpegTimestampError as e:
+                # Retried with its video encoded, as MkvtoMp4.convert does
+                forced = converter.reencodeOptions(options)
+                if os.path.isfile(outputfile):
+                    await self.call(converter.removeFile, outputfile)
+                if forced is None:
+                    self.log.error("Error converting %s: %s" % (inputfile, e))
+                    return None
+                self.log.warning("Non-monotonous DTS in %s, encoding the video instead of copying it." % inputfile)
+                options = forced
+                continue
+            except (FFMpegConvertError, ConverterError, OSError) as e:
+                self.log.error("Error converting %s: %s" % (inputfile, e))
+                if getattr(e, 'output', None):
+                    self.log.debug(e.output)
+                if os.path.isfile(outputfile):
+                    await self.call(converter.removeFile, outputfile)
+                    self.log.error("%s deleted." % outputfile)
+                return None
+
+            try:
+                os.chmod(outputfile, converter.permissions)  # Set permissions of newly created file
+            except:
+                self.log.exception("Unable to set new file permissions.")
+            return outputfile
+
+    async def ffmpeg(self, job, cmd, duration, index=0, passes=1, watchdog=None, resources=None, preemptor=None):
+        # Drive one ffmpeg process in the resource class of the job, feeding its progress to the job and the watchdog
+        cmd = [str(c) for c in cmd]
+        self.log.debug("Spawning ffmpeg with command: %s" % ' '.join(cmd))
+        # In its own process group like FFMpeg._spawn, so a preempted ffmpeg is suspended as a whole
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        job.pid = proc.pid
+        if resources:
+            resources.apply(proc.pid)
+        if watchdog:
+            watchdog.start()
+        if preemptor:
+            preemptor.attach(proc.pid)
+
+        output = []
+        buf = ''
+        monitor = OutputMonitor()
+        while True:
+            if self.stopped():
+                await self.terminate(proc, preemptor)
+                raise FFMpegConvertError('Conversion stopped', ' '.join(cmd), ''.join(output), pid=proc.pid)
+            try:
+                chunk = await asyncio.wait_for(proc.stderr.read(4096), 0.25 if preemptor else 1.0)
+            except asyncio.TimeoutError:
+                chunk = None
+
+            if preemptor:
+                job.suspended = preemptor.poll()
+                paused = preemptor.elapsed()
+                if paused:
+                    # Suspended time is left out of the job's progress rate and the watchdog's window
+                    job.converting += paused
+                    monitor.shift(paused)
+                    if watchdog:
+                        watchdog.shift(paused)
+
+            if watchdog and not job.suspended:
+                stalled = watchdog.check()
+                if stalled:
+                    await self.terminate(proc, preemptor)
+                    raise FFMpegStallError('Stalled conversion', ' '.join(cmd), ''.join(output), stalled, pid=proc.pid, stats=watchdog.last)
+
+            if chunk is None:
+                continue
+            if not chunk:
+                break
+
+            text = chunk.decode(console_encoding, errors='ignore')
+            output.append(text)
+            if monitor.timestamps(text):
+                await self.terminate(proc, preemptor)
+                raise FFMpegTimestampError('Non-monotonous DTS', ' '.join(cmd), ''.join(output), pid=proc.pid)
+            lines = re.split(r'[\r\n]', buf + text)
+            buf = lines.pop()
+            for line in lines:
+                progress = parse_progress(line)
+                if progress['time'] is None and progress['frame'] is None:
+                    continue
+                if monitor.stuck(progress):
+                    await self.terminate(proc, preemptor)
+                    raise FFMpegConvertError('Forcing ffmpeg to close due to taking more than 10 minutes to render a single frame. Source file may be corrupt.', ' '.join(cmd), ''.join(output), pid=proc.pid)
+                job.update(progress, duration, index, passes)
+                if watchdog:
+                    watchdog.update(progress['time'], progress['frame'])
+
+        job.suspended = False
+        returncode = await proc.wait()
+        if returncode != 0:
+            total = ''.join(output)
+            lines = [l for l in total.split('\n') if l.strip()]
+            raise FFMpegConvertError('Encoding error', ' '.join(cmd), total, lines[-1] if lines else None, pid=proc.pid)
+
+    async def terminate(self, proc, preemptor=None):
+        if preemptor:
+            preemptor.resume()
+        try:
+            proc.terminate()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+    def view(self):
+        # Lines of the combined progress view
+        finished = [job for job in self.all if job.state in ('done', 'failed')]
+        failed = [job for job in finished if job.state == 'failed']
+        active = [job for job in self.all if job.state in ACTIVE_STATES]
+        lines = ["Jobs: %d/%d finished | %d running | %d failed | ETA: %s" % (len(finished), len(self.all), len(active), len(failed), formatEta(self.eta()))]
+        if self.controller is not None:
+            lines[0] += " | %s" % self.controller.describe()
+        if self.post is not None:
+            lines[0] += " | %s" % self.post.describe()
+        for job in active + [job for job in self.all if job.state in POST_STATES]:
+            lines.append("  %-40.40s %-10s %6.2f%% | Fps: %s | Speed: %s | PID: %s | ETA: %s" % (job.name, 'suspended' if job.suspended else job.state, job.percent, job.fps or '-', job.speed or '-', job.pid or '-', formatEta(job.remaining())))
+        return lines
+
+    def show(self, final=False):
+        lines = self.view()
+        if sys.stdout.isatty():
+            # Redraw the view in place
+            if self.shown:
+                sys.stdout.write("\033[%dF\033[J" % self.shown)
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+            self.shown = 0 if final else len(lines)
+        elif final or time.time() - self.logged >= 60:
+            self.log.info(lines[0])
+            self.logged = time.time()
+
+    async def render(self):
+        while True:
+            self.show()
+            await asyncio.sleep(1)
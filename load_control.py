@@ -0,0 +1,133 @@
+import os
+import logging
+import multiprocessing
+
+# Pressure (percentage of time some task stalled over the last 10 seconds) above which fewer jobs are run
+CPU_PRESSURE_HIGH = 60.0
+IO_PRESSURE_HIGH = 40.0
+MEMORY_PRESSURE_HIGH = 10.0
+# Pressure below which another job may be started
+CPU_PRESSURE_LOW = 20.0
+MEMORY_PRESSURE_LOW = 2.0
+# Load average per CPU above which fewer jobs are run, and below which another one may be started
+LOAD_HIGH = 1.5
+LOAD_LOW = 0.8
+# Copy-only remuxes allowed beyond the encode limit, they are bound by I/O rather than the CPU
+COPY_EXTRA = 2
+# Adjustments done after a throughput drop are undone and the limit is held for this many intervals
+HOLD_INTERVALS = 6
+
+
+def cpuCount():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def readLoad():
+    # One minute load average per CPU, None where the platform has none
+    try:
+        with open('/proc/loadavg', 'r') as f:
+            load = float(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        try:
+            load = os.getloadavg()[0]
+        except (AttributeError, OSError):
+            return None
+    return load / cpuCount()
+
+
+def readPressure(resource):
+    # avg10 of the 'some' line of /proc/pressure/<resource>, None without pressure stall information
+    try:
+        with open(os.path.join('/proc/pressure', resource), 'r') as f:
+            for line in f:
+                if line.startswith('some'):
+                    for field in line.split()[1:]:
+                        key, value = field.split('=')
+                        if key == 'avg10':
+                            return float(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class ConcurrencyController:
+    """Adjusts how many jobs a JobRunner runs at once from the load of the machine.
+
+    Every interval the limit of concurrent encodes moves one step: down when the load average per CPU, CPU pressure
+    or memory pressure is high, up when they are all low and the last step up did not lower the throughput (media
+    seconds converted per second) of the runner. A step up that lowered the throughput is undone and held for a
+    while. Copy-only remuxes are bound by I/O, so they get COPY_EXTRA slots of their own on top of the encodes that
+    only shrink under I/O pressure. Without any load information the limit stays at half the CPUs."""
+
+    def __init__(self, maximum=None, minimum=1, interval=10.0, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.maximum = maximum or cpuCount()
+        self.minimum = max(1, minimum)
+        self.interval = interval
+        self.encodes = self.minimum
+        self.copies = COPY_EXTRA
+        self.hold = 0
+        self.raised = None
+        self.last = None
+
+    def sample(self):
+        return {'load': readLoad(),
+                'cpu': readPressure('cpu'),
+                'io': readPressure('io'),
+                'memory': readPressure('memory')}
+
+    def update(self, throughput=None, sample=None):
+        # Adjust the limits, throughput is the media seconds converted per second since the last update
+        sample = sample or self.sample()
+        self.last = sample
+        load, cpu, io, memory = sample['load'], sample['cpu'], sample['io'], sample['memory']
+
+        if load is None and cpu is None:
+            self.encodes = max(self.minimum, min(self.maximum, cpuCount() // 2))
+            return
+
+        if io is not None and io > IO_PRESSURE_HIGH:
+            self.copies = max(0, self.copies - 1)
+        elif io is None or io < IO_PRESSURE_HIGH / 2:
+            self.copies = min(COPY_EXTRA, self.copies + 1)
+
+        # Undo a step up that made the runner slower
+        if self.raised is not None and throughput is not None and throughput < self.raised * 0.95:
+            self.setEncodes(self.encodes - 1, "throughput dropped from %.2f to %.2f" % (self.raised, throughput))
+            self.raised = None
+            self.hold = HOLD_INTERVALS
+            return
+        self.raised = None
+
+        if (load is not None and load > LOAD_HIGH) or (cpu is not None and cpu > CPU_PRESSURE_HIGH) or (memory is not None and memory > MEMORY_PRESSURE_HIGH):
+            self.setEncodes(self.encodes - 1, "load %s, cpu pressure %s, memory pressure %s" % (load, cpu, memory))
+        elif self.hold > 0:
+            self.hold -= 1
+        elif (load is None or load < LOAD_LOW) and (cpu is None or cpu < CPU_PRESSURE_LOW) and (memory is None or memory < MEMORY_PRESSURE_LOW):
+            if self.setEncodes(self.encodes + 1, "load %s, cpu pressure %s" % (load, cpu)):
+                self.raised = throughput
+
+    def setEncodes(self, encodes, reason):
+        encodes = max(self.minimum, min(self.maximum, encodes))
+        if encodes == self.encodes:
+            return False
+        self.log.info("Running up to %d encodes at once (%s)." % (encodes, reason))
+        self.encodes = encodes
+        return True
+
+    def admit(self, copy, encodes, copies):
+        """Whether a job may start while encodes encodes and copies copy-only remuxes are running. Remuxes fill the
+        free encode slots first and then their own."""
+        if not copy:
+            return encodes < self.encodes
+        return encodes + copies < self.encodes + self.copies
+
+    def describe(self):
+        return "%d encode + %d copy slots" % (self.encodes, self.copies)
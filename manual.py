@@ -13,6 +13,7 @@ import struct
 import platform
 import logging
 import multiprocessing
+import threading
 from multiprocessing import Process, Event, Pool
 from subprocess import call
 from autoSetup import autoSetup
@@ -21,10 +22,17 @@ from tvdb_mp4 import Tvdb_mp4
 from tmdb_mp4 import tmdb_mp4
 from mkvtomp4 import MkvtoMp4
 from post_processor import PostProcessor
+from identity_cache import IdentityCache
+from load_control import ConcurrencyController
+from post_pipeline import PostPipeline
 from tvdb_api import tvdb_api
 from tmdb_api import tmdb
-from extensions import tmdb_api_key
+from extensions import tmdb_api_key, valid_input_extensions
 from logging.config import fileConfig
+try:
+    from job_runner import JobRunner
+except (ImportError, SyntaxError):
+    JobRunner = None  # Concurrent jobs need asyncio
 original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
 #sys.tracebacklimit=0
 
@@ -33,6 +41,10 @@ if sys.version[0] == "3":
 
 fileConfig(os.path.join(os.path.dirname(sys.argv[0]), 'logging.ini'), defaults={'logfilename': os.path.join(os.path.dirname(sys.argv[0]), ("info-%s.log" % (platform.node()))).replace("\\", "/")})
 log = logging.getLogger("MANUAL")
+# Post-encode stage of files converted one at a time, created with the settings
+postPipeline = None
+# Held while the post workers rewrite a list file
+listLock = threading.Lock()
 logging.getLogger("subliminal").setLevel(logging.CRITICAL)
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("enzyme").setLevel(logging.WARNING)
@@ -91,6 +103,7 @@ def getinfo(fileName=None, silent=False, tag=True, tvdbid=None):
         if tagdata:
             print("Proceed using guessed identification from filename?")
             if getYesNo():
+                confirmInfo(fileName, tagdata, tvdbid)
                 return tagdata
         else:
             print("Unable to determine identity based on filename, must enter manually")
@@ -99,12 +112,14 @@ def getinfo(fileName=None, silent=False, tag=True, tvdbid=None):
             tvdbid = getValue("Enter TVDB Series ID", True)
             season = getValue("Enter Season Number", True)
             episode = getValue("Enter Episode Number", True)
+            confirmInfo(fileName, (m_type, tvdbid, season, episode))
             return m_type, tvdbid, season, episode
         elif m_type is 1:
             imdbid = getValue("Enter IMDB ID")
             return m_type, imdbid
         elif m_type is 2:
             tmdbid = getValue("Enter TMDB ID", True)
+            confirmInfo(fileName, (m_type, tmdbid))
             return m_type, tmdbid
         elif m_type is 4:
             return None
@@ -117,13 +132,20 @@ def getinfo(fileName=None, silent=False, tag=True, tvdbid=None):
             return None
 
 
+def guessFile(fileName, episode=False):
+    # Every file name is only run through guessit once per run
+    if episode:
+        return identities.guess(fileName, guessit.guess_episode_info, 'episode')
+    return identities.guess(fileName, guessit.guess_file_info)
+
+
 def guessInfo(fileName, tvdbid=None):
     if tvdbid:
-        guess = guessit.guess_episode_info(fileName)
+        guess = guessFile(fileName, True)
         return tvdbInfo(guess, tvdbid)
     if not settings.fullpathguess:
         fileName = os.path.basename(fileName)
-    guess = guessit.guess_file_info(fileName)
+    guess = guessFile(fileName)
     try:
         if guess['type'] == 'movie':
             return tmdbInfo(guess)
@@ -134,9 +156,65 @@ def guessInfo(fileName, tvdbid=None):
     except Exception as e:
         print(e)
         return None
-        
+
+
+def confirmInfo(fileName, tagdata, tvdbid=None):
+    # Store an identification the user confirmed or entered so later runs reuse it
+    if fileName is None or not tagdata:
+        return
+    try:
+        if not tvdbid and not settings.fullpathguess:
+            fileName = os.path.basename(fileName)
+        guess = guessFile(fileName, bool(tvdbid))
+        if tagdata[0] == 3 and guess.get('series'):
+            identities.set('series', guess['series'], guess.get('year'), int(tagdata[1]), identities.name('series', tagdata[1]), confirmed=True)
+        elif tagdata[0] == 2 and guess.get('type') == 'movie' and guess.get('title'):
+            identities.set('movie', guess['title'], guess.get('year'), int(tagdata[1]), identities.name('movie', tagdata[1]), confirmed=True)
+    except Exception as e:
+        log.exception("Unable to store identification for %s." % fileName)
+
+
+def identifyBatch(files, tvdbid=None):
+    # Guess every file of a directory up front and resolve each distinct series or movie once, the per file lookups then hit the identification cache
+    groups = {}
+    for filepath in files:
+        if not MkvtoMp4(settings, logger=log).validSource(filepath) or MkvtoMp4(settings, logger=log).alreadyProcessed(filepath):
+            continue
+        fileName = filepath if (tvdbid or settings.fullpathguess) else os.path.basename(filepath)
+        try:
+            guess = guessFile(fileName, bool(tvdbid))
+        except Exception as e:
+            log.debug("Unable to guess %s." % filepath)
+            continue
+        if tvdbid or guess.get('type') == 'episode':
+            key = ('series', guess.get('series'), guess.get('year'))
+        elif guess.get('type') == 'movie':
+            key = ('movie', guess.get('title'), guess.get('year'))
+        else:
+            continue
+        if key[1]:
+            groups.setdefault(key, []).append(filepath)
+
+    for kind, title, year in groups:
+        members = groups[(kind, title, year)]
+        if identities.get(kind, title, year) is None:
+            log.info("Identifying %s (%d files)." % (title, len(members)))
+            try:
+                guessInfo(members[0], tvdbid)
+            except Exception as e:
+                log.debug("Unable to identify %s: %s." % (title, e))
+    log.debug("Identification cache: %d hits, %d misses." % (identities.hits, identities.misses))
+    return groups
+
 
 def tmdbInfo(guessData):
+    known = identities.get('movie', guessData["title"], guessData.get("year"))
+    if known:
+        try:
+            print("Matched movie title as: %s (TMDB ID:%s)" % ((known['name'] or guessData["title"]).encode(sys.stdout.encoding, errors='ignore'), known['id']))
+        except:
+            print("Matched movie")
+        return 2, known['id']
     tmdb.configure(tmdb_api_key)
     movies = tmdb.Movies(guessData["title"].encode('ascii', errors='ignore'), limit=4)
     for movie in movies.iter_results():
@@ -146,27 +224,54 @@ def tmdbInfo(guessData):
         # origname = origname.replace('&', 'and')
         if foundname.lower() == origname.lower():
             print("Matched movie title as: %s %s" % (movie["title"].encode(sys.stdout.encoding, errors='ignore'), movie["release_date"].encode(sys.stdout.encoding, errors='ignore')))
-            movie = tmdb.Movie(movie["id"])
-            if isinstance(movie, dict):
-                tmdbid = movie["id"]
-            else:
-                tmdbid = movie.get_id()
+            # The search result already carries the id, no need to fetch the full movie
+            tmdbid = movie["id"]
+            identities.set('movie', guessData["title"], guessData.get("year"), tmdbid, movie["title"])
             return 2, tmdbid
     return None
 
 
+def resolveSeries(series, year=None):
+    # Search TVDB for the series, with the year appended first if known. Like tvdb_api the first result wins, but only the search is downloaded
+    t = tvdb_api.Tvdb(interactive=False, cache=False, banners=False, actors=False, forceConnect=True, language='en')
+    names = [series]
+    if year:
+        names.insert(0, series + " (" + str(year) + ")")
+    for name in names:
+        try:
+            results = t.search(name)
+        except Exception as e:
+            log.debug("TVDB search for %s failed: %s." % (name, e))
+            results = []
+        if results:
+            return results[0]['id'], results[0]['seriesname']
+    raise tvdb_api.tvdb_shownotfound("Show-name search returned zero results (cannot find show on TVDB)")
+
+
 def tvdbInfo(guessData, tvdbid=None):
     series = guessData["series"]
-    if 'year' in guessData:
-        fullseries = series + " (" + str(guessData["year"]) + ")"
+    year = guessData.get("year")
     season = guessData["season"]
     episode = guessData["episodeNumber"]
-    t = tvdb_api.Tvdb(interactive=False, cache=False, banners=False, actors=False, forceConnect=True, language='en')
-    try:
-        tvdbid = str(tvdbid) if tvdbid else t[fullseries]['id']
-        series = t[int(tvdbid)]['seriesname']
-    except:
-        tvdbid = t[series]['id']
+    if tvdbid:
+        tvdbid = int(tvdbid)
+        name = identities.name('series', tvdbid)
+        if name is None:
+            try:
+                t = tvdb_api.Tvdb(interactive=False, cache=False, banners=False, actors=False, forceConnect=True, language='en')
+                name = t.getShow(tvdbid, stop_after=int(season))['seriesname']
+                identities.set('series', series, year, tvdbid, name)
+            except:
+                name = series
+        series = name
+    else:
+        known = identities.get('series', series, year)
+        if known:
+            tvdbid, series = known['id'], known['name'] or series
+        else:
+            tvdbid, name = resolveSeries(series, year)
+            identities.set('series', guessData["series"], year, tvdbid, name)
+            series = name
     try:
         print("Matched TV episode as %s (TVDB ID:%d) S%02dE%02d" % (series.encode(sys.stdout.encoding, errors='ignore'), int(tvdbid), int(season), int(episode)))
     except:
@@ -174,13 +279,10 @@ def tvdbInfo(guessData, tvdbid=None):
     return 3, tvdbid, season, episode
 
 
-def processFile(inputfile, tagdata, stop_event, relativePath=None):
-    
-    # Gather tagdata
-    if tagdata is False:
-        return  # This means the user has elected to skip the file
-    elif tagdata is None:
-        tagmp4 = None  # No tag data specified but convert the file anyway
+def getTagger(tagdata):
+    # Build the tagger for tagdata, this does all of the metadata lookups
+    if tagdata is None:
+        return None  # No tag data specified but convert the file anyway
     elif tagdata[0] is 1:
         imdbid = tagdata[1]
         tagmp4 = tmdb_mp4(imdbid, language=settings.taglanguage, logger=log)
@@ -204,33 +306,123 @@ def processFile(inputfile, tagdata, stop_event, relativePath=None):
             print("Processing %s Season %02d Episode %02d - %s" % (tagmp4.show.encode(sys.stdout.encoding, errors='ignore'), int(tagmp4.season), int(tagmp4.episode), tagmp4.title.encode(sys.stdout.encoding, errors='ignore')))
         except:
             print("Processing TV episode")
+    else:
+        return None
+    return tagmp4
+
+
+class TagLookup(threading.Thread):
+    # Gathers metadata and artwork in the background so network lookups overlap with the encode
+    def __init__(self, tagdata):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.tagdata = tagdata
+        self.tagmp4 = None
+
+    def run(self):
+        try:
+            self.tagmp4 = getTagger(self.tagdata)
+            if self.tagmp4 is not None and settings.artwork:
+                self.tagmp4.downloadArtwork(settings.thumbnail)
+        except Exception as e:
+            log.exception("Unable to gather tag information.")
+            self.tagmp4 = None
+
+    def result(self):
+        # Wait for the lookups to finish and return the tagger, or None if they failed
+        self.join()
+        return self.tagmp4
+
+
+def processFile(inputfile, tagdata, stop_event, relativePath=None, priority='backfill', done=None):
+    # done(result, error) is called once the file is finished, right away when it is not converted
+    
+    # Gather tagdata while the file converts
+    if tagdata is False:
+        if done:
+            done(None, None)
+        return  # This means the user has elected to skip the file
+    lookup = TagLookup(tagdata)
+    lookup.start()
 
     # Process
     if MkvtoMp4(settings, logger=log).validSource(inputfile):
-        converter = MkvtoMp4(settings, logger=log)
+        converter = MkvtoMp4(settings, logger=log, deferMove=True)
+        converter.priority = priority
         output = converter.process(inputfile, stop_event, True)
         if output:
-            if tagmp4 is not None:
-                try:
-                    tagmp4.setHD(output['x'], output['y'])
-                    tagmp4.writeTags(output['output'], settings.artwork, settings.thumbnail)
-                except Exception as e:
-                    print("There was an error tagging the file")
-                    print(e)
-            if settings.relocate_moov:
-                converter.QTFS(output['output'])
-            output_files = converter.replicate(output['output'], relativePath=relativePath)
-            if settings.postprocess:
-                post_processor = PostProcessor(output_files)
-                if tagdata:
-                    if tagdata[0] is 1:
-                        post_processor.setMovie(tagdata[1])
-                    elif tagdata[0] is 2:
-                        post_processor.setMovie(tagdata[1])
-                    elif tagdata[0] is 3:
-                        post_processor.setTV(tagdata[1], tagdata[2], tagdata[3])
-                post_processor.run_scripts()
-            print("Conversion Successful. File: %s" % (output))
+            # Tagged, moved and post processed on the post workers while the next file converts
+            postPipeline.submit(os.path.basename(inputfile), finishFile, (converter, output, tagdata, lookup, relativePath), done)
+            return
+    if done:
+        done(None, None)
+
+
+def removeListed(path, content, entry, error=None):
+    # Drop a finished file from a list file, from the post workers once its output is delivered
+    if error is not None:
+        return
+    with listLock:
+        print("removing %s from file..list length before: %s" % (entry, len(content)))
+        content.remove(entry)
+        print("list length after: %s" % (len(content)))
+
+        data = open(path, "w")
+        for c in content:
+               data.write("%s\n" % (c))
+        data.close()
+
+
+def finishFile(converter, output, tagdata, lookup, relativePath=None):
+    # Tag, optimize, copy/move and post process a converted file
+    tagmp4 = lookup.result()
+    if tagmp4 is not None:
+        try:
+            tagmp4.setHD(output['x'], output['y'])
+            tagmp4.writeTags(output['output'], settings.artwork, settings.thumbnail, profile=settings.profile_hash)
+        except Exception as e:
+            print("There was an error tagging the file")
+            print(e)
+    if settings.relocate_moov:
+        converter.QTFS(output['output'])
+    output_files = converter.replicate(output['output'], relativePath=relativePath)
+    if settings.postprocess:
+        post_processor = PostProcessor(output_files)
+        if tagdata:
+            if tagdata[0] is 1:
+                post_processor.setMovie(tagdata[1])
+            elif tagdata[0] is 2:
+                post_processor.setMovie(tagdata[1])
+            elif tagdata[0] is 3:
+                post_processor.setTV(tagdata[1], tagdata[2], tagdata[3])
+        post_processor.run_scripts()
+    print("Conversion Successful. File: %s" % (output))
+
+
+def beginJob(converter, job):
+    # Gather the tag data of a concurrent job while it converts, finishFile moves the output once it is tagged
+    job.context = TagLookup(job.tagdata)
+    job.context.start()
+
+
+def finishJob(converter, output, job):
+    finishFile(converter, output, job.tagdata, job.context, job.relativePath)
+
+
+def newRunner(jobs, stop_event, order=None, priority=None):
+    # Runner converting up to jobs files at once (as many as the load allows with 'auto'), None when files are processed one at a time in the order found
+    controller = None
+    if jobs == 'auto':
+        jobs = 1
+        controller = ConcurrencyController(logger=log)
+    else:
+        jobs = int(jobs or 1)
+    if jobs < 2 and not order and controller is None:
+        return None
+    if JobRunner is None:
+        log.warning("Concurrent and ordered jobs need Python 3, processing files one at a time.")
+        return None
+    return JobRunner(settings, jobs, begin=beginJob, finish=finishJob, stop_event=stop_event, order=order or 'sjf', priority=priority or 'backfill', controller=controller, deferMove=True, logger=log)
      
      
 def getFileInfo(inputfile, stop_event):
@@ -261,7 +453,7 @@ def getFileInfo(inputfile, stop_event):
                 
                 filepath = os.path.join(r, file)
                 try:
-                    if MkvtoMp4(settings, logger=log).validSource(filepath):
+                    if MkvtoMp4(settings, logger=log).validSource(filepath) and not MkvtoMp4(settings, logger=log).alreadyProcessed(filepath):
 
                         reason = MkvtoMp4(settings, logger=log).needConversion(filepath)
                         if reason:
@@ -284,7 +476,7 @@ def getFileInfo(inputfile, stop_event):
         log.info("Total amount of files that need converting: %s\nFiles logged in filesToConvert.log\n" % (len(b)))
         
     elif (os.path.isfile(inputfile) and MkvtoMp4(settings, logger=log).validSource(inputfile)):
-        if MkvtoMp4(settings, logger=log).validSource(inputfile):
+        if MkvtoMp4(settings, logger=log).validSource(inputfile) and not MkvtoMp4(settings, logger=log).alreadyProcessed(inputfile):
 
             reason = MkvtoMp4(settings, logger=log).needConversion(inputfile, True)
             if reason:
@@ -297,7 +489,7 @@ def getFileInfo(inputfile, stop_event):
             print("File is not in the correct format")
 
             
-def walkDir(dir, stop_event, silent=False, preserveRelative=False, tvdbid=None, tag=True):
+def walkDir(dir, stop_event, silent=False, preserveRelative=False, tvdbid=None, tag=True, runner=None, priority='backfill'):
     biggest_file_size = 0
     biggest_file_name = ""
     m2ts_file = False
@@ -311,6 +503,13 @@ def walkDir(dir, stop_event, silent=False, preserveRelative=False, tvdbid=None,
                     biggest_file_size = size
                     biggest_file_name = filepath
 
+        if tag and not m2ts_file:
+            identifyBatch([os.path.join(r, file) for file in f], tvdbid)
+
+        # Download the subtitles of the whole directory in the background while the first files convert
+        if settings.downloadsubs and not m2ts_file:
+            MkvtoMp4(settings, logger=log).prefetchSubtitles([os.path.join(r, file) for file in f if os.path.splitext(file)[1][1:].lower() in valid_input_extensions])
+
         for file in f:
             if stop_event.is_set():
                 break;
@@ -321,7 +520,7 @@ def walkDir(dir, stop_event, silent=False, preserveRelative=False, tvdbid=None,
                 filepath = biggest_file_name
             relative = os.path.split(os.path.relpath(filepath, dir))[0] if preserveRelative else None
             try:
-                if MkvtoMp4(settings, logger=log).validSource(filepath):
+                if MkvtoMp4(settings, logger=log).validSource(filepath) and not MkvtoMp4(settings, logger=log).alreadyProcessed(filepath):
                     try:
                         print("Processing file %s" % (filepath.encode(sys.stdout.encoding, errors='ignore')))
                     except:
@@ -333,7 +532,12 @@ def walkDir(dir, stop_event, silent=False, preserveRelative=False, tvdbid=None,
                         tagdata = getinfo(filepath, silent, tvdbid=tvdbid)
                     else:
                         tagdata = None
-                    processFile(filepath, tagdata, stop_event, relativePath=relative)
+                    if runner is not None and not m2ts_file:
+                        # Queued jobs run together once the walk is done
+                        if tagdata is not False:
+                            runner.add(filepath, tagdata, relative)
+                        continue
+                    processFile(filepath, tagdata, stop_event, relativePath=relative, priority=priority)
                     if m2ts_file == True:
                         filelist = [ f_r for f_r in os.listdir(dir_name) if f_r.endswith(".m2ts") ]
                         for f_r in filelist:
@@ -366,8 +570,11 @@ def checkForSpot(maxproc, printlog=True):
 
 def main_functions(stop_event):
     try:
-        global settings
+        global settings, identities, postPipeline
         settings = ReadSettings(os.path.dirname(sys.argv[0]), "autoProcess.ini", logger=log)
+        identities = IdentityCache(logger=log)
+        # Files converted one at a time wait for a post worker once twice as many are queued
+        postPipeline = PostPipeline(settings.post_workers, limit=settings.post_workers * 2, logger=log)
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         
         parser = argparse.ArgumentParser(description="Manual conversion and tagging script for sickbeard_mp4_automator")
@@ -388,9 +595,12 @@ def main_functions(stop_event):
         parser.add_argument('-np', '--nopost', action="store_true", help="Overrides and disables the execution of additional post processing scripts")
         parser.add_argument('-pr', '--preserveRelative', action='store_true', help="Preserves relative directories when processing multiple files using the copy-to or move-to functionality")
         parser.add_argument('-cmp4', '--convertmp4', action='store_true', help="Overrides convert-mp4 setting in autoProcess.ini enabling the reprocessing of mp4 files")
-        parser.add_argument('-mp', '--maxproc', help="Specify the max amount of concurrent scripts can happen. Passmark score of your CPU / 2000 is a good baseline.")
+        parser.add_argument('-mp', '--maxproc', help="Specify the max amount of concurrent scripts can happen. Prefer --jobs auto, which runs as many conversions from one script as the load of the machine allows.")
         parser.add_argument('-m', '--moveto', help="Override move-to value setting in autoProcess.ini changing the final destination of the file")
         parser.add_argument('-fc', '--forceConvert', action='store_true', help="Override video copying and force encoding, useful for files that have timescale issues.") 
+        parser.add_argument('-j', '--jobs', help="Number of files to convert at once from this process, sharing its settings and caches, or auto to follow the load of the machine. Default is 1")
+        parser.add_argument('-qo', '--order', choices=['sjf', 'fifo'], help="Order of a batch, sjf converts the files estimated to be the quickest first from the history of finished jobs. Default is sjf when --jobs is used")
+        parser.add_argument('-pc', '--priority', choices=['hook', 'interactive', 'backfill'], help="Priority and resource class of the files of this run. Default is interactive for a single file and backfill for a batch")
 
         args = vars(parser.parse_args())
 
@@ -463,8 +673,11 @@ def main_functions(stop_event):
             getFileInfo(path, stop_event)
         else:
             tvdbid = int(args['tvdbid']) if args['tvdbid'] else None
+            runner = newRunner(args['jobs'], stop_event, args['order'], args['priority'])
             if os.path.isdir(path):
-                walkDir(path, stop_event, silent, tvdbid=tvdbid, preserveRelative=args['preserveRelative'], tag=settings.tagfile)
+                walkDir(path, stop_event, silent, tvdbid=tvdbid, preserveRelative=args['preserveRelative'], tag=settings.tagfile, runner=runner, priority=args['priority'] or 'backfill')
+                if runner is not None:
+                    runner.run()
             elif (os.path.isfile(path) and MkvtoMp4(settings, logger=log).validSource(path)):
                 if (not settings.tagfile):
                     tagdata = None
@@ -485,7 +698,7 @@ def main_functions(stop_event):
                 else:
                     tagdata = getinfo(path, silent=silent, tvdbid=tvdbid)
                 
-                processFile(path, tagdata, stop_event, None)
+                processFile(path, tagdata, stop_event, None, args['priority'] or 'interactive')
             elif (os.path.isfile(path)):
                 try:
                     with open(path) as f:
@@ -523,18 +736,27 @@ def main_functions(stop_event):
                                 else:
                                     tagdata = getinfo(currFile, silent=silent)
                                 
+                                if runner is not None:
+                                    # Queued jobs run together once the list is read, the list is rewritten afterwards
+                                    if tagdata is not False:
+                                        runner.add(currFile, tagdata)
+                                    continue
+
                                 print("PROCCESSING: %s" % (currFile))
-                                processFile(currFile, tagdata, stop_event)
+                                # Kept in the list until its output is delivered
+                                processFile(currFile, tagdata, stop_event, priority=args['priority'] or 'backfill', done=lambda result, error, entry=currFile: removeListed(path, contentCopy, entry, error))
                                 
                                 count += 1
-                                print("removing %s from file..list length before: %s" % (currFile, len(contentCopy)))
-                                contentCopy.remove(currFile)
-                                print("list length after: %s" % (len(contentCopy)))
-                                
-                                data = open(path, "w")
-                                for c in contentCopy:
-                                       data.write("%s\n" % (c))
-                                data.close()
+
+                        if runner is not None:
+                            runner.run()
+                            # Keep the files that never started, ie. when the batch was stopped, and those whose output was not delivered
+                            pending = [job.inputfile for job in runner.all if job.state == 'queued' or job.postFailed]
+                            data = open(path, "w")
+                            for c in contentCopy:
+                                if c in pending or not MkvtoMp4(settings, logger=log).validSource(c):
+                                    data.write("%s\n" % (c))
+                            data.close()
                     except Exception as e:
                         print(e)
       
@@ -550,6 +772,10 @@ def main_functions(stop_event):
             print("Manually stopping conversion...")
         else:
             raise Exception("".join(traceback.format_exception(*sys.exc_info())))
+    finally:
+        # Wait for the files still being tagged and moved
+        if postPipeline is not None:
+            postPipeline.close()
     
     #print("done with conversions.")
     stop_event.set()
@@ -32,7 +32,7 @@ from mutagen._util import (cdata, insert_bytes, DictProxy, MutagenError,
                            hashable, enum)
 from mutagen._compat import (reraise, PY2, string_types, text_type, chr_,
                              iteritems, PY3, cBytesIO)
-from ._atom import Atoms, Atom, AtomError
+from ._atom import Atoms, LazyAtoms, Atom, AtomError
 from ._util import parse_full_atom
 from ._as_entry import AudioSampleEntry, ASEntryError
 
@@ -289,39 +289,88 @@ class MP4Tags(DictProxy, Metadata):
 
     Unknown non-text tags and tags that failed to parse will be written
     back as is.
+
+    When loaded with lazy=True, 'covr' and any other atom larger than
+    LAZY_ATOM_SIZE (except freeform atoms, whose key is part of the
+    payload) are only read from the file and decoded the first time
+    they are accessed.
     """
 
+    LAZY_ATOM_SIZE = 2 ** 16
+
     def __init__(self, *args, **kwargs):
         self._failed_atoms = {}
+        self._lazy_atoms = {}
+        self._lazy_filename = None
         super(MP4Tags, self).__init__(*args, **kwargs)
 
-    def load(self, atoms, fileobj):
+    def load(self, atoms, fileobj, lazy=False):
         try:
             ilst = atoms[b"moov.udta.meta.ilst"]
         except KeyError as key:
             raise MP4MetadataError(key)
+        filename = getattr(fileobj, "name", None) if lazy else None
         for atom in ilst.children:
+            if filename is not None and atom.name != b"----" and (
+                    atom.name == b"covr" or atom.length > self.LAZY_ATOM_SIZE):
+                self._lazy_filename = filename
+                key = _name2key(atom.name)
+                self._lazy_atoms.setdefault(key, []).append(atom)
+                continue
             ok, data = atom.read(fileobj)
             if not ok:
                 raise MP4MetadataError("Not enough data")
+            self.__parse_atom(atom, data)
 
-            try:
-                if atom.name in self.__atoms:
-                    info = self.__atoms[atom.name]
-                    info[0](self, atom, data)
-                else:
-                    # unknown atom, try as text
-                    self.__parse_text(atom, data, implicit=False)
-            except MP4MetadataError:
-                # parsing failed, save them so we can write them back
-                key = _name2key(atom.name)
-                self._failed_atoms.setdefault(key, []).append(data)
+    def __parse_atom(self, atom, data):
+        try:
+            if atom.name in self.__atoms:
+                info = self.__atoms[atom.name]
+                info[0](self, atom, data)
+            else:
+                # unknown atom, try as text
+                self.__parse_text(atom, data, implicit=False)
+        except MP4MetadataError:
+            # parsing failed, save them so we can write them back
+            key = _name2key(atom.name)
+            self._failed_atoms.setdefault(key, []).append(data)
+
+    def __load_lazy(self, key):
+        """Read and decode atoms deferred by a lazy load."""
+
+        atoms = self._lazy_atoms.pop(key)
+        with open(self._lazy_filename, "rb") as fileobj:
+            for atom in atoms:
+                ok, data = atom.read(fileobj)
+                if not ok:
+                    raise MP4MetadataError("Not enough data")
+                self.__parse_atom(atom, data)
+
+    def __getitem__(self, key):
+        if key in self._lazy_atoms:
+            self.__load_lazy(key)
+        return super(MP4Tags, self).__getitem__(key)
 
     def __setitem__(self, key, value):
         if not isinstance(key, str):
             raise TypeError("key has to be str")
+        self._lazy_atoms.pop(key, None)
         super(MP4Tags, self).__setitem__(key, value)
 
+    def __delitem__(self, key):
+        if self._lazy_atoms.pop(key, None) is not None:
+            if key not in super(MP4Tags, self).keys():
+                return
+        super(MP4Tags, self).__delitem__(key)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def keys(self):
+        keys = list(super(MP4Tags, self).keys())
+        keys.extend(k for k in self._lazy_atoms if k not in keys)
+        return keys
+
     @classmethod
     def _can_load(cls, atoms):
         return b"moov.udta.meta.ilst" in atoms
@@ -955,11 +1004,21 @@ class MP4(FileType):
 
     _mimes = ["audio/mp4", "audio/x-m4a", "audio/mpeg4", "audio/aac"]
 
-    def load(self, filename):
+    def load(self, filename, lazy=False):
+        """Load stream information and tags from filename.
+
+        With lazy=True only the top-level atom headers are scanned and
+        moov is parsed on demand, so media data is never walked. Cover
+        art and other large tag atoms are decoded when first accessed.
+        """
+
         self.filename = filename
         with open(filename, "rb") as fileobj:
             try:
-                atoms = Atoms(fileobj)
+                if lazy:
+                    atoms = LazyAtoms(fileobj)
+                else:
+                    atoms = Atoms(fileobj)
             except AtomError as err:
                 reraise(error, err, sys.exc_info()[2])
 
@@ -974,12 +1033,16 @@ class MP4(FileType):
                 self.tags = None
             else:
                 try:
-                    self.tags = self.MP4Tags(atoms, fileobj)
+                    self.tags = self.MP4Tags(atoms, fileobj, lazy=lazy)
                 except error:
                     raise
                 except Exception as err:
                     reraise(MP4MetadataError, err, sys.exc_info()[2])
 
+    def __contains__(self, key):
+        # Avoid decoding lazily loaded atoms just to test for a key
+        return self.tags is not None and key in self.tags
+
     def add_tags(self):
         if self.tags is None:
             self.tags = self.MP4Tags()
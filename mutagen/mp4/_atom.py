@@ -35,8 +35,12 @@ class Atom(object):
 
     children = None
 
-    def __init__(self, fileobj, level=0):
-        """May raise AtomError"""
+    def __init__(self, fileobj, level=0, recurse=True):
+        """May raise AtomError
+
+        If recurse is False only the header is read and the file
+        position is moved past the atom, children stay None.
+        """
 
         self.offset = fileobj.tell()
         try:
@@ -66,7 +70,7 @@ class Atom(object):
             raise AtomError(
                 "atom length can only be 0, 1 or 8 and higher")
 
-        if self.name in _CONTAINERS:
+        if self.name in _CONTAINERS and recurse:
             self.children = []
             fileobj.seek(_SKIP_SIZE.get(self.name, 0), 1)
             while fileobj.tell() < self.offset + self.length:
@@ -188,3 +192,45 @@ class Atoms(object):
 
     def __repr__(self):
         return "\n".join([repr(child) for child in self.atoms])
+
+
+class LazyAtoms(Atoms):
+    """Root atoms in a given file, expanded on demand.
+
+    Only the top-level atom headers are read when constructed, so large
+    atoms like mdat are seeked over instead of being walked. Container
+    atoms (usually just moov) are parsed the first time they are looked
+    up. The passed fileobj has to stay open while lookups are made.
+
+    This structure should only be used internally by Mutagen.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.atoms = []
+        fileobj.seek(0, 2)
+        end = fileobj.tell()
+        fileobj.seek(0)
+        while fileobj.tell() + 8 <= end:
+            self.atoms.append(Atom(fileobj, recurse=False))
+
+    def _expand(self, index):
+        atom = self.atoms[index]
+        if atom.children is None and atom.name in _CONTAINERS:
+            self._fileobj.seek(atom.offset)
+            atom = self.atoms[index] = Atom(self._fileobj)
+        return atom
+
+    def __getitem__(self, names):
+        if PY2:
+            if isinstance(names, basestring):
+                names = names.split(b".")
+        else:
+            if isinstance(names, bytes):
+                names = names.split(b".")
+
+        for index, child in enumerate(self.atoms):
+            if child.name == names[0]:
+                return self._expand(index)[names[1:]]
+        else:
+            raise KeyError("%r not found" % names[0])
@@ -0,0 +1,622 @@
+import os
+import copy
+import logging
+import datetime
+from babelfish import Language
+from extensions import bad_subtitle_codecs
+from converter.capabilities import Capabilities
+
+
+# Break apart a file path into the directory, filename, and extension
+def parseFile(path):
+    path = os.path.abspath(path)
+    input_dir, filename = os.path.split(path)
+    filename, input_extension = os.path.splitext(filename)
+    input_extension = input_extension[1:]
+    return input_dir, filename, input_extension
+
+
+# Estimate the video bitrate
+def estimateVideoBitrate(info, log):
+    total_bitrate = info.format.bitrate
+    audio_bitrate = 0
+    for a in info.audio:
+        audio_bitrate += a.bitrate
+
+    log.debug("Total bitrate is %s." % info.format.bitrate)
+    log.debug("Total audio bitrate is %s." % audio_bitrate)
+    log.debug("Estimated video bitrate is %s." % (total_bitrate - audio_bitrate))
+    return ((total_bitrate - audio_bitrate) / 1000) * .95
+
+
+# Value of a resolution table for a video width, falling back to the plain setting
+def pickRate(profile, table, attribute, width):
+    value = profile.rate(table, width)
+    return getattr(profile, attribute) if value is None else value
+
+
+# Return codec if the ffmpeg binary can encode it, otherwise the first configured alternative it can encode
+def supportedCodec(capabilities, codec, choices, kind, log):
+    if capabilities.supports(codec):
+        return codec
+    for alternative in choices:
+        if alternative != 'copy' and capabilities.supports(alternative):
+            log.warning("%s has no encoder for %s codec %s, using %s instead." % (capabilities.version, kind, codec, alternative))
+            return alternative
+    log.error("%s cannot encode any of the configured %s codecs %s." % (capabilities.version, kind, ', '.join(choices)))
+    return None
+
+
+# Preset of a conversion, a preset in postopts overrides the one of the codec
+def optionsPreset(options):
+    postopts = options.get('postopts') or []
+    if '-preset' in postopts[:-1]:
+        return postopts[postopts.index('-preset') + 1]
+    video = options.get('video') or {}
+    return video.get('preset') or video.get('nvenc_preset')
+
+
+# Copy of options encoding with preset, set in postopts so it also overrides presets given there
+def withPreset(options, preset):
+    options = copy.deepcopy(options)
+    postopts = list(options.get('postopts') or [])
+    if '-preset' in postopts[:-1]:
+        postopts[postopts.index('-preset') + 1] = preset
+    else:
+        postopts.extend(['-preset', preset])
+    options['postopts'] = postopts
+    return options
+
+
+def planOptions(profile, info, inputfile, capabilities=None, external_subtitles=(), logger=None):
+    """Plan the ffmpeg options for one file from a SettingsProfile and its probed MediaInfo.
+
+    Nothing is read from disk and neither the profile nor info is modified, so one profile can plan many files
+    concurrently and the same inputs always give the same plan. External subtitle files are passed in as
+    SubtitleCandidates. Returns a dict with the converter 'options', the internal subtitle streams to 'rips' into
+    external files and the external subtitle files to delete after conversion ('deletesubs'), or None if the file
+    cannot be converted with this ffmpeg."""
+    log = logger or logging.getLogger(__name__)
+    capabilities = capabilities or Capabilities()
+
+    # Stream metadata is normalised while planning, work on a copy so the caller's MediaInfo is untouched
+    info = copy.deepcopy(info)
+
+    input_dir, filename, input_extension = parseFile(inputfile)
+    drive_letter, directory = os.path.splitdrive( input_dir )
+    drive_letter_no_colon = drive_letter.replace( ":", "" )
+    directory = directory.replace("\\", "\\\\");
+
+    # Settings that are adjusted for this file only
+    awl = profile.awl
+    iOS = profile.iOS
+    audio_copyoriginal = profile.audio_copyoriginal
+    sample_rate = profile.sample_rate
+    nvenc_decoder_gpu = profile.nvenc_decoder_gpu
+    nvenc_decoder_hevc_gpu = profile.nvenc_decoder_hevc_gpu
+    rips = []
+    deletesubs = []
+
+    try:
+        vbr = estimateVideoBitrate(info, log)
+    except:
+        vbr = info.format.bitrate / 1000
+
+    # Pick the rates for this resolution from the precompiled tables
+    video_bitrate = pickRate(profile, 'video_bitrate_restriction', 'video_bitrate', info.video.video_width)
+    minrate = pickRate(profile, 'minrate', 'minrate', info.video.video_width)
+    maxrate = pickRate(profile, 'maxrate', 'maxrate', info.video.video_width)
+    bufsize = pickRate(profile, 'bufsize', 'bufsize', info.video.video_width)
+
+    log.debug("Force convert is %s." % profile.forceConvert)
+    if info.video.codec.lower() in profile.video_codec and profile.forceConvert is False:
+        log.debug("Setting video codec to copy.")
+        vcodec = 'copy'
+    else:
+        vcodec = profile.video_codec[0]
+    vbitrate = video_bitrate if video_bitrate else vbr
+
+    log.info("Pix Fmt: %s." % info.video.pix_fmt)
+    if profile.pix_fmt and info.video.pix_fmt.lower() not in profile.pix_fmt:
+        log.debug("Overriding video pix_fmt. Codec cannot be copied because pix_fmt is not approved.")
+        vcodec = profile.video_codec[0]
+        pix_fmt = profile.pix_fmt[0]
+        if profile.video_profile:
+            vprofile = profile.video_profile[0]
+    else:
+        pix_fmt = None
+    
+    #print("vbr type %s profile.video type %s" % (type(vbr), type(video_bitrate)))
+    if video_bitrate is not None and vbr > int(video_bitrate):
+        log.debug("Overriding video bitrate. Codec cannot be copied because video bitrate is too high.")
+        vcodec = profile.video_codec[0]
+        vbitrate = video_bitrate
+
+    if profile.video_width is not None and profile.video_width < info.video.video_width:
+        log.debug("Video width is over the max width, it will be downsampled. Video stream can no longer be copied.")
+        vcodec = profile.video_codec[0]
+        vwidth = profile.video_width
+    else:
+        vwidth = None
+
+    if '264' in info.video.codec.lower() and profile.h264_level and info.video.video_level and (info.video.video_level / 10 > profile.h264_level):
+        log.info("Video level %0.1f." % (info.video.video_level / 10))
+        vcodec = profile.video_codec[0]
+
+    log.debug("Video codec: %s." % vcodec)
+    log.debug("Video bitrate: %s." % vbitrate)
+
+    log.info("Profile: %s." % info.video.profile)
+    if profile.video_profile and info.video.profile.lower().replace(" ", "") not in profile.video_profile:
+        log.debug("Video profile is not supported. Video stream can no longer be copied.")
+        vcodec = profile.video_codec[0]
+        vprofile = profile.video_profile[0]
+        if profile.pix_fmt:
+            pix_fmt = profile.pix_fmt[0]
+    else:
+        vprofile = None
+
+    # Validate the codec up front rather than failing mid-encode
+    vcodec = supportedCodec(capabilities, vcodec, profile.video_codec, 'video', log)
+    if vcodec is None:
+        return None
+
+    if vcodec == 'nvenc_h264' and pix_fmt == 'yuv420': #yuv420 + nvenc has aliasing that is annoying once it is pointed out, nv12 does not and supports the same colors.
+        pix_fmt = 'nv12'
+
+    # Audio streams
+    log.info("Reading audio streams.")
+
+    overrideLang = True
+    num_desired_language_audio_streams = 0
+    for a in info.audio:
+        try:
+            if a.metadata['language'].strip() == "" or a.metadata['language'] is None:
+                a.metadata['language'] = 'und'
+        except KeyError:
+            a.metadata['language'] = 'und'
+        if (a.metadata['language'] == 'und' and profile.adl) or (awl and a.metadata['language'].lower() in awl):
+            overrideLang = False
+            num_desired_language_audio_streams +=1
+
+    if overrideLang:
+        awl = None
+        log.info("No audio streams detected in any appropriate language, relaxing restrictions so there will be some audio stream present.")
+
+    audio_settings = {}
+    l = 0
+    for a in info.audio:
+        try:
+            if a.metadata['language'].strip() == "" or a.metadata['language'] is None:
+                a.metadata['language'] = 'und'
+        except KeyError:
+            a.metadata['language'] = 'und'
+
+        log.info("Audio detected for stream #%s: %s [%s]." % (a.index, a.codec, a.metadata['language']))
+
+        if profile.output_extension == 'mp4':
+            if a.codec.lower() == 'truehd': # Need to skip it early so that it flags the next track as default.
+                if num_desired_language_audio_streams < 2 or overrideLang == True:
+                    log.info( "MP4 does not support truehd audio, as this is the only audio track in the desired language we will attempt to convert it, but be warned that there may be audio syncing issues.")
+                    audio_copyoriginal = False #Need to disable copying this or it will just fail anyway.
+                else: 
+                    log.info( "MP4 containers do not support truehd audio, and converting it is inconsistent due to video/audio sync issues. Skipping stream %s as typically the 2nd audio track is the AC3 core of the truehd stream." % a.index )
+                    continue
+            if a.codec.startswith( 'pcm' ): #pcm formats also cannot be container in a .mp4 file
+                audio_copyoriginal = False
+
+        # Set undefined language to default language if specified
+        if profile.adl is not None and a.metadata['language'] == 'und':
+            log.debug("Undefined language detected, defaulting to [%s]." % profile.adl)
+            a.metadata['language'] = profile.adl
+
+        if sample_rate is None:
+            try:
+                sample_rate = a.audio_samplerate
+            except:
+                sample_rate = 48000
+
+        # Proceed if no whitelist is set, or if the language is in the whitelist
+        iosdata = None
+        if awl is None or a.metadata['language'].lower() in awl:
+            # Create iOS friendly audio stream if the default audio stream has too many channels (iOS only likes AAC stereo)
+            if iOS and a.audio_channels > 2:
+                iOSbitrate = 256 if (profile.audio_bitrate * 2) > 384 else (profile.audio_bitrate * 2)
+                log.info("Creating audio stream %s from source audio stream %s [iOS-audio]." % (str(l), a.index))
+                log.debug("Audio codec: %s." % iOS[0])
+                log.debug("Channels: 2.")
+                log.debug("Filter: %s." % profile.iOS_filter)
+                log.debug("Bitrate: %s." % iOSbitrate)
+                log.debug("Language: %s." % a.metadata['language'])
+                if l == 0:
+                    disposition = 'default'
+                    log.info("Audio track is number %s setting disposition to %s" % (str(l), disposition))
+                else:
+                    disposition = 'none'
+                    log.info("Audio track is number %s setting disposition to %s" % (str(l), disposition))
+                iosdata = {
+                    'map': a.index,
+                    'codec': iOS[0],
+                    'channels': 2,
+                    'bitrate': iOSbitrate,
+                    'samplerate': sample_rate,
+                    'filter': profile.iOS_filter,
+                    'language': a.metadata['language'],
+                    'disposition': disposition,
+                    }
+                if not profile.iOSLast:
+                    audio_settings.update({l: iosdata})
+                    l += 1
+            # If the iOS audio option is enabled and the source audio channel is only stereo, the additional iOS channel will be skipped and a single AAC 2.0 channel will be made regardless of codec preference to avoid multiple stereo channels
+            log.info("Creating audio stream %s from source stream %s." % (str(l), a.index))
+            if iOS and a.audio_channels <= 2:
+                log.debug("Overriding default channel settings because iOS audio is enabled but the source is stereo [iOS-audio].")
+                acodec = 'copy' if a.codec in iOS else iOS[0]
+                audio_channels = a.audio_channels
+                afilter = profile.iOS_filter
+                abitrate = a.audio_channels * 128 if (a.audio_channels * profile.audio_bitrate) > (a.audio_channels * 128) else (a.audio_channels * profile.audio_bitrate)
+            else:
+                # If desired codec is the same as the source codec, copy to avoid quality loss
+                acodec = 'copy' if a.codec.lower() in profile.audio_codec else profile.audio_codec[0]
+                # Audio channel adjustments
+                if ( profile.maxchannels and a.audio_channels > profile.maxchannels ):
+                    audio_channels = profile.maxchannels
+                    if acodec == 'copy':
+                        acodec = profile.audio_codec[0]
+                        if acodec == 'copy': # Some people put 'copy' as the first audio codec.
+                            acodec = 'aac'
+                    abitrate = profile.maxchannels * profile.audio_bitrate
+                else:
+                    audio_channels = a.audio_channels
+                    abitrate = a.audio_channels * profile.audio_bitrate
+                # Bitrate calculations/overrides
+                if profile.audio_bitrate == 0:
+                    log.debug("Attempting to set bitrate based on source stream bitrate.")
+                    try:
+                        abitrate = a.bitrate / 1000
+                    except:
+                        log.warning("Unable to determine audio bitrate from source stream %s, defaulting to 256 per channel." % a.index)
+                        abitrate = a.audio_channels * 256
+                afilter = profile.audio_filter
+
+            acodec = supportedCodec(capabilities, acodec, list(profile.audio_codec) + ['aac'], 'audio', log)
+            if acodec is None:
+                return None
+
+            log.debug("Audio codec: %s." % acodec)
+            log.debug("Channels: %s." % audio_channels)
+            log.debug("Bitrate: %s." % abitrate)
+            log.debug("Language: %s" % a.metadata['language'])
+            log.debug("Filter: %s" % afilter)
+
+            # If the iOSFirst option is enabled, disable the iOS option after the first audio stream is processed
+            if iOS and profile.iOSFirst:
+                log.debug("Not creating any additional iOS audio streams.")
+                iOS = False
+
+            # Set first track as default disposition
+            if l == 0:
+                disposition = 'default'
+                log.info("Audio Track is number %s setting disposition to %s" % (a.index, disposition))
+            else:
+                disposition = 'none'
+                log.info("Audio Track is number %s setting disposition to %s" % (a.index, disposition))
+
+            audio_settings.update({l: {
+                'map': a.index,
+                'codec': acodec,
+                'channels': audio_channels,
+                'bitrate': abitrate,
+                'filter': afilter,
+                'samplerate': sample_rate,
+                'language': a.metadata['language'],
+                'disposition': disposition,
+            }})
+
+            if acodec == 'copy' and a.codec == 'aac' and profile.aac_adtstoasc:
+                audio_settings[l]['bsf'] = 'aac_adtstoasc'
+            if profile.output_extension == 'mp4':
+                if a.codec.lower() == 'flac' and acodec == 'copy': #flac in mp4 is experimental, ffmpeg requires adding strict -2 to do it.
+                    audio_settings[l]['strict'] = '-2'
+            l += 1
+
+            #Add the iOS track last instead
+            if profile.iOSLast and iosdata:
+                iosdata['disposition'] = 'none'
+                audio_settings.update({l: iosdata})
+                l += 1
+
+            if audio_copyoriginal and acodec != 'copy' and profile.forceConvert == False:
+                log.info("Adding copy of original audio track in format %s" % a.codec)
+                audio_settings.update({l: {
+                    'map': a.index,
+                    'codec': 'copy',
+                    'language': a.metadata['language'],
+                    'disposition': 'none',
+                }})
+                if a.codec == 'flac' and profile.output_extension == 'mp4': #flac in mp4 is experimental, ffmpeg requires adding strict -2 to do it.
+                    audio_settings[l]['strict'] = '-2'
+
+    # Subtitle streams
+    subtitle_settings = {}
+    l = 0
+    log.info("Reading subtitle streams.")
+    forced_sub = 0 # This is the index of the subtitle stream in the entire file, overlay uses this index
+    guessed_forced_sub = 0
+    guessed_subtitle_number  = -1
+    overlay_stream = ""
+    subtitle_will_be_burned_in = False
+    subtitle_number = -1 # Subtitle_used is the index of the subtitle stream compared to only other subtitles. -vf to overlay uses this.
+    subtitle_used = subtitle_number
+    shortest_duration_subtitle_stream = 86400 # There probably aren't too many movies that are 24 hours long.
+    longest_duration_subtitle_stream = 1
+    desired_language_streams = 0
+    for s in info.subtitle:
+        subtitle_number += 1
+        try:
+            if s.metadata['language'].strip() == "" or s.metadata['language'] is None:
+                s.metadata['language'] = 'und'
+        except KeyError:
+            s.metadata['language'] = 'und'
+        log.info("Subtitle detected for stream #%s: %s [%s]." % (s.index, s.codec, s.metadata['language']))
+        # Set undefined language to default language if specified
+        if profile.sdl is not None and s.metadata['language'] == 'und':
+            log.debug("Undefined language detected, defaulting to [%s]." % profile.sdl)
+            s.metadata['language'] = profile.sdl
+        if s.metadata['language'].lower() not in profile.swl:
+            continue
+        desired_language_streams += 1
+        if s.sub_forced == 2 and s.sub_default == 1: ## Prefer subs that are flagged forced AND default by their disposition
+            forced_sub = s.index
+            subtitle_used = subtitle_number
+            break
+        elif s.sub_forced == 2: ## Prefer flagged subs next
+            forced_sub = s.index
+            subtitle_used = subtitle_number
+            break
+        elif s.sub_forced == 1: ## Go searching for forced subs that hang out in the title metadata
+            forced_sub = s.index
+            subtitle_used = subtitle_number
+            break
+        elif overrideLang == True: # If there is no audio stream in the desired language,
+            forced_sub = s.index   # burn in the first subtitle stream that matches the users language.  
+            subtitle_used = subtitle_number
+            s.sub_forced = 1
+            break
+        elif s.sub_force_guess:# Finally, throw a guess at it if there are 2 desired language subtitle streams.
+            s.sub_force_guess = s.sub_force_guess[:-3]
+            try:
+                duration = datetime.datetime.strptime(s.sub_force_guess,'%H:%M:%S.%f')
+                total_seconds = duration.second + ( duration.minute * 60 ) + ( duration.hour * 3600 )
+                if total_seconds < shortest_duration_subtitle_stream:
+                    shortest_duration_subtitle_stream = total_seconds
+                    guessed_forced_sub = s.index
+                    guessed_subtitle_number = subtitle_number
+                if total_seconds > longest_duration_subtitle_stream:
+                    longest_duration_subtitle_stream = total_seconds
+            except:
+                log.info( "Couldn't use experimental forced subtitle duration. Probably due to odd time formatting - Attempted to parse time format from %s" % s.sub_force_guess )
+
+    if forced_sub == 0 and desired_language_streams > 1 and longest_duration_subtitle_stream > 1 and \
+        ( float( shortest_duration_subtitle_stream ) / float( longest_duration_subtitle_stream ) ) < 0.75: # This is a sanity check just in case there is a video with multiple
+        forced_sub = guessed_forced_sub # native-speaking language subtitle streams and the 2nd one just happens to be a director's commentary instead of foreign language subtitles.
+        subtitle_used = guessed_subtitle_number # If the film has >75% forced subtitles then it's probably going to be flagged with overrideLang = true
+        log.info( "Used experimental forced subtitle guess" ) #Just to check when it is used. 
+
+    for s in info.subtitle:
+        if forced_sub > 0 and s.index != forced_sub and profile.burn_in_forced_subs == True:
+            continue
+        if forced_sub > 0 and profile.burn_in_forced_subs == True:
+            subtitle_will_be_burned_in = True
+            if vcodec == 'copy':
+                vcodec = profile.video_codec[0]
+        # Make sure its not an image based codec
+        if s.codec.lower() not in bad_subtitle_codecs and profile.embedsubs:
+            # Proceed if no whitelist is set, or if the language is in the whitelist
+            if profile.swl is None or s.metadata['language'].lower() in profile.swl:
+                subtitle_settings.update({l: {
+                    'map': s.index,
+                    'codec': profile.scodec[0],
+                    'language': s.metadata['language'],
+                    'encoding': profile.subencoding,
+                    'forced': s.sub_forced,
+                    'default': s.sub_default,
+                    'burn_in_forced_subs': profile.burn_in_forced_subs,
+                    'subtitle_burn': drive_letter_no_colon + r"\:" + directory + "\\\\" + filename + "." + input_extension + \
+                        ":si=" + str( subtitle_used ) + "'" #FFmpeg requires a very specific string of letters for -vf subtitles=
+                                                            #TODO: Check if this works on something other than windows- ie: escape character shenaningans.
+                }})
+                log.info("Creating subtitle stream %s from source stream %s." % (l, s.index))
+                l = l + 1
+        elif s.codec.lower() in bad_subtitle_codecs and profile.embedsubs == True and forced_sub > 0 and profile.burn_in_forced_subs == True: # This overlays forced picture subtitles on top of the video stream. Slows down conversion significantly.
+            if vwidth == None:
+                overlay_stream = "[0:v][0:%s]overlay" % ( s.index )
+            else: # The resolution has changed, we must use scale2ref to resize the picture subtitles or they'll end up in weird places.
+                overlay_stream = "[0:%s][video]scale2ref[sub][video];[video][sub]overlay" % ( s.index )
+        elif s.codec.lower() not in bad_subtitle_codecs and not profile.embedsubs:
+            if profile.swl is None or s.metadata['language'].lower() in profile.swl:
+                for codec in profile.scodec:
+                    # Ripped by the caller, the planner does no I/O
+                    rips.append({'map': s.index,
+                                 'codec': codec,
+                                 'language': s.metadata['language'],
+                                 'forced': s.sub_forced})
+
+    # External subtitle import
+    if profile.embedsubs and not profile.embedonlyinternalsubs:  # Don't bother if we're not embeddeding subtitles and external subtitles
+        src = 1  # FFMPEG input source number
+        for candidate in external_subtitles:
+            dirName, fname = os.path.split(candidate.path)
+            lang = candidate.language
+            # Using bablefish to convert a 2 language code to a 3 language code
+            if len(lang) == 2:
+                try:
+                    babel = Language.fromalpha2(lang)
+                    lang = babel.alpha3
+                except:
+                    pass
+            log.info("External %s subtitle file detected." % lang)
+            if profile.swl is None or lang in profile.swl:
+
+                log.info("Creating subtitle stream %s by importing %s." % (l, fname))
+
+                if forced_sub == 0 and profile.burn_in_forced_subs == True:
+                    subtitle_settings.update({l: {
+                        'path': os.path.join(dirName, fname),
+                        'source': src,
+                        'map': 0,
+                        'codec': 'mov_text',
+                        'language': lang,
+                        'burn_in_forced_subs': profile.burn_in_forced_subs,
+                        'subtitle_burn': os.path.join(dirName, fname)
+                        }})
+                else:
+                    subtitle_settings.update({l: {
+                        'path': os.path.join(dirName, fname),
+                        'source': src,
+                        'map': 0,
+                        'codec': 'mov_text',
+                        'language': lang}})
+                    if candidate.forced:
+                        subtitle_settings[l]['forced'] = 1
+
+                log.debug("Path: %s." % os.path.join(dirName, fname))
+                log.debug("Source: %s." % src)
+                log.debug("Codec: mov_text.")
+                log.debug("Langauge: %s." % lang)
+
+                l = l + 1
+                src = src + 1
+
+                deletesubs.append(os.path.join(dirName, fname))
+
+            else:
+                log.info("Ignoring %s external subtitle stream due to language %s." % (fname, lang))
+
+    # Collect all options
+    options = {
+        'format': profile.output_format,
+        'video': {
+            'codec': vcodec,
+            'map': info.video.index,
+            'bitrate': vbitrate,
+            'level': profile.h264_level,
+            'qmin': profile.qmin,
+            'qmax': profile.qmax,
+            'global_quality': profile.global_quality,
+            'maxrate': maxrate,
+            'minrate': minrate,
+            'bufsize': bufsize,
+            'vsync': profile.vsync,
+            'level': profile.h264_level,
+            'profile': vprofile,
+            'pix_fmt': pix_fmt
+        },
+        'audio': audio_settings,
+        'subtitle': subtitle_settings,
+        'preopts': ['-fix_sub_duration'],
+        'postopts': ['-threads', profile.threads]
+    }
+
+    # If a CRF option is set, override the determine bitrate
+    if profile.vcrf:
+        del options['video']['bitrate']
+        options['video']['crf'] = profile.vcrf
+
+    options['postopts'].extend([ '-max_muxing_queue_size', '2048' ] )  
+    # Some ffmpeg filters are in a state of internal API transition with how they handle certain magic
+    # that I don't understand, but read about and nodded about on the ffmpeg mailing list.
+    # Allowing a higher queue size fixes whatever wizardry is happening, and shouldn't be needed in a year or so. 02/11/2018
+
+    if len(overlay_stream) > 0:
+        options['preopts'].remove( '-fix_sub_duration' ) #fix_sub_duration really screws up the duration of overlaid "picture" subtitles,
+                       #as they stay on the screen for less than a second. This doesn't have any negative consequences that I've noticed.
+        if vwidth != None:
+            del options['video']['map'] #The video stream formally known as [v:(number)] is remapped to [video] in order to support scaling picture subtitles to another resolution.
+        options['video']['filter_complex'] = overlay_stream # I couldn't quite get it to work correctly without doing this. 
+
+    if profile.preopts:
+        options['preopts'].extend(profile.preopts)
+    
+    options['postopts'].extend(['-movflags', 'faststart'])
+    if profile.postopts:
+        options['postopts'].extend(profile.postopts)
+
+    options['preopts'].extend(['-vsync', profile.vsync ])
+
+    nvenc_cuvid_codecs = { "h264", "mjpeg", "mpeg1video", "mpeg2video", "mpeg4", "vc1", "vp8", "hevc", "vp9" } # mpeg1video/mpeg4 decoding were horribly broken before an ffmpeg commit on 11/20/2017
+
+    if profile.dxva2_decoder and capabilities.has_hwaccel('dxva2'): # DXVA2 will fallback to CPU decoding when it hits a file that it cannot handle, so we don't need to check if the file is supported.
+        options['preopts'].extend(['-hwaccel', 'dxva2' ])
+    elif info.video.codec.lower() == "hevc" and profile.hevc_qsv_decoder and capabilities.has_decoder('hevc_qsv'):
+        options['preopts'].extend(['-vcodec', 'hevc_qsv'])
+    elif vcodec == "h264qsv" and info.video.codec.lower() == "h264" and profile.qsv_decoder and capabilities.has_decoder('h264_qsv') and (info.video.video_level / 10) < 5:
+        options['preopts'].extend(['-vcodec', 'h264_qsv'])
+    elif info.video.codec.lower() in nvenc_cuvid_codecs and \
+    profile.nvenc_cuvid and (capabilities.has_hwaccel('cuvid') or capabilities.has_hwaccel('cuda')) and vcodec != "copy" and not '422' in info.video.pix_fmt and not '444' in info.video.pix_fmt: #Cuvid only supports 420 chroma at the moment. 
+        if not '10le' in info.video.pix_fmt and not '16le' in info.video.pix_fmt and subtitle_will_be_burned_in == False: #Cannot do full hardware decoding with 10/12 bit video, it must be copied to system memory after decoding.
+            options['preopts'].extend(['-hwaccel', 'cuvid' ])                                                             #Also cannot do full hardware decoding when subtitles are being burned in
+            if info.video.codec.lower() == "hevc" or info.video.codec.lower() == "vp9":
+                if nvenc_decoder_hevc_gpu:
+                    options['preopts'].extend(['-hwaccel_device', str( nvenc_decoder_hevc_gpu )])
+                    nvenc_decoder_hevc_gpu = None
+            elif nvenc_decoder_gpu:
+                options['preopts'].extend(['-hwaccel_device', str( nvenc_decoder_gpu )])
+                nvenc_decoder_gpu = None
+            options['video']['nvenc_hwaccel_enabled'] = True
+        else:
+            options['video']['nvenc_hwaccel_enabled'] = False
+        if info.video.codec.lower() == "h264":
+            options['preopts'].extend(['-c:v', 'h264_cuvid'])
+        elif info.video.codec.lower() == "mjpeg":
+            options['preopts'].extend(['-c:v', 'mjpeg_cuvid'])
+        elif info.video.codec.lower() == "mpeg1video":
+            options['preopts'].extend(['-c:v', 'mpeg1_cuvid'])
+        elif info.video.codec.lower() == "mpeg2video":
+            options['preopts'].extend(['-c:v', 'mpeg2_cuvid'])
+        elif info.video.codec.lower() == "mpeg4":
+            options['preopts'].extend(['-c:v', 'mpeg4_cuvid'])
+        elif info.video.codec.lower() == "vc1":
+            options['preopts'].extend(['-c:v', 'vc1_cuvid'])
+        elif info.video.codec.lower() == "vp8":
+            options['preopts'].extend(['-c:v', 'vp8_cuvid'])
+        elif info.video.codec.lower() == "hevc" and profile.nvenc_cuvid_hevc:
+            options['preopts'].extend(['-c:v', 'hevc_cuvid'])
+        elif info.video.codec.lower() == "vp9" and profile.nvenc_cuvid_hevc:
+            options['preopts'].extend(['-c:v', 'vp9_cuvid'])
+        if info.video.codec.lower() == "hevc" or info.video.codec.lower() == "vp9":
+            if nvenc_decoder_hevc_gpu:
+                options['preopts'].extend(['-gpu', str( nvenc_decoder_hevc_gpu )])
+        elif nvenc_decoder_gpu:
+            options['preopts'].extend(['-gpu', str( nvenc_decoder_gpu )])
+    else:
+        options['video']['nvenc_hwaccel_enabled'] = False
+
+    # Add width option
+    if vwidth:
+        options['video']['width'] = vwidth
+    # Add Nvidia specific options
+    if profile.nvenc_profile:
+        options['video']['nvenc_profile'] = profile.nvenc_profile
+    if profile.nvenc_preset:
+        options['video']['nvenc_preset'] = profile.nvenc_preset
+    if profile.nvenc_rate_control:
+        options['video']['nvenc_rate_control'] = profile.nvenc_rate_control
+        if profile.nvenc_rate_control == "vbr_minqp" and profile.qmin is None:
+            log.error("nvenc vbr_minqp requires qmin option set.")
+        elif profile.nvenc_rate_control == "constqp" and profile.global_quality is None:
+            log.error("nvenc constqp requires global_quality to be set." )
+    if profile.nvenc_gpu:
+        options['video']['nvenc_gpu'] = profile.nvenc_gpu
+    if profile.nvenc_temporal_aq:
+        options['video']['nvenc_temporal_aq'] = profile.nvenc_temporal_aq
+    if profile.nvenc_weighted_prediction:
+        options['video']['nvenc_weighted_prediction'] = profile.nvenc_weighted_prediction
+    if profile.nvenc_rc_lookahead:
+        options['video']['nvenc_rc_lookahead'] = profile.nvenc_rc_lookahead
+    # HEVC Tagging for copied streams
+    if info.video.codec.lower() in ['x265', 'h265', 'hevc'] and vcodec == 'copy':
+        options['postopts'].extend(['-tag:v', 'hvc1'])
+        log.info("Tagging copied video stream as hvc1")
+
+    return {'options': options, 'rips': rips, 'deletesubs': deletesubs}
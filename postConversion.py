@@ -26,7 +26,7 @@ if len(sys.argv) > 4:
     season = int(sys.argv[4])
     episode = int(sys.argv[5])
 
-    converter = MkvtoMp4(settings)
+    converter = MkvtoMp4(settings, deferMove=True)
 
     log.debug("Input file: %s." % inputfile)
     log.debug("Original name: %s." % original)
@@ -45,7 +45,7 @@ if len(sys.argv) > 4:
                 try:
                     tagmp4 = Tvdb_mp4(tvdb_id, season, episode, original, language=settings.taglanguage)
                     tagmp4.setHD(output['x'], output['y'])
-                    tagmp4.writeTags(output['output'], settings.artwork, settings.thumbnail)
+                    tagmp4.writeTags(output['output'], settings.artwork, settings.thumbnail, profile=settings.profile_hash)
                 except:
                     log.error("Unable to tag file")
 
@@ -16,7 +16,7 @@ log = logging.getLogger("CouchPotatoPostConversion")
 log.info('MP4 Automator - Post processing script initialized')
 
 settings = ReadSettings(os.path.dirname(sys.argv[0]), "autoProcess.ini")
-converter = MkvtoMp4(settings)
+converter = MkvtoMp4(settings, deferMove=True)
 
 imdbid = sys.argv[1]
 inputfile = sys.argv[2]
@@ -39,7 +39,7 @@ try:
                 try:
                     tagmp4 = tmdb_mp4(imdbid, original=original, language=settings.taglanguage)
                     tagmp4.setHD(output['x'], output['y'])
-                    tagmp4.writeTags(output['output'], settings.artwork)
+                    tagmp4.writeTags(output['output'], settings.artwork, profile=settings.profile_hash)
                 except:
                     log.error("Unable to tag file")
 
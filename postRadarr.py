@@ -24,7 +24,7 @@ inputfile = os.environ.get('radarr_moviefile_path')
 original = os.environ.get('radarr_moviefile_scenename')
 imdbid = os.environ.get('radarr_movie_imdbid')
 
-converter = MkvtoMp4(settings)
+converter = MkvtoMp4(settings, deferMove=True)
 
 log.debug("Input file: %s." % inputfile)
 log.debug("Original name: %s." % original)
@@ -42,7 +42,7 @@ if MkvtoMp4(settings).validSource(inputfile):
             try:
                 tagmp4 = tmdb_mp4(imdbid, original=original, language=settings.taglanguage)
                 tagmp4.setHD(output['x'], output['y'])
-                tagmp4.writeTags(output['output'], settings.artwork, settings.thumbnail)
+                tagmp4.writeTags(output['output'], settings.artwork, settings.thumbnail, profile=settings.profile_hash)
             except:
                 log.error("Unable to tag file")
 
@@ -28,7 +28,7 @@ try:
 except:
     episode = int(os.environ.get('sonarr_episodefile_episodenumbers').split(",")[0])
 
-converter = MkvtoMp4(settings)
+converter = MkvtoMp4(settings, deferMove=True)
 
 log.debug("Input file: %s." % inputfile)
 log.debug("Original name: %s." % original)
@@ -47,7 +47,7 @@ if MkvtoMp4(settings).validSource(inputfile):
             try:
                 tagmp4 = Tvdb_mp4(tvdb_id, season, episode, original, language=settings.taglanguage)
                 tagmp4.setHD(output['x'], output['y'])
-                tagmp4.writeTags(output['output'], settings.artwork, settings.thumbnail)
+                tagmp4.writeTags(output['output'], settings.artwork, settings.thumbnail, profile=settings.profile_hash)
             except:
                 log.error("Unable to tag file")
 
@@ -0,0 +1,128 @@
+import time
+import logging
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from job_events import jobEvents
+
+
+class PostPipeline:
+    """Runs the post-encode steps of converted files on a pool of I/O workers.
+
+    Tagging, QT FastStart, replication, post process scripts and notifications mostly wait on disks and the network,
+    so a file frees its encode slot as soon as ffmpeg exits and its remaining steps are queued here. The depth of the
+    queue between the encode and post stages is tracked over time, with how long files waited in it and how long
+    their steps ran, and recorded as a 'pipeline' event when the pipeline is closed. With a limit, submit blocks while
+    that many files are queued or running, so a producer cannot get ahead of the workers without bound."""
+
+    def __init__(self, workers=2, stage='post', limit=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.stage = stage
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(limit) if limit else None
+        self.threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self.work, name="%s-%d" % (stage, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.waiting = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.peak = 0
+        self.waited = 0.0
+        self.ran = 0.0
+        self.opened = time.time()
+        self.changed = self.opened
+        self.area = 0.0
+        self.closed = False
+
+    def count(self, waiting=0, running=0):
+        # Change the counters under the lock, integrating the queue depth over time
+        now = time.time()
+        self.area += self.waiting * (now - self.changed)
+        self.changed = now
+        self.waiting += waiting
+        self.running += running
+        self.peak = max(self.peak, self.waiting)
+        return now
+
+    def submit(self, label, function, args=(), done=None):
+        """Queue function(*args) for the workers, done(result, error) is called from the worker once it ran."""
+        if self.slots is not None:
+            self.slots.acquire()
+        with self.lock:
+            queued = self.count(waiting=1)
+        self.queue.put((label, function, args, done, queued))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            label, function, args, done, queued = item
+            with self.lock:
+                started = self.count(waiting=-1, running=1)
+                self.waited += started - queued
+            self.log.debug("Starting the %s stage of %s after %.1fs in queue." % (self.stage, label, started - queued))
+            result = error = None
+            try:
+                result = function(*args)
+            except Exception as e:
+                self.log.exception("Error in the %s stage of %s." % (self.stage, label))
+                error = e
+            with self.lock:
+                self.ran += self.count(running=-1) - started
+                if error is None:
+                    self.done += 1
+                else:
+                    self.failed += 1
+            if done is not None:
+                try:
+                    done(result, error)
+                except Exception:
+                    self.log.exception("Error completing the %s stage of %s." % (self.stage, label))
+            if self.slots is not None:
+                self.slots.release()
+
+    def metrics(self):
+        with self.lock:
+            self.count()
+            finished = self.done + self.failed
+            elapsed = self.changed - self.opened
+            return {'stage': self.stage,
+                    'workers': len(self.threads),
+                    'jobs': finished,
+                    'failed': self.failed,
+                    'depth': self.waiting,
+                    'running': self.running,
+                    'peak_depth': self.peak,
+                    'mean_depth': round(self.area / elapsed, 2) if elapsed > 0 else 0.0,
+                    'mean_wait': round(self.waited / finished, 2) if finished else 0.0,
+                    'mean_run': round(self.ran / finished, 2) if finished else 0.0}
+
+    def describe(self):
+        with self.lock:
+            return "%s: %d waiting, %d running" % (self.stage, self.waiting, self.running)
+
+    def close(self):
+        # Wait for every queued file and record the metrics of the stage
+        if self.closed:
+            return
+        self.closed = True
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        metrics = self.metrics()
+        if metrics['jobs']:
+            self.log.info("%s stage: %d files, queue depth peak %d mean %.2f, waited %.1fs and ran %.1fs on average." % (self.stage.capitalize(), metrics['jobs'], metrics['peak_depth'], metrics['mean_depth'], metrics['mean_wait'], metrics['mean_run']))
+            jobEvents.record('pipeline', **metrics)
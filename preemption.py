@@ -0,0 +1,242 @@
+import os
+import time
+import errno
+import signal
+import logging
+import tempfile
+import itertools
+from job_costs import PRIORITIES
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Classes whose ffmpeg processes are suspended while jobs of a higher class run
+PREEMPTIBLE_CLASSES = ['backfill']
+PREEMPT_MODES = ['stop', 'throttle', 'none']
+# Seconds between two looks at the claims of running jobs
+CHECK_INTERVAL = 1.0
+# A throttled ffmpeg runs this fraction of every period
+THROTTLE_PERIOD = 4.0
+THROTTLE_DUTY = 0.25
+
+
+def supported():
+    return hasattr(signal, 'SIGSTOP') and hasattr(os, 'killpg') and fcntl is not None
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def privateDirectory(name):
+    # Directory of this user in the temp directory, named like the tvdb_api cache
+    if hasattr(os, 'getuid'):
+        name = "%s-u%d" % (name, os.getuid())
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def makePrivate(path):
+    # Create a directory only this user can use, raises OSError when it belongs to someone else or others can write it
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    if not hasattr(os, 'getuid'):
+        return
+    st = os.lstat(path)
+    if os.path.islink(path) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError(errno.EPERM, "%s is not a private directory" % path)
+
+
+def lockFile(path):
+    """Create path and hold an exclusive lock on it for as long as the returned file stays open.
+
+    The file is locked under a hidden name first and then renamed, so it never shows up unlocked."""
+    tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+    f = open(tmp, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        f.close()
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return f
+
+
+def unlock(f):
+    # Remove the file of lockFile before its lock is dropped, so it is never seen unlocked
+    try:
+        os.remove(os.path.join(os.path.dirname(f.name), os.path.basename(f.name)[1:]))
+    except OSError:
+        pass
+    f.close()
+
+
+def held(path):
+    # Whether a process holds the lock of path, a file nobody holds was left behind by a process that is gone
+    try:
+        with open(path, 'r') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+    except (IOError, OSError):
+        return False
+
+
+class PreemptionClaims:
+    """Running jobs of every process on the machine that may preempt lower classes.
+
+    A job that is not preemptible claims its class with an empty file named after the class, which it keeps locked for
+    as long as it converts. A claim whose lock nobody holds was left by a process that died and is removed when it is
+    found, whatever became of its pid. The claims live in a directory only the user can write to."""
+
+    def __init__(self, path=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.path = path or privateDirectory("mp4_automator-claims")
+        self.counter = itertools.count()
+
+    def claim(self, priority):
+        # Returns the claim to release once the job is done, None if it could not be made
+        if not supported():
+            return None
+        path = os.path.join(self.path, "%s-%d-%d" % (priority, os.getpid(), next(self.counter)))
+        try:
+            makePrivate(self.path)
+            return lockFile(path)
+        except (IOError, OSError):
+            self.log.exception("Unable to claim the %s class, lower classes will not be preempted." % priority)
+            return None
+
+    def release(self, claim):
+        if claim is not None:
+            unlock(claim)
+
+    def active(self, priority):
+        """Return the classes of the running jobs that preempt a job of priority."""
+        rank = PRIORITIES.get(priority, len(PRIORITIES))
+        classes = set()
+        try:
+            makePrivate(self.path)
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        for name in names:
+            claimed = name.split('-', 1)[0]
+            if name.startswith('.') or PRIORITIES.get(claimed, rank) >= rank:
+                continue
+            path = os.path.join(self.path, name)
+            if not held(path):
+                self.log.debug("Removing stale claim %s." % name)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            classes.add(claimed)
+        return sorted(classes)
+
+
+class Preemptor:
+    """Suspends the ffmpeg process of a preemptible job while jobs of a higher class run.
+
+    poll() is called from the loop reading ffmpeg's progress. In stop mode ffmpeg is stopped with SIGSTOP for as long
+    as a higher class job runs, in throttle mode it only runs THROTTLE_DUTY of every THROTTLE_PERIOD, and it is
+    continued with SIGCONT afterwards. The whole process group is signalled when ffmpeg leads its own. The time spent
+    stopped is handed out by elapsed() so progress timers and the stall watchdog can leave it out."""
+
+    def __init__(self, priority, mode='stop', claims=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.priority = priority
+        self.mode = mode
+        self.claims = claims or preemptionClaims
+        self.pid = None
+        self.group = False
+        self.preempted = []
+        self.checked = 0
+        self.stopped = None
+        self.paused = 0.0
+        self.total = 0.0
+
+    def attach(self, pid):
+        # The ffmpeg process to suspend, a new one for every pass or retry
+        self.pid = pid
+        self.stopped = None
+        self.checked = 0
+        try:
+            self.group = os.getpgid(pid) == pid
+        except OSError:
+            self.group = False
+
+    def signal(self, signum):
+        try:
+            if self.group:
+                os.killpg(self.pid, signum)
+            else:
+                os.kill(self.pid, signum)
+        except OSError:
+            return False
+        return True
+
+    def poll(self, now=None):
+        """Stop or continue ffmpeg as higher class jobs come and go, returns True while it is stopped."""
+        if self.pid is None:
+            return False
+        now = now or time.time()
+        if now - self.checked >= CHECK_INTERVAL:
+            self.checked = now
+            preempted = self.claims.active(self.priority)
+            if preempted and not self.preempted:
+                self.log.info("%s %s ffmpeg process %d while %s jobs run." % ('Suspending' if self.mode == 'stop' else 'Throttling', self.priority, self.pid, ', '.join(preempted)))
+            elif self.preempted and not preempted:
+                self.log.info("Resuming %s ffmpeg process %d." % (self.priority, self.pid))
+            self.preempted = preempted
+
+        stop = bool(self.preempted) and (self.mode == 'stop' or now % THROTTLE_PERIOD >= THROTTLE_PERIOD * THROTTLE_DUTY)
+        if stop and self.stopped is None:
+            if self.signal(signal.SIGSTOP):
+                self.stopped = now
+        elif not stop and self.stopped is not None:
+            self.resume(now)
+        return self.stopped is not None
+
+    def resume(self, now=None):
+        # Continue a stopped ffmpeg, also called before it is terminated as a stopped process ignores SIGTERM
+        if self.stopped is None:
+            return
+        self.signal(signal.SIGCONT)
+        paused = (now or time.time()) - self.stopped
+        self.paused += paused
+        self.total += paused
+        self.stopped = None
+
+    def elapsed(self):
+        # Seconds ffmpeg spent stopped since the last call
+        paused = self.paused
+        self.paused = 0.0
+        return paused
+
+
+# Shared by every MkvtoMp4 instance and runner in the process
+preemptionClaims = PreemptionClaims()
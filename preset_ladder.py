@@ -0,0 +1,70 @@
+import logging
+import threading
+from option_planner import optionsPreset, withPreset
+from job_events import jobEvents
+
+# Ladder used by each video codec, codecs without one keep their preset
+LADDER_CODECS = {'h264': 'x264', 'h265': 'x264', 'h264qsv': 'x264', 'hevcqsv': 'x264', 'nvenc_h264': 'nvenc', 'nvenc_h265': 'nvenc'}
+
+
+class PresetLadder:
+    """Moves the encoder preset along a configured ladder of presets as the backlog changes.
+
+    Each ladder lists the allowed presets from the slowest to the fastest, so its ends are the quality bounds. Every
+    decision moves one rung faster while the backlog (estimated seconds of queued work per job slot) is above the
+    target, and one rung slower once it drops below half of it, so an idle queue gets the best quality the ladder
+    allows and a flood of files is drained with faster presets."""
+
+    def __init__(self, ladders, target=3600, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.ladders = dict((kind, list(ladder)) for kind, ladder in ladders.items() if ladder)
+        self.target = target
+        self.rungs = dict((kind, 0) for kind in self.ladders)
+        self.lock = threading.Lock()
+
+    def update(self, backlog):
+        # Move every ladder one rung according to the backlog
+        with self.lock:
+            if backlog > self.target:
+                step = 1
+            elif backlog < self.target / 2.0:
+                step = -1
+            else:
+                return
+            for kind, ladder in self.ladders.items():
+                rung = min(len(ladder) - 1, max(0, self.rungs[kind] + step))
+                if rung != self.rungs[kind]:
+                    self.log.info("Backlog of %ds per job, moving the %s preset to %s." % (backlog, kind, ladder[rung]))
+                    self.rungs[kind] = rung
+
+    def preset(self, codec):
+        """Return (preset, rung) for a video codec, (None, None) if it has no ladder."""
+        kind = LADDER_CODECS.get(codec)
+        if kind not in self.ladders:
+            return None, None
+        with self.lock:
+            rung = self.rungs[kind]
+        return self.ladders[kind][rung], rung
+
+    def apply(self, inputfile, options, backlog):
+        """Return options using the preset of the current rung after updating the ladder with the backlog, and
+        record the choice for the file."""
+        self.update(backlog)
+        codec = (options.get('video') or {}).get('codec')
+        preset, rung = self.preset(codec)
+        if preset is None:
+            return options
+        jobEvents.record('preset', input=inputfile, codec=codec, preset=preset, rung=rung, ladder=self.ladders[LADDER_CODECS[codec]], previous=optionsPreset(options), backlog=round(backlog, 1))
+        self.log.debug("Encoding %s with the %s preset (rung %d)." % (inputfile, preset, rung))
+        return withPreset(options, preset)
+
+
+def ladderFromSettings(settings, logger=None):
+    # PresetLadder configured by settings, None when adaptive presets are disabled
+    if not getattr(settings, 'adaptive_preset', False):
+        return None
+    return PresetLadder({'x264': settings.preset_ladder, 'nvenc': settings.nvenc_preset_ladder}, settings.preset_backlog_target, logger)
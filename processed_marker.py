@@ -0,0 +1,74 @@
+import os
+import hashlib
+import logging
+from mutagen.mp4 import MP4
+
+# Prefix written to the encoder tag (\xa9too) by the taggers
+MARKER_PREFIX = "MDH:"
+# Freeform atom holding the hash of the settings profile the file was produced with
+PROFILE_KEY = "----:com.apple.iTunes:MDHProfile"
+# MP4 settings that shape the file that is produced, new settings only change the profile hash once they are listed here
+PROFILE_OPTIONS = ['vsync', 'output_extension', 'output_format', 'relocate_moov', 'ios-audio', 'ios-first-track-only',
+                   'ios-move-last', 'ios-audio-filter', 'max-audio-channels', 'audio-language', 'audio-default-language',
+                   'audio-codec', 'audio-filter', 'audio-channel-bitrate', 'audio-copy-original', 'aac_adtstoasc', 'sample_rate',
+                   'video-codec', 'resolution-bitrate-restriction', 'video-bitrate', 'video-crf', 'video-max-width',
+                   'video_two_pass', 'video-profile', 'h264-max-level', 'pix-fmt', 'qmin', 'qmax', 'global_quality', 'maxrate',
+                   'minrate', 'bufsize', 'nvenc_profile', 'nvenc_preset', 'nvenc_encoder_gpu', 'nvenc_temporal_aq',
+                   'nvenc_weighted_prediction', 'nvenc_rc_lookahead', 'nvenc_rate_control', 'enable_nvenc_decoder',
+                   'enable_nvenc_hevc_decoder', 'nvenc_decoder_gpu', 'nvenc_hevc_decoder_gpu', 'use-qsv-decoder-with-encoder',
+                   'use-hevc-qsv-decoder', 'enable_dxva2_gpu_decode', 'burn_in_forced_subs', 'subtitle-codec',
+                   'subtitle-language', 'subtitle-default-language', 'subtitle-encoding', 'embed-subs',
+                   'embed-only-internal-subs', 'tagfile', 'tag-language', 'download-artwork', 'artwork-max-size', 'preopts',
+                   'postopts']
+# Extensions that can carry the marker
+MARKER_EXTENSIONS = ['mp4', 'm4v']
+
+
+def profileHash(config, section="MP4"):
+    """Fingerprint the options of a settings section that shape the output file."""
+    items = sorted((k.lower(), config.get(section, k, raw=True).strip()) for k in config.options(section) if k.lower() in PROFILE_OPTIONS)
+    return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()[:16]
+
+
+def readMarker(path, logger=None):
+    """Return (original filename, profile hash) from the MDH marker of path, reading only the moov atom.
+
+    Either value is None when the file was not tagged by this tool or carries no profile hash."""
+    log = logger or logging.getLogger(__name__)
+    if os.path.splitext(path)[1][1:].lower() not in MARKER_EXTENSIONS:
+        return None, None
+    try:
+        video = MP4(path, lazy=True)
+    except Exception:
+        log.debug("Unable to read MDH marker from %s." % path)
+        return None, None
+    if video.tags is None or "\xa9too" not in video.tags:
+        return None, None
+
+    tool = video.tags["\xa9too"][0]
+    if not tool.startswith(MARKER_PREFIX):
+        return None, None
+    original = tool[len(MARKER_PREFIX):]
+
+    profile = None
+    if PROFILE_KEY in video.tags:
+        try:
+            profile = bytes(video.tags[PROFILE_KEY][0]).decode('utf-8')
+        except (IndexError, UnicodeDecodeError):
+            log.debug("Invalid MDH profile hash in %s." % path)
+    return original, profile
+
+
+def isProcessed(path, profile, logger=None):
+    """Check whether path was produced by this tool with the settings profile hash profile."""
+    if not profile:
+        return False
+    original, marked = readMarker(path, logger)
+    return original is not None and marked == profile
+
+
+def writeMarker(video, original, profile=None):
+    """Stamp an MP4 object with the MDH marker and, when known, the settings profile hash."""
+    video["\xa9too"] = MARKER_PREFIX + os.path.basename(original)
+    if profile:
+        video[PROFILE_KEY] = [profile]
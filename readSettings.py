@@ -8,8 +8,13 @@ except ImportError:
     import ConfigParser as configparser
 import logging
 from extensions import *
+from processed_marker import profileHash
+from artwork_cache import artworkCache
+from converter.capabilities import which
+from settings_profile import compileProfile
+from resource_classes import RESOURCE_CLASSES, RESOURCE_OPTIONS, RESOURCE_PARSERS
+from preemption import PREEMPT_MODES
 from babelfish import Language
-from subprocess import Popen, PIPE
 
 class ReadSettings:
 
@@ -121,6 +126,8 @@ class ReadSettings:
                         'tagfile': 'True',
                         'tag-language': 'en',
                         'download-artwork': 'poster',
+                        'artwork-max-size': '',
+                        'artwork-cache-size': '200',
                         'download-subs': 'False',
                         'embed-subs': 'True',
                         'embed-only-internal-subs': 'False',
@@ -129,7 +136,18 @@ class ReadSettings:
                         'post-process': 'False',
                         'pix-fmt': '',
                         'preopts': '',
-                        'postopts': ''}
+                        'postopts': '',
+                        'stall-speed-fraction': '0.1',
+                        'stall-window': '120',
+                        'stall-retries': '1',
+                        'adaptive-preset': 'False',
+                        'preset-ladder': 'slow, medium, fast, faster, veryfast',
+                        'nvenc-preset-ladder': 'slow, medium, fast',
+                        'preset-backlog-target': '3600',
+                        'scratch-directory': '',
+                        'scratch-size': '',
+                        'post-workers': '2',
+                        'min-free-space': '1024'}
         # Default settings for CouchPotato
         cp_defaults = {'host': 'localhost',
                        'port': '5050',
@@ -215,7 +233,26 @@ class ReadSettings:
 
         podnapisi_defaults = {'only_foreign':'true'}
 
-        defaults = {'SickBeard': sb_defaults, 'CouchPotato': cp_defaults, 'Sonarr': sonarr_defaults, 'Radarr': radarr_defaults, 'MP4': mp4_defaults, 'uTorrent': utorrent_defaults, 'SABNZBD': sab_defaults, 'Sickrage': sr_defaults, 'Deluge': deluge_defaults, 'Plex': plex_defaults, 'Opensubtitles': opensubtitles_defaults, 'Podnapisi': podnapisi_defaults }
+        # Default resource classes, batches yield to the downloaders and media servers on the same machine
+        resources_defaults = {'cgroup': '',
+                              'preempt': 'stop',
+                              'hook-cpus': '',
+                              'hook-nice': '',
+                              'hook-ionice': '',
+                              'hook-cpu-weight': '',
+                              'hook-io-weight': '',
+                              'interactive-cpus': '',
+                              'interactive-nice': '',
+                              'interactive-ionice': '',
+                              'interactive-cpu-weight': '',
+                              'interactive-io-weight': '',
+                              'backfill-cpus': '',
+                              'backfill-nice': '10',
+                              'backfill-ionice': 'best-effort:7',
+                              'backfill-cpu-weight': '',
+                              'backfill-io-weight': ''}
+
+        defaults = {'SickBeard': sb_defaults, 'CouchPotato': cp_defaults, 'Sonarr': sonarr_defaults, 'Radarr': radarr_defaults, 'MP4': mp4_defaults, 'uTorrent': utorrent_defaults, 'SABNZBD': sab_defaults, 'Sickrage': sr_defaults, 'Deluge': deluge_defaults, 'Plex': plex_defaults, 'Opensubtitles': opensubtitles_defaults, 'Podnapisi': podnapisi_defaults, 'Resources': resources_defaults }
         write = False  # Will be changed to true if a value is missing from the config file and needs to be written
 
         config = configparser.SafeConfigParser()
@@ -243,33 +280,23 @@ class ReadSettings:
 
         # Read relevant MP4 section information
         section = "MP4"
-        if os.name != 'nt':
-            p = Popen(['/usr/bin/whereis', 'ffmpeg'], stdin=PIPE, stdout=PIPE, stderr=PIPE, encoding='utf8')
-            output, err = p.communicate()
-            ffmpegLoc = output.split(' ')
-            
-            #print("ffmpeg Length %s" % (len(ffmpegLoc)))
-            
-            p = Popen(['/usr/bin/whereis', 'ffprobe'], stdin=PIPE, stdout=PIPE, stderr=PIPE, encoding='utf8')
-            output, err = p.communicate()
-            ffprobeLoc = output.split(' ')
-            
-            #print("ffprobe Length %s" % (len(ffprobeLoc)))
-        
+        self.profile_hash = profileHash(config, section)  # Fingerprint of the conversion settings, embedded with the MDH marker to skip already processed files
         self.ffmpeg = config.get(section, "ffmpeg")  # Location of FFMPEG.exe       
         self.ffprobe = config.get(section, "ffprobe")  # Location of FFPROBE.exe
 
-        # Auto find binary if wrong location for ffmpeg/ffprobe (or if .exe is detected)
+        # Auto find binary if wrong location for ffmpeg/ffprobe (or if .exe is detected), the PATH lookup is cached per process
         if os.name != 'nt':
             if ".exe" in self.ffmpeg or self.ffmpeg == '':
-                if len(ffmpegLoc) > 1:
-                    print("Error in ffmpeg location.. We automatically found the binary.. %s" % (ffmpegLoc[1]))
-                    self.ffmpeg = ffmpegLoc[1]
+                ffmpegLoc = which('ffmpeg')
+                if ffmpegLoc:
+                    print("Error in ffmpeg location.. We automatically found the binary.. %s" % (ffmpegLoc))
+                    self.ffmpeg = ffmpegLoc
             if ".exe" in self.ffprobe or self.ffprobe == '':
-                if len(ffmpegLoc) > 1:
-                    print("Error in ffprobe location.. We automatically found the binary.. %s" % (ffprobeLoc[1]))
-                    self.ffprobe = ffprobeLoc[1]        
-        
+                ffprobeLoc = which('ffprobe')
+                if ffprobeLoc:
+                    print("Error in ffprobe location.. We automatically found the binary.. %s" % (ffprobeLoc))
+                    self.ffprobe = ffprobeLoc
+
         self.ffmpeg = os.path.normpath(self.raw(self.ffmpeg))
         self.ffprobe = os.path.normpath(self.raw(self.ffprobe))
         self.threads = config.get(section, "threads")  # Number of FFMPEG threads
@@ -637,6 +664,16 @@ class ReadSettings:
             except:
                 self.artwork = True
                 log.error("Invalid download-artwork value, defaulting to 'poster'.")
+        try:
+            self.artwork_max_size = int(config.get(section, "artwork-max-size"))  # Downscale cover art to this many pixels on its longest side
+        except ValueError:
+            self.artwork_max_size = None
+        try:
+            self.artwork_cache_size = int(config.get(section, "artwork-cache-size"))  # Size of the shared artwork cache in MB
+        except ValueError:
+            log.error("Invalid artwork-cache-size value, defaulting to 200.")
+            self.artwork_cache_size = 200
+        artworkCache.configure(self.ffmpeg, self.artwork_max_size, self.artwork_cache_size * 1024 * 1024)
 
         self.preopts = config.get(section, "preopts").lower()
         if self.preopts == '':
@@ -652,6 +689,52 @@ class ReadSettings:
             self.postopts = self.postopts.split(',')
             [o.strip() for o in self.postopts]
 
+        try:
+            self.stall_fraction = float(config.get(section, "stall-speed-fraction"))  # Fraction of the expected encode speed below which a conversion counts as stalled
+        except ValueError:
+            log.error("Invalid stall-speed-fraction value, defaulting to 0.1.")
+            self.stall_fraction = 0.1
+        try:
+            self.stall_window = int(config.get(section, "stall-window"))  # Seconds of progress the encode speed is measured over
+        except ValueError:
+            log.error("Invalid stall-window value, defaulting to 120.")
+            self.stall_window = 120
+        try:
+            self.stall_retries = int(config.get(section, "stall-retries"))  # Number of retries with a fallback profile after a stall
+        except ValueError:
+            log.error("Invalid stall-retries value, defaulting to 1.")
+            self.stall_retries = 1
+
+        self.adaptive_preset = config.getboolean(section, "adaptive-preset")  # Move the preset along the ladders with the backlog of batches
+        self.preset_ladder = [p for p in config.get(section, "preset-ladder").lower().replace(' ', '').split(',') if p]  # x264/x265/QSV presets, slowest first
+        self.nvenc_preset_ladder = [p for p in config.get(section, "nvenc-preset-ladder").lower().replace(' ', '').split(',') if p]  # NVENC presets, slowest first
+        try:
+            self.preset_backlog_target = int(config.get(section, "preset-backlog-target"))  # Seconds of queued work per job above which faster presets are used
+        except ValueError:
+            log.error("Invalid preset-backlog-target value, defaulting to 3600.")
+            self.preset_backlog_target = 3600
+
+        self.scratch_dir = config.get(section, "scratch-directory")  # Fast local directory inputs and outputs are staged in
+        if self.scratch_dir == '':
+            self.scratch_dir = None
+        else:
+            self.scratch_dir = os.path.normpath(self.raw(self.scratch_dir))
+        try:
+            self.scratch_size = int(config.get(section, "scratch-size") or 0)  # MB the staged files may use, 0 for the free space
+        except ValueError:
+            log.error("Invalid scratch-size value, defaulting to the free space of the scratch directory.")
+            self.scratch_size = 0
+        try:
+            self.post_workers = max(1, int(config.get(section, "post-workers")))  # Workers tagging, moving and post processing converted files while the next ones convert
+        except ValueError:
+            log.error("Invalid post-workers value, defaulting to 2.")
+            self.post_workers = 2
+        try:
+            self.min_free_space = max(0, int(config.get(section, "min-free-space")))  # MB left free on every file system a conversion writes to
+        except ValueError:
+            log.error("Invalid min-free-space value, defaulting to 1024.")
+            self.min_free_space = 1024
+
         # Read relevant CouchPotato section information
         section = "CouchPotato"
         self.CP = {}
@@ -820,11 +903,39 @@ class ReadSettings:
         self.podnapisi = {}
         self.podnapisi['only_foreign'] = config.getboolean(section, "only_foreign" )
 
+        # Read the limits of the resource classes ffmpeg runs in
+        section = "Resources"
+        self.resources = {}
+        for name in RESOURCE_CLASSES:
+            limits = {}
+            for option in RESOURCE_OPTIONS:
+                value = config.get(section, "%s-%s" % (name, option)).strip()
+                try:
+                    limits[option.replace('-', '_')] = RESOURCE_PARSERS[option](value) if value else None
+                except ValueError:
+                    log.error("Invalid %s-%s value %s, ignoring it." % (name, option, value))
+                    limits[option.replace('-', '_')] = None
+            self.resources[name] = limits
+        self.resource_cgroup = config.get(section, "cgroup").strip()  # Delegated cgroup v2 directory the classes get their child cgroups in
+        if self.resource_cgroup == '':
+            self.resource_cgroup = None
+        self.preempt = config.get(section, "preempt").strip().lower()  # How backfill conversions make way for hook and interactive ones
+        if self.preempt not in PREEMPT_MODES:
+            log.error("Invalid preempt value %s, defaulting to stop." % self.preempt)
+            self.preempt = 'stop'
 
         # Pass the values on
         self.config = config
         self.configFile = configFile
 
+        compileProfile(self, log)
+
+    def __setattr__(self, name, value):
+        # Changes made after loading, e.g. command line overrides, invalidate the compiled profile
+        self.__dict__[name] = value
+        if name != 'compiled':
+            self.__dict__['compiled'] = None
+
     def getRefreshURL(self, tvdb_id):
         config = self.config
         section = "SickBeard"
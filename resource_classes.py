@@ -0,0 +1,212 @@
+import os
+import sys
+import logging
+import platform
+import threading
+
+# Classes ffmpeg processes run in, the same names as the priority classes of the job queue
+RESOURCE_CLASSES = ['hook', 'interactive', 'backfill']
+# Options of a class in the Resources section, prefixed with the class name
+RESOURCE_OPTIONS = ['cpus', 'nice', 'ionice', 'cpu-weight', 'io-weight']
+# I/O scheduling classes of ioprio_set
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# ioprio_set system call number by machine
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'arm64': 30, 'armv7l': 314, 'ppc64le': 273}
+
+
+def parseCpus(text):
+    # "0-3,6" -> [0, 1, 2, 3, 6]
+    cpus = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    if not cpus or min(cpus) < 0:
+        raise ValueError(text)
+    return sorted(cpus)
+
+
+def parseIonice(text):
+    # "best-effort:7" -> ('best-effort', 7), the level defaults to 4 and the idle class has none
+    name, _, level = text.strip().lower().partition(':')
+    name = name.strip()
+    if name not in IOPRIO_CLASSES:
+        raise ValueError(text)
+    level = int(level) if level.strip() else (0 if name == 'idle' else 4)
+    if level < 0 or level > 7:
+        raise ValueError(text)
+    return name, level
+
+
+def parseWeight(text):
+    # cgroup v2 cpu.weight and io.weight range
+    weight = int(text)
+    if weight < 1 or weight > 10000:
+        raise ValueError(text)
+    return weight
+
+
+RESOURCE_PARSERS = {'cpus': parseCpus, 'nice': int, 'ionice': parseIonice, 'cpu-weight': parseWeight, 'io-weight': parseWeight}
+
+
+class ResourceClass:
+    """CPU and I/O limits the ffmpeg processes of a resource class are started with.
+
+    The limits are applied by the parent right after ffmpeg is spawned, to every thread it already runs, so the threads
+    it starts later inherit the CPU affinity, nice level and I/O scheduling class. Nothing runs in the child between
+    fork and exec, which is not safe from a parent running other threads. With a delegated cgroup v2 directory the
+    process is also moved, with all its threads, to a child cgroup named after the class, carrying its CPU and I/O
+    weights. Limits the platform or the permissions of the user do not allow are logged once by prepare() and
+    skipped."""
+
+    def __init__(self, name, cpus=None, nice=None, ionice=None, cpu_weight=None, io_weight=None, cgroup=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.name = name
+        self.cpus = cpus
+        self.nice = nice
+        self.ionice = ionice
+        self.cpu_weight = cpu_weight
+        self.io_weight = io_weight
+        self.cgroup = cgroup
+        self.ioprio = None
+        self.syscall = None
+        self.procs = None
+        self.prepared = False
+        self.lock = threading.Lock()
+
+    def prepare(self):
+        # Check the limits and set up the cgroup once in the parent, so the child only makes system calls
+        with self.lock:
+            if self.prepared:
+                return self
+            self.prepared = True
+
+            if self.cpus:
+                try:
+                    available = os.sched_getaffinity(0)
+                    cpus = set(cpu for cpu in self.cpus if cpu in available)
+                    if not cpus:
+                        self.log.warning("None of the cpus %s of the %s resource class are available, ignoring them." % (self.cpus, self.name))
+                    self.cpus = cpus or None
+                except AttributeError:
+                    self.log.warning("CPU affinity is not supported on this platform, ignoring the cpus of the %s resource class." % self.name)
+                    self.cpus = None
+
+            if self.nice is not None and not hasattr(os, 'setpriority'):
+                self.log.warning("Nice levels are not supported on this platform, ignoring the nice level of the %s resource class." % self.name)
+                self.nice = None
+
+            if self.ionice:
+                self.syscall = IOPRIO_SET_SYSCALLS.get(platform.machine().lower()) if sys.platform.startswith('linux') else None
+                if self.syscall is None:
+                    self.log.warning("I/O scheduling classes are not supported on this platform, ignoring the ionice of the %s resource class." % self.name)
+                else:
+                    try:
+                        import ctypes
+                        self.libc = ctypes.CDLL(None, use_errno=True)
+                        self.ioprio = (IOPRIO_CLASSES[self.ionice[0]] << IOPRIO_CLASS_SHIFT) | self.ionice[1]
+                    except (ImportError, OSError, AttributeError):
+                        self.log.warning("Unable to load the C library, ignoring the ionice of the %s resource class." % self.name)
+
+            if self.cgroup and (self.cpu_weight or self.io_weight):
+                self.procs = self.setupCgroup()
+        return self
+
+    def setupCgroup(self):
+        # Child cgroup of the configured cgroup v2 directory with the weights of the class, returns its cgroup.procs or None
+        path = os.path.join(self.cgroup, self.name)
+        try:
+            # The controllers may already be enabled
+            try:
+                with open(os.path.join(self.cgroup, 'cgroup.subtree_control'), 'w') as f:
+                    f.write('+cpu +io')
+            except (IOError, OSError):
+                pass
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            if self.cpu_weight:
+                with open(os.path.join(path, 'cpu.weight'), 'w') as f:
+                    f.write(str(self.cpu_weight))
+            if self.io_weight:
+                with open(os.path.join(path, 'io.weight'), 'w') as f:
+                    f.write('default %d' % self.io_weight)
+        except (IOError, OSError) as e:
+            self.log.warning("Unable to set up cgroup %s, ignoring the weights of the %s resource class: %s" % (path, self.name, e))
+            return None
+        self.log.debug("Running %s jobs in cgroup %s." % (self.name, path))
+        return os.path.join(path, 'cgroup.procs')
+
+    def threads(self, pid):
+        # Thread ids of a process, affinity, nice levels and I/O priorities are set per thread on Linux
+        try:
+            return [int(tid) for tid in os.listdir('/proc/%d/task' % pid)]
+        except (OSError, ValueError):
+            return [pid]
+
+    def apply(self, pid):
+        """Apply the limits to the running process pid, errors are logged and never raised."""
+        if self.procs:
+            try:
+                with open(self.procs, 'w') as f:
+                    f.write(str(pid))
+            except (IOError, OSError) as e:
+                self.log.debug("Unable to move process %d to %s: %s" % (pid, os.path.dirname(self.procs), e))
+        done = set()
+        # Once more for threads started while the first ones were handled
+        for i in range(2):
+            for tid in self.threads(pid):
+                if tid in done:
+                    continue
+                done.add(tid)
+                try:
+                    if self.cpus:
+                        os.sched_setaffinity(tid, self.cpus)
+                    if self.nice is not None:
+                        os.setpriority(os.PRIO_PROCESS, tid, self.nice)
+                    if self.ioprio is not None:
+                        self.libc.syscall(self.syscall, IOPRIO_WHO_PROCESS, tid, self.ioprio)
+                except OSError as e:
+                    # The process may already be gone
+                    self.log.debug("Unable to apply the %s resource class to thread %d: %s" % (self.name, tid, e))
+
+    def describe(self):
+        limits = []
+        if self.cpus:
+            limits.append("cpus %s" % ','.join(str(cpu) for cpu in sorted(self.cpus)))
+        if self.nice is not None:
+            limits.append("nice %d" % self.nice)
+        if self.ioprio is not None:
+            limits.append("ionice %s:%d" % self.ionice)
+        if self.procs:
+            limits.append("cgroup %s" % os.path.dirname(self.procs))
+        return "%s (%s)" % (self.name, ', '.join(limits) or 'unrestricted')
+
+
+# Prepared classes shared by every converter in the process, by name and limits
+resourceClasses = {}
+resourceLock = threading.Lock()
+
+
+def resourceClass(name, limits, cgroup=None, logger=None):
+    """Return the prepared ResourceClass of a class name from its parsed limits (see ReadSettings.resources), None
+    when the class sets no limits."""
+    limits = dict((key, value) for key, value in (limits or {}).items() if value is not None)
+    if not limits:
+        return None
+    key = (name, repr(sorted(limits.items())), cgroup)
+    with resourceLock:
+        resources = resourceClasses.get(key)
+        if resources is None:
+            resources = resourceClasses[key] = ResourceClass(name, cgroup=cgroup, logger=logger, **limits)
+    return resources.prepare()
@@ -0,0 +1,289 @@
+import os
+import json
+import shutil
+import logging
+import threading
+import itertools
+from preemption import alive, lockFile, unlock, held
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bytes always left free on the scratch file system
+FREE_MARGIN = 512 * 1024 * 1024
+# Written next to a converted output with the destination it is bound for
+DESTINATION = '.destination'
+# Kept locked in a job directory by the process that reserved the space of its file
+RESERVED = '.reserved'
+
+
+def freeSpace(path):
+    # Bytes available to this user on the file system of path, None if unknown
+    try:
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+    except AttributeError:
+        try:
+            return shutil.disk_usage(path).free
+        except (AttributeError, OSError):
+            return None
+    except OSError:
+        return None
+
+
+def fileKey(path):
+    # Identifies a file across renames, such as the .original rename of outputPath
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+def fileSize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class ScratchArea:
+    """Fast local directory conversions are staged in.
+
+    Every job gets its own directory in the scratch directory. Inputs are copied in before ffmpeg reads them, ahead of
+    time for the next queued job with prefetch(), and outputs are written, tagged and optimized there before a single
+    move to their destination. Each staged file reserves its size, or the expected size of an output, against the
+    capacity and the free space of the file system, shared with the other processes through a file each job directory
+    holds locked. A file that does not fit is not staged and the job uses its original paths instead. Job directories of processes that died are removed, except those holding a converted
+    output that was never moved to its destination."""
+
+    def __init__(self, path, capacity=None, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.path = path
+        self.capacity = capacity
+        self.reservations = {}
+        self.locks = {}
+        self.prefetched = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.cleaned = False
+
+    def clean(self):
+        # Remove the job directories left behind by processes that died
+        self.cleaned = True
+        if os.name == 'nt':
+            return
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            try:
+                pid = int(name.split('-')[0])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not alive(pid):
+                path = os.path.join(self.path, name)
+                destination = self.destination(path)
+                if destination:
+                    # A converted output may be the only copy left, it is kept for the user to recover
+                    self.log.warning("Keeping %s, converted for %s by a process that died before moving it there." % (path, destination))
+                    continue
+                self.log.debug("Removing stale scratch directory %s." % name)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def destination(self, workspace):
+        # Destination of the converted output in a job directory, None if it holds none
+        try:
+            with open(os.path.join(workspace, DESTINATION), 'r') as f:
+                return f.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def keep(self, staged, destination):
+        # Mark a staged output as converted so clean does not remove it before it is published
+        try:
+            with open(os.path.join(os.path.dirname(staged), DESTINATION), 'w') as f:
+                f.write(destination)
+        except (IOError, OSError):
+            self.log.exception("Unable to record the destination of %s." % staged)
+
+    def workspace(self):
+        # New directory for the files of one job
+        if not self.cleaned:
+            self.clean()
+        path = os.path.join(self.path, "%d-%d" % (os.getpid(), next(self.counter)))
+        os.makedirs(path)
+        return path
+
+    def used(self):
+        with self.lock:
+            return sum(self.reservations.values())
+
+    def locked(self, function, *args):
+        # Run function holding the lock of this process and, where there is one, the lock file of the scratch directory
+        with self.lock:
+            if fcntl is None:
+                return function(*args)
+            with open(os.path.join(self.path, '.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    return function(*args)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def others(self):
+        # Bytes reserved and already written by the staged files of the other processes
+        reserved = written = 0
+        if fcntl is None:
+            return reserved, written
+        for name in os.listdir(self.path):
+            workspace = os.path.join(self.path, name)
+            if name.startswith('.') or name.split('-')[0] == str(os.getpid()) or not held(os.path.join(workspace, RESERVED)):
+                continue
+            try:
+                with open(os.path.join(workspace, RESERVED), 'r') as f:
+                    filename, size = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            reserved += size
+            written += fileSize(os.path.join(workspace, filename))
+        return reserved, written
+
+    def reserve(self, path, size):
+        # Reserve size bytes for path, False when they do not fit
+        def reserve():
+            otherReserved, otherWritten = self.others()
+            reserved = sum(self.reservations.values()) + otherReserved
+            if self.capacity and reserved + size > self.capacity:
+                self.log.info("Scratch capacity of %dMB is used up (%dMB reserved), not staging %s." % (self.capacity // 1048576, reserved // 1048576, os.path.basename(path)))
+                return False
+            free = freeSpace(self.path)
+            # Reservations not written yet still show up as free space
+            pending = max(0, reserved - sum(fileSize(p) for p in self.reservations) - otherWritten)
+            if free is not None and free - FREE_MARGIN - pending < size:
+                self.log.info("Not enough free space on %s to stage %s." % (self.path, os.path.basename(path)))
+                return False
+            if fcntl is not None:
+                f = lockFile(os.path.join(os.path.dirname(path), RESERVED))
+                json.dump([os.path.basename(path), size], f)
+                f.flush()
+                self.locks[path] = f
+            self.reservations[path] = size
+            return True
+        try:
+            return self.locked(reserve)
+        except (IOError, OSError):
+            self.log.exception("Unable to reserve scratch space for %s, not staging it." % os.path.basename(path))
+            return False
+
+    def release(self, path):
+        # Remove a staged file if it is still there and free its reservation
+        if path is None:
+            return
+        with self.lock:
+            self.reservations.pop(path, None)
+            lock = self.locks.pop(path, None)
+        if lock is not None:
+            unlock(lock)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            marker = os.path.join(os.path.dirname(path), DESTINATION)
+            if os.path.exists(marker):
+                os.remove(marker)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def copyIn(self, inputfile):
+        # Local copy of an input, None if it does not fit or cannot be copied
+        workspace = self.workspace()
+        staged = os.path.join(workspace, os.path.basename(inputfile))
+        if not self.reserve(staged, fileSize(inputfile)):
+            os.rmdir(workspace)
+            return None
+        try:
+            shutil.copyfile(inputfile, staged)
+        except (IOError, OSError):
+            self.log.exception("Unable to stage %s on %s." % (inputfile, self.path))
+            self.release(staged)
+            return None
+        self.log.debug("Staged %s as %s." % (inputfile, staged))
+        return staged
+
+    def stage(self, inputfile):
+        """Return the local copy of an input, prefetched or copied now, None if it cannot be staged."""
+        key = fileKey(inputfile)
+        with self.lock:
+            entry = self.prefetched.pop(key, None)
+        if entry is not None:
+            entry[0].wait()
+            if entry[1] is not None:
+                return entry[1]
+        return self.copyIn(inputfile)
+
+    def prefetch(self, inputfile):
+        # Copy an input in the background for a job that starts later
+        key = fileKey(inputfile)
+        if key is None:
+            return
+        with self.lock:
+            if key in self.prefetched:
+                return
+            entry = self.prefetched[key] = [threading.Event(), None]
+
+        def copy():
+            try:
+                entry[1] = self.copyIn(inputfile)
+            except Exception:
+                self.log.exception("Unable to prefetch %s." % inputfile)
+            finally:
+                entry[0].set()
+        thread = threading.Thread(target=copy, name="prefetch-%s" % os.path.basename(inputfile))
+        thread.daemon = True
+        thread.start()
+
+    def discard(self, inputfile):
+        # Drop a prefetched copy that was never staged
+        with self.lock:
+            entry = self.prefetched.pop(fileKey(inputfile), None)
+        if entry is not None:
+            entry[0].wait()
+            self.release(entry[1])
+
+    def outputPath(self, outputfile, size):
+        """Return where to write an output bound for outputfile, None if size bytes do not fit."""
+        workspace = self.workspace()
+        staged = os.path.join(workspace, os.path.basename(outputfile))
+        if not self.reserve(staged, size):
+            os.rmdir(workspace)
+            return None
+        return staged
+
+
+# Scratch areas of the process by directory, shared by every converter
+scratchAreas = {}
+scratchLock = threading.Lock()
+
+
+def scratchArea(path, capacity=None, logger=None):
+    """Return the ScratchArea of a scratch directory with capacity in bytes, None without a directory."""
+    if not path:
+        return None
+    with scratchLock:
+        scratch = scratchAreas.get(path)
+        if scratch is None:
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    (logger or logging.getLogger(__name__)).exception("Unable to create scratch directory %s, files are not staged." % path)
+                    return None
+            scratch = scratchAreas[path] = ScratchArea(path, capacity, logger)
+    return scratch
@@ -0,0 +1,85 @@
+import logging
+
+# MkvtoMp4 attribute -> ReadSettings attribute
+PROFILE_ATTRIBUTES = [('FFMPEG_PATH', 'ffmpeg'), ('FFPROBE_PATH', 'ffprobe'), ('threads', 'threads'), ('vsync', 'vsync'),
+                      ('delete', 'delete'), ('output_extension', 'output_extension'), ('output_format', 'output_format'),
+                      ('output_dir', 'output_dir'), ('create_subdirectories', 'create_subdirectories'), ('relocate_moov', 'relocate_moov'),
+                      ('processMP4', 'processMP4'), ('forceConvert', 'forceConvert'), ('profile_hash', 'profile_hash'),
+                      ('copyto', 'copyto'), ('moveto', 'moveto'), ('permissions', 'permissions'), ('preopts', 'preopts'),
+                      ('postopts', 'postopts'), ('stall_fraction', 'stall_fraction'), ('stall_window', 'stall_window'),
+                      ('stall_retries', 'stall_retries'), ('resources', 'resources'), ('resource_cgroup', 'resource_cgroup'),
+                      ('preempt', 'preempt'), ('scratch_dir', 'scratch_dir'), ('scratch_size', 'scratch_size'),
+                      ('min_free_space', 'min_free_space'),
+                      # Video settings
+                      ('video_codec', 'vcodec'), ('video_bitrate_restriction', 'video_bitrate_restriction'), ('video_bitrate', 'vbitrate'),
+                      ('video_conversion_priority', 'vpriority'), ('vcrf', 'vcrf'), ('video_width', 'vwidth'), ('nvenc_profile', 'nvenc_profile'),
+                      ('nvenc_preset', 'nvenc_preset'), ('qmin', 'qmin'), ('qmax', 'qmax'), ('global_quality', 'global_quality'),
+                      ('maxrate', 'maxrate'), ('minrate', 'minrate'), ('bufsize', 'bufsize'), ('nvenc_gpu', 'nvenc_gpu'),
+                      ('nvenc_temporal_aq', 'nvenc_temporal_aq'), ('nvenc_weighted_prediction', 'nvenc_weighted_prediction'),
+                      ('nvenc_rate_control', 'nvenc_rate_control'), ('nvenc_rc_lookahead', 'nvenc_rc_lookahead'),
+                      ('handle_m2ts_files', 'handle_m2ts_files'), ('video_profile', 'vprofile'), ('h264_level', 'h264_level'),
+                      ('qsv_decoder', 'qsv_decoder'), ('hevc_qsv_decoder', 'hevc_qsv_decoder'), ('dxva2_decoder', 'dxva2_decoder'),
+                      ('nvenc_cuvid', 'nvenc_cuvid'), ('nvenc_cuvid_hevc', 'nvenc_cuvid_hevc'), ('nvenc_decoder_gpu', 'nvenc_decoder_gpu'),
+                      ('nvenc_decoder_hevc_gpu', 'nvenc_decoder_hevc_gpu'), ('nvenc_hwaccel_enabled', 'nvenc_hwaccel_enabled'),
+                      ('burn_in_forced_subs', 'burn_in_forced_subs'), ('pix_fmt', 'pix_fmt'),
+                      # Audio settings
+                      ('audio_codec', 'acodec'), ('audio_bitrate', 'abitrate'), ('audio_filter', 'afilter'), ('iOS', 'iOS'),
+                      ('iOSFirst', 'iOSFirst'), ('iOSLast', 'iOSLast'), ('iOS_filter', 'iOSfilter'), ('maxchannels', 'maxchannels'),
+                      ('awl', 'awl'), ('adl', 'adl'), ('aac_adtstoasc', 'aac_adtstoasc'), ('audio_copyoriginal', 'audio_copyoriginal'),
+                      ('sample_rate', 'sample_rate'),
+                      # Subtitle settings
+                      ('scodec', 'scodec'), ('swl', 'swl'), ('sdl', 'sdl'), ('downloadsubs', 'downloadsubs'),
+                      ('subproviders', 'subproviders'), ('embedsubs', 'embedsubs'), ('embedonlyinternalsubs', 'embedonlyinternalsubs'),
+                      ('subencoding', 'subencoding'), ('opensubtitles', 'opensubtitles'), ('podnapisi', 'podnapisi')]
+# Settings holding "max width, value, max width, value, ..." resolution tables
+RATE_TABLES = ['video_bitrate_restriction', 'maxrate', 'minrate', 'bufsize']
+
+
+class SettingsProfile(object):
+    """Immutable, precompiled MP4 settings shared by every MkvtoMp4 instance built from the same ReadSettings.
+
+    List settings are stored as tuples and the resolution tables are parsed into (max width, value) pairs once,
+    so building a converter or looking up a rate does no parsing."""
+
+    def __init__(self, values, logger=None):
+        log = logger or logging.getLogger(__name__)
+        for key, value in values.items():
+            if isinstance(value, list):
+                value = tuple(value)
+            self.__dict__[key] = value
+
+        tables = {}
+        for name in RATE_TABLES:
+            table = []
+            entries = values.get(name) or []
+            for i in range(1, len(entries), 2):
+                try:
+                    table.append((int(entries[i - 1]), entries[i]))
+                except ValueError:
+                    log.error("Invalid %s entry %s, ignoring it." % (name, entries[i - 1]))
+            tables[name] = tuple(table)
+        self.__dict__['rate_tables'] = tables
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings profiles are immutable, cannot set %s." % name)
+
+    def __delattr__(self, name):
+        raise AttributeError("Settings profiles are immutable, cannot delete %s." % name)
+
+    def rate(self, name, width):
+        # Value of the first entry of a resolution table whose max width fits width, None if no entry does
+        for max_width, value in self.rate_tables.get(name, ()):
+            if max_width >= width:
+                return value
+        return None
+
+
+def compileProfile(settings, logger=None):
+    """Return the SettingsProfile of a ReadSettings object, compiling it on first use."""
+    profile = getattr(settings, 'compiled', None)
+    if profile is None:
+        values = dict((attribute, getattr(settings, name)) for attribute, name in PROFILE_ATTRIBUTES)
+        values['vtwopass'] = False
+        profile = SettingsProfile(values, logger)
+        settings.compiled = profile
+    return profile
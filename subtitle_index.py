@@ -0,0 +1,101 @@
+import os
+import logging
+import threading
+from extensions import valid_subtitle_extensions
+
+
+class SubtitleCandidate:
+    # External subtitle file found next to a video
+    __slots__ = ('path', 'language', 'forced')
+
+    def __init__(self, path, language, forced=False):
+        self.path = path
+        self.language = language
+        self.forced = forced
+
+
+class SubtitleIndex:
+    """Index of the external subtitle files under a directory.
+
+    Each directory tree is walked once and every subtitle file is filed under the base name of the video it belongs to,
+    so all the videos of a season pack look their subtitles up without walking the tree again. The index of a directory
+    is rebuilt when the modification time of any directory in its tree changes, such as a Subs folder gaining a file,
+    or when it is invalidated, e.g. after downloading subtitles."""
+
+    def __init__(self, max_dirs=32, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.max_dirs = max_dirs
+        self.lock = threading.RLock()
+        self.dirs = {}
+        self.order = []
+
+    def parse(self, fname):
+        # Split a subtitle file name into (video base name, language, forced), None if it is not a subtitle
+        subname, subextension = os.path.splitext(fname)
+        if subextension[1:] not in valid_subtitle_extensions:
+            return None
+        forced = False
+        if subname.lower().endswith('.forced'):
+            forced = True
+            subname = subname[:-len('.forced')]
+        base, lang = os.path.splitext(subname)
+        return base, lang[1:], forced
+
+    def build(self, directory):
+        # Returns the index and the directories of the tree it was built from
+        index = {}
+        dirs = []
+        count = 0
+        for dirName, subdirList, fileList in os.walk(directory):
+            dirs.append(dirName)
+            for fname in fileList:
+                parsed = self.parse(fname)
+                if parsed is None:
+                    continue
+                base, lang, forced = parsed
+                index.setdefault(base, []).append(SubtitleCandidate(os.path.join(dirName, fname), lang, forced))
+                count += 1
+        self.log.debug("Indexed %d subtitle files under %s." % (count, directory))
+        return index, dirs
+
+    def mtimes(self, dirs):
+        # Modification times of the directories of a tree, adding or removing a file or subdirectory changes one of them
+        stamps = []
+        for d in dirs:
+            try:
+                stamps.append(os.path.getmtime(d))
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def lookup(self, directory, filename):
+        # Return the subtitle candidates for the video named filename (without extension) under directory
+        directory = os.path.abspath(directory)
+        with self.lock:
+            cached = self.dirs.get(directory)
+            if cached is None or self.mtimes(cached[2]) != cached[0]:
+                index, dirs = self.build(directory)
+                cached = (self.mtimes(dirs), index, dirs)
+                self.dirs[directory] = cached
+                if directory in self.order:
+                    self.order.remove(directory)
+                self.order.append(directory)
+                while len(self.order) > self.max_dirs:
+                    self.dirs.pop(self.order.pop(0), None)
+            # Sidecars may have been removed by an earlier file of the batch
+            return [c for c in cached[1].get(filename, []) if os.path.exists(c.path)]
+
+    def invalidate(self, directory):
+        with self.lock:
+            directory = os.path.abspath(directory)
+            self.dirs.pop(directory, None)
+            if directory in self.order:
+                self.order.remove(directory)
+
+
+# Shared by every MkvtoMp4 instance in the process
+subtitleIndex = SubtitleIndex()
@@ -0,0 +1,199 @@
+import os
+import io
+import logging
+import threading
+import datetime
+from subtitle_index import subtitleIndex
+from preemption import privateDirectory, makePrivate
+
+try:
+    import subliminal
+    from subliminal.providers import Provider
+    from subliminal.subtitle import Subtitle
+    from babelfish import Language, LANGUAGES
+except ImportError:
+    subliminal = None
+
+# Persistent dogpile cache shared by every process of the user, so provider lookups survive restarts. dogpile pickles
+# its values, so the file lives in a directory no other user can write to
+CACHE_DIRECTORY = privateDirectory("mp4_automator-subliminal")
+CACHE_FILE = os.path.join(CACHE_DIRECTORY, "subliminal.dbm")
+# Number of videos sent to subliminal in a single download_best_subtitles call
+BATCH_SIZE = 8
+
+configured = False
+configure_lock = threading.Lock()
+
+
+def configure(logger=None):
+    # Configure the subliminal cache region and the local provider once per process
+    global configured
+    log = logger or logging.getLogger(__name__)
+    with configure_lock:
+        if configured or subliminal is None:
+            return
+        configured = True
+        try:
+            makePrivate(CACHE_DIRECTORY)
+            subliminal.region.configure('dogpile.cache.dbm', expiration_time=datetime.timedelta(days=30), arguments={'filename': CACHE_FILE})
+        except Exception:
+            log.debug("Unable to configure the persistent subliminal cache, falling back to memory.")
+            try:
+                subliminal.region.configure('dogpile.cache.memory')
+            except Exception:
+                pass
+        try:
+            subliminal.provider_manager.register('local = subtitle_prefetch:LocalProvider')
+        except Exception:
+            log.debug("Unable to register the local subtitle provider.")
+
+
+def scanVideo(path):
+    try:
+        return subliminal.scan_video(path, subtitles=True, embedded_subtitles=True)
+    except TypeError:
+        # Newer versions of subliminal scan existing subtitles separately
+        return subliminal.scan_video(path)
+
+
+def downloadSubtitles(paths, languages, providers, provider_configs, min_score=337, logger=None):
+    # Download and save the best subtitles for several videos with a single subliminal call
+    log = logger or logging.getLogger(__name__)
+    configure(log)
+    videos = []
+    for path in paths:
+        try:
+            videos.append(scanVideo(os.path.abspath(path)))
+        except Exception:
+            log.debug("Unable to scan %s for subtitles." % path, exc_info=True)
+    if not videos:
+        return
+    try:
+        subtitles = subliminal.download_best_subtitles(videos, languages, hearing_impaired=False, min_score=min_score, providers=providers, provider_configs=provider_configs)
+    except TypeError:
+        # Newer versions of subliminal no longer take hearing_impaired
+        subtitles = subliminal.download_best_subtitles(videos, languages, min_score=min_score, providers=providers, provider_configs=provider_configs)
+    for video in videos:
+        try:
+            subliminal.save_subtitles(video, subtitles[video])
+        except:
+            # Support for older versions of subliminal
+            subliminal.save_subtitles(subtitles)
+            log.info("Please update to the latest version of subliminal.")
+            break
+    # Pick up the new files on the next lookup
+    for path in paths:
+        subtitleIndex.invalidate(os.path.dirname(os.path.abspath(path)))
+
+
+class SubtitlePrefetcher:
+    """Downloads subtitles for queued videos in the background.
+
+    Videos are sent to subliminal in batches of BATCH_SIZE so one provider session serves many files, while each video
+    can be waited on as soon as its own batch is saved."""
+
+    def __init__(self, logger=None):
+        if logger:
+            self.log = logger
+        else:
+            self.log = logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.pending = []
+        self.events = {}
+        self.worker = None
+
+    def prefetch(self, paths, languages, providers, provider_configs, min_score=337):
+        # Queue videos and start the background worker if it is not running
+        if subliminal is None or not languages or not providers:
+            return
+        with self.lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                if path not in self.events:
+                    self.events[path] = threading.Event()
+                    self.pending.append(path)
+            self.options = (languages, providers, provider_configs, min_score)
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run)
+                self.worker.daemon = True
+                self.worker.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                batch = self.pending[:BATCH_SIZE]
+                del self.pending[:BATCH_SIZE]
+                options = self.options
+                if not batch:
+                    self.worker = None
+                    return
+            self.log.info("Prefetching subtitles for %d files." % len(batch))
+            try:
+                downloadSubtitles(batch, *options, logger=self.log)
+            except Exception:
+                self.log.info("Unable to prefetch subtitles.", exc_info=True)
+            for path in batch:
+                self.events[path].set()
+
+    def wait(self, path, timeout=None):
+        # Block until the subtitles of path were prefetched, returns False if path was never queued
+        event = self.events.get(os.path.abspath(path))
+        if event is None:
+            return False
+        event.wait(timeout)
+        return event.is_set()
+
+
+if subliminal is not None:
+    class LocalSubtitle(Subtitle):
+        provider_name = 'local'
+
+        def __init__(self, language, path):
+            super(LocalSubtitle, self).__init__(language)
+            self.path = path
+
+        @property
+        def id(self):
+            return self.path
+
+        def get_matches(self, video, hearing_impaired=False):
+            # A file named after the video is treated as a hash match
+            return set(['hash'])
+
+    class LocalProvider(Provider):
+        """Offline provider serving <video name>.<language>.srt files from a local directory.
+
+        The directory is the provider config 'directory' or the LOCAL_SUBTITLES_DIR environment variable, which makes
+        the download path testable without network access."""
+        languages = set(Language(l) for l in LANGUAGES)
+
+        def __init__(self, directory=None):
+            self.directory = directory or os.environ.get('LOCAL_SUBTITLES_DIR')
+
+        def initialize(self):
+            pass
+
+        def terminate(self):
+            pass
+
+        def list_subtitles(self, video, languages):
+            subtitles = []
+            if not self.directory or not os.path.isdir(self.directory):
+                return subtitles
+            base = os.path.splitext(os.path.basename(video.name))[0]
+            for language in languages:
+                for code in (getattr(language, 'alpha2', None), language.alpha3):
+                    path = os.path.join(self.directory, "%s.%s.srt" % (base, code)) if code else None
+                    if path and os.path.isfile(path):
+                        subtitles.append(LocalSubtitle(language, path))
+                        break
+            return subtitles
+
+        def download_subtitle(self, subtitle):
+            with io.open(subtitle.path, 'rb') as f:
+                subtitle.content = f.read()
+
+
+# Shared by every MkvtoMp4 instance in the process
+subtitlePrefetcher = SubtitlePrefetcher()
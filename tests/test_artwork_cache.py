@@ -0,0 +1,68 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from artwork_cache import ArtworkCache
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+
+class ArtworkCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ArtworkCache(os.path.join(self.directory, 'cache'), max_size=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def poster(self, name, size):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(name.encode('ascii') * (size // len(name)))
+        return 'file:' + pathname2url(path)
+
+    def test_cached_by_url(self):
+        url = self.poster('a.jpg', 100)
+        path = self.cache.fetch(url)
+        self.assertTrue(os.path.isfile(path))
+        os.remove(os.path.join(self.directory, 'a.jpg'))
+        self.assertEqual(self.cache.fetch(url), path)
+
+    def test_poster_larger_than_the_cache_is_returned(self):
+        path = self.cache.fetch(self.poster('big.jpg', 5000))
+        self.assertTrue(os.path.isfile(path))
+
+    def test_least_recently_used_is_evicted_before_storing(self):
+        first = self.cache.fetch(self.poster('a.jpg', 400))
+        time.sleep(0.01)
+        second = self.cache.fetch(self.poster('b.jpg', 400))
+        time.sleep(0.01)
+        third = self.cache.fetch(self.poster('c.jpg', 400))
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.isfile(second))
+        self.assertTrue(os.path.isfile(third))
+
+    def test_names_outside_the_cache_are_ignored(self):
+        victim = os.path.join(self.directory, 'victim')
+        open(victim, 'w').close()
+        url = self.poster('a.jpg', 100)
+        conn = self.cache.connect()
+        with conn:
+            conn.execute("INSERT INTO urls (url, name, stored) VALUES (?, ?, ?)", (url, '../victim', time.time()))
+            conn.execute("INSERT INTO files (name, size, accessed) VALUES (?, ?, ?)", ('../victim', 10000, 0))
+        path = self.cache.fetch(url)
+        self.assertEqual(os.path.dirname(path), self.cache.directory)
+        self.assertTrue(os.path.exists(victim))
+
+    def test_shared_directory_is_not_used(self):
+        os.makedirs(self.cache.directory)
+        os.chmod(self.cache.directory, 0o777)
+        self.assertIsNone(self.cache.fetch(self.poster('a.jpg', 100)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import disk_space
+from disk_space import SpaceLedger, parseRate, predictSize, spaceNeeds, written, CONTAINER_OVERHEAD, AUDIO_CHANNEL_RATE, STALE_AFTER
+from scratch_area import freeSpace
+
+
+class Info:
+    def __init__(self, duration=100.0, bitrate=5000000, audio=((1, 192000, 2),)):
+        self.format = Info.Format(duration, bitrate)
+        self.audio = [Info.Audio(index, rate, channels) for index, rate, channels in audio]
+
+    class Format:
+        def __init__(self, duration, bitrate):
+            self.duration = duration
+            self.bitrate = bitrate
+
+    class Audio:
+        def __init__(self, index, bitrate, channels):
+            self.index = index
+            self.bitrate = bitrate
+            self.audio_channels = channels
+
+
+def bytesOf(kbps, duration=100.0):
+    return int(kbps * 1000 / 8 * duration * CONTAINER_OVERHEAD)
+
+
+class PredictSizeTest(unittest.TestCase):
+    def test_parse_rate(self):
+        self.assertEqual(parseRate('8000k'), 8000)
+        self.assertEqual(parseRate('8M'), 8000)
+        self.assertEqual(parseRate(192), 192)
+        self.assertIsNone(parseRate(None))
+        self.assertIsNone(parseRate('fast'))
+
+    def test_remux_keeps_source_size(self):
+        options = {'video': {'codec': 'copy'}, 'audio': {0: {'codec': 'copy', 'map': 1}}}
+        self.assertEqual(predictSize(options, Info(), 12345), 12345)
+
+    def test_unknown_duration(self):
+        options = {'video': {'codec': 'h264', 'bitrate': 2000}, 'audio': {}}
+        self.assertEqual(predictSize(options, Info(duration=None), 12345), 12345)
+
+    def test_encoded_streams(self):
+        options = {'video': {'codec': 'h264', 'bitrate': 2000}, 'audio': {0: {'codec': 'aac', 'bitrate': 128, 'map': 1}}}
+        self.assertEqual(predictSize(options, Info(), 0), bytesOf(2128))
+
+    def test_maxrate_caps_the_video(self):
+        options = {'video': {'codec': 'h264', 'bitrate': 2000, 'maxrate': '3M'}, 'audio': {}}
+        self.assertEqual(predictSize(options, Info(), 0), bytesOf(3000))
+
+    def test_copied_video_and_audio_without_bitrate(self):
+        options = {'video': {'codec': 'copy'}, 'audio': {0: {'codec': 'ac3', 'channels': 6, 'map': 1}}}
+        video = (5000000 - 192000) / 1000.0 * .95
+        self.assertEqual(predictSize(options, Info(), 0), bytesOf(video + 6 * AUDIO_CHANNEL_RATE))
+
+
+class SpaceLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ledger = SpaceLedger(os.path.join(self.directory, 'ledger'))
+        self.output = os.path.join(self.directory, 'out.mp4')
+        # Room for a single 600kB output
+        self.margin = freeSpace(self.directory) - 1000000
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reservations(self):
+        return sorted(name for name in os.listdir(self.ledger.path) if not name.startswith('.'))
+
+    def test_reserve_and_release(self):
+        reservation = self.ledger.reserve(spaceNeeds(600000, [self.output]), self.margin, 'a')
+        self.assertTrue(reservation)
+        self.assertEqual(self.reservations(), [os.path.basename(reservation)])
+        with open(reservation, 'r') as f:
+            self.assertEqual(json.load(f)[0][2], 600000)
+        self.ledger.release(reservation)
+        self.assertEqual(self.reservations(), [])
+
+    def test_reservations_count_against_free_space(self):
+        first = self.ledger.reserve(spaceNeeds(600000, [self.output]), self.margin, 'a')
+        self.assertTrue(first)
+        self.assertFalse(self.ledger.reserve(spaceNeeds(600000, [self.output + '2']), self.margin, 'b'))
+        # Another ledger is another process as far as the locks go
+        self.assertFalse(SpaceLedger(self.ledger.path).reserve(spaceNeeds(600000, [self.output + '2']), self.margin, 'b'))
+        self.ledger.release(first)
+        self.assertTrue(self.ledger.reserve(spaceNeeds(600000, [self.output + '2']), self.margin, 'b'))
+
+    def test_amend(self):
+        reservation = self.ledger.reserve(spaceNeeds(600000, [self.output]), self.margin, 'a')
+        self.assertTrue(self.ledger.amend(reservation, spaceNeeds(900000, [self.output]), self.margin, 'a'))
+        self.assertFalse(self.ledger.amend(reservation, spaceNeeds(2000000, [self.output]), self.margin, 'a'))
+        with open(reservation, 'r') as f:
+            self.assertEqual(json.load(f)[0][2], 900000)
+
+    def test_unlocked_reservation_is_removed(self):
+        os.makedirs(self.ledger.path, 0o700)
+        planted = os.path.join(self.ledger.path, '1-0')
+        with open(planted, 'w') as f:
+            json.dump(spaceNeeds(freeSpace(self.directory) * 2, [self.output]), f)
+        self.assertTrue(self.ledger.reserve(spaceNeeds(10, [self.output]), 0, 'a'))
+        self.assertFalse(os.path.exists(planted))
+
+    @unittest.skipIf(disk_space.fcntl is None, "no file locks")
+    def test_stale_reservation_no_longer_counts(self):
+        needs = spaceNeeds(600000, [self.output])
+        for entry in needs:
+            entry[3] -= STALE_AFTER + 60
+        hung = SpaceLedger(self.ledger.path)
+        reservation = hung.reserve(needs, self.margin, 'hung')
+        self.assertTrue(reservation)
+        self.assertTrue(self.ledger.reserve(spaceNeeds(600000, [self.output + '2']), self.margin, 'a'))
+        # Still held, it is kept for when its process moves on
+        self.assertTrue(os.path.exists(reservation))
+        hung.release(reservation)
+
+    def test_written_bytes_are_not_pending(self):
+        since = time.time()
+        with open(self.output, 'wb') as f:
+            f.write(b'0' * 400)
+        self.assertEqual(written(self.output, since), 400)
+        self.assertEqual(self.ledger.pending([[self.output, None, 1000, since]]), 600)
+        # A file from before the reservation is going to be replaced
+        self.assertEqual(self.ledger.pending([[self.output, None, 1000, since + 60]]), 1000)
+
+    def test_shared_directory_is_not_used(self):
+        os.makedirs(self.ledger.path)
+        os.chmod(self.ledger.path, 0o777)
+        self.assertIsNone(self.ledger.reserve(spaceNeeds(10, [self.output]), 0, 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
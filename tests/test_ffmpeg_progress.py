@@ -0,0 +1,50 @@
+import unittest
+from converter.ffmpeg import parse_progress, OutputMonitor, FRAME_TIMEOUT
+
+LINE = "frame= 1200 fps= 48 q=28.0 size=   10240kB time=00:01:02.50 bitrate=1342.2kbits/s speed=1.93x "
+
+
+class ParseProgressTest(unittest.TestCase):
+    def test_progress_line(self):
+        progress = parse_progress(LINE)
+        self.assertEqual(progress['frame'], 1200)
+        self.assertEqual(progress['fps'], '48')
+        self.assertEqual(progress['q'], '28.0')
+        self.assertAlmostEqual(progress['time'], 62.5)
+        self.assertEqual(progress['speed'], '1.93x')
+        self.assertEqual(progress['bitrate'], '1342.2kbits/s')
+
+    def test_hours(self):
+        self.assertAlmostEqual(parse_progress("time=01:00:01.00 ")['time'], 3601.0)
+
+    def test_other_output(self):
+        progress = parse_progress("Stream mapping:")
+        self.assertEqual(set(progress.values()), set([None]))
+
+
+class OutputMonitorTest(unittest.TestCase):
+    def test_dts(self):
+        monitor = OutputMonitor()
+        self.assertTrue(monitor.timestamps("[mp4 @ 0x1] Non-monotonous DTS in output stream 0:1"))
+        self.assertFalse(monitor.timestamps("Queue input is backward in time"))
+        self.assertFalse(monitor.timestamps("[mp4 @ 0x1] Non-monotonous DTS in output stream 0:1"))
+
+    def test_stuck_frame(self):
+        monitor = OutputMonitor()
+        self.assertFalse(monitor.stuck({'frame': 10}, 1000.0))
+        self.assertFalse(monitor.stuck({'frame': 10}, 1001.0))
+        self.assertFalse(monitor.stuck({'frame': 10}, 1001.0 + FRAME_TIMEOUT))
+        self.assertTrue(monitor.stuck({'frame': 10}, 1002.0 + FRAME_TIMEOUT))
+
+    def test_progressing_and_suspended(self):
+        monitor = OutputMonitor()
+        monitor.stuck({'frame': 10}, 1000.0)
+        monitor.stuck({'frame': 10}, 1001.0)
+        monitor.shift(FRAME_TIMEOUT)
+        self.assertFalse(monitor.stuck({'frame': 10}, 1002.0 + FRAME_TIMEOUT))
+        self.assertFalse(monitor.stuck({'frame': 11}, 1000.0 + 3 * FRAME_TIMEOUT))
+        self.assertFalse(monitor.stuck({'frame': None}, 1000.0 + 4 * FRAME_TIMEOUT))
+
+
+if __name__ == '__main__':
+    unittest.main()
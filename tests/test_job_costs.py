@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+from job_events import JobEvents
+from job_costs import CostModel, MIN_SAMPLES, JOB_OVERHEAD
+from converter.watchdog import expected_speed
+
+
+def features(codec='h264', width=1920, height=1080, preset='medium', source_codec='mpeg2video', duration=600.0):
+    return {'duration': duration, 'width': width, 'height': height, 'source_codec': source_codec, 'codec': codec,
+            'copy': codec == 'copy', 'preset': preset, 'hwaccel': False}
+
+
+class CostModelTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.events = JobEvents(os.path.join(self.directory, 'events.jsonl'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_without_history(self):
+        model = CostModel(self.events)
+        self.assertEqual(model.speed(features()), expected_speed('h264', 1920, 1080))
+        self.assertEqual(model.speed(features('copy')), expected_speed('copy'))
+
+    def test_exact_combination(self):
+        model = CostModel(self.events)
+        for i in range(MIN_SAMPLES):
+            model.add(features(), 300.0)
+        model.add(features(preset='slow'), 600.0)
+        self.assertAlmostEqual(model.speed(features()), 2.0)
+
+    def test_falls_back_to_general_combination(self):
+        model = CostModel(self.events)
+        for i in range(MIN_SAMPLES):
+            model.add(features(preset='slow'), 600.0)
+        model.add(features(preset='fast'), 100.0)
+        # Not enough fast samples, the speed of every h264 encode at this resolution
+        self.assertAlmostEqual(model.speed(features(preset='fast')), 2400.0 / 1900.0)
+
+    def test_mode_alone_with_one_sample(self):
+        model = CostModel(self.events)
+        model.add(features(width=3840, height=2160), 1200.0)
+        self.assertAlmostEqual(model.speed(features(width=720, height=480)), 0.5)
+
+    def test_ignores_invalid_jobs(self):
+        model = CostModel(self.events)
+        model.add(features(duration=0), 100.0)
+        model.add(features(), None)
+        self.assertEqual(model.speed(features()), expected_speed('h264', 1920, 1080))
+
+    def test_learns_from_history(self):
+        for i in range(MIN_SAMPLES):
+            CostModel(self.events).record('a.mkv', features(), 150.0)
+        model = CostModel(self.events)
+        self.assertAlmostEqual(model.speed(features()), 4.0)
+        self.assertAlmostEqual(model.estimate(features()), JOB_OVERHEAD + 150.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
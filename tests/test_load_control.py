@@ -0,0 +1,64 @@
+import unittest
+from load_control import ConcurrencyController, COPY_EXTRA, HOLD_INTERVALS, cpuCount
+
+IDLE = {'load': 0.1, 'cpu': 1.0, 'io': 0.0, 'memory': 0.0}
+BUSY = {'load': 2.0, 'cpu': 80.0, 'io': 0.0, 'memory': 0.0}
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+    def test_idle_machine_raises_up_to_maximum(self):
+        controller = ConcurrencyController(maximum=3)
+        for i in range(5):
+            controller.update(sample=IDLE)
+        self.assertEqual(controller.encodes, 3)
+
+    def test_busy_machine_lowers_down_to_minimum(self):
+        controller = ConcurrencyController(maximum=4)
+        controller.encodes = 4
+        for i in range(5):
+            controller.update(sample=BUSY)
+        self.assertEqual(controller.encodes, 1)
+
+    def test_between_thresholds_holds(self):
+        controller = ConcurrencyController(maximum=4)
+        controller.encodes = 2
+        controller.update(sample={'load': 1.0, 'cpu': 30.0, 'io': 0.0, 'memory': 0.0})
+        self.assertEqual(controller.encodes, 2)
+
+    def test_throughput_drop_undoes_step_and_holds(self):
+        controller = ConcurrencyController(maximum=4)
+        controller.update(10.0, IDLE)
+        self.assertEqual(controller.encodes, 2)
+        controller.update(8.0, IDLE)
+        self.assertEqual(controller.encodes, 1)
+        for i in range(HOLD_INTERVALS):
+            controller.update(8.0, IDLE)
+        self.assertEqual(controller.encodes, 1)
+        controller.update(8.0, IDLE)
+        self.assertEqual(controller.encodes, 2)
+
+    def test_throughput_kept_continues(self):
+        controller = ConcurrencyController(maximum=4)
+        controller.update(10.0, IDLE)
+        controller.update(12.0, IDLE)
+        self.assertEqual(controller.encodes, 3)
+
+    def test_without_load_information(self):
+        controller = ConcurrencyController(maximum=64)
+        controller.update(sample={'load': None, 'cpu': None, 'io': None, 'memory': None})
+        self.assertEqual(controller.encodes, max(1, cpuCount() // 2))
+
+    def test_io_pressure_limits_copies(self):
+        controller = ConcurrencyController(maximum=1)
+        for i in range(COPY_EXTRA + 1):
+            controller.update(sample=dict(IDLE, io=90.0))
+        self.assertEqual(controller.copies, 0)
+        self.assertFalse(controller.admit(True, 1, 0))
+        controller.update(sample=IDLE)
+        self.assertEqual(controller.copies, 1)
+        self.assertTrue(controller.admit(True, 1, 0))
+        self.assertFalse(controller.admit(False, 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
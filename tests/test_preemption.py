@@ -0,0 +1,89 @@
+import os
+import signal
+import shutil
+import tempfile
+import unittest
+import preemption
+from preemption import PreemptionClaims, Preemptor, CHECK_INTERVAL, THROTTLE_PERIOD
+
+
+class Claims:
+    def __init__(self):
+        self.classes = []
+
+    def active(self, priority):
+        return list(self.classes)
+
+
+class PreemptorTest(unittest.TestCase):
+    def setUp(self):
+        self.claims = Claims()
+        self.signals = []
+
+    def preemptor(self, mode='stop'):
+        preemptor = Preemptor('backfill', mode, self.claims)
+        preemptor.signal = lambda signum: self.signals.append(signum) or True
+        preemptor.attach(os.getpid())
+        return preemptor
+
+    def test_not_attached(self):
+        self.claims.classes = ['hook']
+        self.assertFalse(Preemptor('backfill', claims=self.claims).poll(1000.0))
+
+    def test_stop_and_resume(self):
+        preemptor = self.preemptor()
+        self.assertFalse(preemptor.poll(1000.0))
+        self.claims.classes = ['hook']
+        # The claims are only looked at every CHECK_INTERVAL
+        self.assertFalse(preemptor.poll(1000.0 + CHECK_INTERVAL / 2))
+        self.assertTrue(preemptor.poll(1000.0 + CHECK_INTERVAL))
+        self.assertTrue(preemptor.poll(1000.0 + CHECK_INTERVAL * 2))
+        self.claims.classes = []
+        self.assertFalse(preemptor.poll(1000.0 + CHECK_INTERVAL * 11))
+        self.assertEqual(self.signals, [signal.SIGSTOP, signal.SIGCONT])
+        self.assertAlmostEqual(preemptor.elapsed(), CHECK_INTERVAL * 10)
+        self.assertEqual(preemptor.elapsed(), 0.0)
+        self.assertAlmostEqual(preemptor.total, CHECK_INTERVAL * 10)
+
+    def test_throttle(self):
+        preemptor = self.preemptor('throttle')
+        self.claims.classes = ['interactive']
+        start = THROTTLE_PERIOD * 1000
+        # Runs the first quarter of every period
+        self.assertFalse(preemptor.poll(start))
+        self.assertTrue(preemptor.poll(start + THROTTLE_PERIOD * 0.5))
+        self.assertFalse(preemptor.poll(start + THROTTLE_PERIOD * 1.1))
+        self.assertEqual(self.signals, [signal.SIGSTOP, signal.SIGCONT])
+
+
+@unittest.skipUnless(preemption.supported(), "no SIGSTOP or file locks")
+class PreemptionClaimsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.claims = PreemptionClaims(os.path.join(self.directory, 'claims'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_claims_preempt_lower_classes(self):
+        claim = self.claims.claim('hook')
+        self.assertEqual(self.claims.active('backfill'), ['hook'])
+        self.assertEqual(self.claims.active('hook'), [])
+        self.claims.release(claim)
+        self.assertEqual(self.claims.active('backfill'), [])
+        self.assertEqual(os.listdir(self.claims.path), [])
+
+    def test_unlocked_claim_is_removed(self):
+        os.makedirs(self.claims.path, 0o700)
+        open(os.path.join(self.claims.path, 'hook-1-0'), 'w').close()
+        self.assertEqual(self.claims.active('backfill'), [])
+        self.assertEqual(os.listdir(self.claims.path), [])
+
+    def test_shared_directory_is_refused(self):
+        os.makedirs(self.claims.path)
+        os.chmod(self.claims.path, 0o777)
+        self.assertIsNone(self.claims.claim('hook'))
+
+
+if __name__ == '__main__':
+    unittest.main()
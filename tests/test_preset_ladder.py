@@ -0,0 +1,39 @@
+import unittest
+from preset_ladder import PresetLadder
+
+
+class PresetLadderTest(unittest.TestCase):
+    def setUp(self):
+        self.ladder = PresetLadder({'x264': ['slow', 'medium', 'fast'], 'nvenc': ['slow', 'fast'], 'unused': []}, target=3600)
+
+    def test_starts_at_slowest(self):
+        self.assertEqual(self.ladder.preset('h264'), ('slow', 0))
+        self.assertEqual(self.ladder.preset('nvenc_h264'), ('slow', 0))
+        self.assertEqual(self.ladder.preset('copy'), (None, None))
+
+    def test_large_backlog_moves_one_rung_at_a_time(self):
+        self.ladder.update(7200)
+        self.assertEqual(self.ladder.preset('h264'), ('medium', 1))
+        self.ladder.update(7200)
+        self.ladder.update(7200)
+        self.assertEqual(self.ladder.preset('h264'), ('fast', 2))
+        self.assertEqual(self.ladder.preset('nvenc_h265'), ('fast', 1))
+
+    def test_holds_between_half_and_target(self):
+        self.ladder.update(7200)
+        self.ladder.update(3600)
+        self.ladder.update(1800)
+        self.assertEqual(self.ladder.preset('h264'), ('medium', 1))
+
+    def test_small_backlog_moves_back_to_slowest(self):
+        self.ladder.update(7200)
+        self.ladder.update(7200)
+        self.ladder.update(100)
+        self.assertEqual(self.ladder.preset('h264'), ('medium', 1))
+        self.ladder.update(100)
+        self.ladder.update(100)
+        self.assertEqual(self.ladder.preset('h264'), ('slow', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+import scratch_area
+from scratch_area import ScratchArea, DESTINATION
+
+# Reserves 800 bytes of a scratch directory and waits for a line on stdin before exiting
+HOLDER = """import os, sys
+from scratch_area import ScratchArea
+scratch = ScratchArea(sys.argv[1], 1000)
+print(scratch.reserve(os.path.join(scratch.workspace(), 'a.mp4'), 800))
+sys.stdout.flush()
+sys.stdin.readline()
+"""
+
+
+class ScratchAreaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_capacity(self):
+        scratch = ScratchArea(self.directory, 1000)
+        first = scratch.outputPath('/media/a.mp4', 600)
+        self.assertTrue(first)
+        self.assertIsNone(scratch.outputPath('/media/b.mp4', 600))
+        scratch.release(first)
+        self.assertEqual(scratch.used(), 0)
+        self.assertEqual([name for name in os.listdir(self.directory) if not name.startswith('.')], [])
+        self.assertTrue(scratch.outputPath('/media/b.mp4', 600))
+
+    @unittest.skipIf(scratch_area.fcntl is None, "no file locks")
+    def test_capacity_is_shared_with_other_processes(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        holder = subprocess.Popen([sys.executable, '-c', HOLDER, self.directory], cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            self.assertEqual(holder.stdout.readline().strip(), 'True')
+            scratch = ScratchArea(self.directory, 1000)
+            self.assertIsNone(scratch.outputPath('/media/b.mp4', 600))
+        finally:
+            holder.communicate('\n')
+        self.assertTrue(scratch.outputPath('/media/b.mp4', 600))
+
+    def test_clean_keeps_converted_outputs(self):
+        partial = os.path.join(self.directory, '999999-0')
+        converted = os.path.join(self.directory, '999999-1')
+        for workspace in (partial, converted):
+            os.makedirs(workspace)
+            open(os.path.join(workspace, 'a.mp4'), 'w').close()
+        ScratchArea(self.directory).keep(os.path.join(converted, 'a.mp4'), '/media/a.mp4')
+        scratch = ScratchArea(self.directory)
+        scratch_area.alive, alive = (lambda pid: False), scratch_area.alive
+        try:
+            scratch.clean()
+        finally:
+            scratch_area.alive = alive
+        self.assertFalse(os.path.exists(partial))
+        self.assertEqual(scratch.destination(converted), '/media/a.mp4')
+        self.assertTrue(os.path.exists(os.path.join(converted, 'a.mp4')))
+
+    def test_release_removes_the_marker(self):
+        scratch = ScratchArea(self.directory)
+        staged = scratch.outputPath('/media/a.mp4', 10)
+        open(staged, 'w').close()
+        scratch.keep(staged, '/media/a.mp4')
+        scratch.release(staged)
+        self.assertFalse(os.path.exists(os.path.dirname(staged)))
+
+
+if __name__ == '__main__':
+    unittest.main()
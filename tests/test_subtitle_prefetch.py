@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subtitle_prefetch
+from subtitle_prefetch import SubtitlePrefetcher, downloadSubtitles
+from mkvtomp4 import MkvtoMp4
+
+try:
+    import subliminal
+    from babelfish import Language
+except ImportError:
+    subliminal = None
+
+SRT = b"1\n00:00:01,000 --> 00:00:02,000\nHello\n\n"
+
+
+@unittest.skipIf(subliminal is None, "subliminal is not installed")
+class LocalProviderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.subs = os.path.join(self.directory, 'subs')
+        os.makedirs(self.subs)
+        with open(os.path.join(self.subs, 'Show.S01E01.en.srt'), 'wb') as f:
+            f.write(SRT)
+        self.video = os.path.join(self.directory, 'Show.S01E01.mkv')
+        open(self.video, 'wb').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lists_and_downloads_matching_file(self):
+        provider = subtitle_prefetch.LocalProvider(self.subs)
+        subtitles = provider.list_subtitles(subliminal.Video.fromname(self.video), set([Language('eng'), Language('fra')]))
+        self.assertEqual([s.language for s in subtitles], [Language('eng')])
+        provider.download_subtitle(subtitles[0])
+        self.assertEqual(subtitles[0].content, SRT)
+
+    def test_missing_directory(self):
+        provider = subtitle_prefetch.LocalProvider(os.path.join(self.directory, 'none'))
+        self.assertEqual(provider.list_subtitles(subliminal.Video.fromname(self.video), set([Language('eng')])), [])
+
+    def test_batch_download_saves_next_to_video(self):
+        downloadSubtitles([self.video], set([Language('eng')]), ['local'], {'local': {'directory': self.subs}}, min_score=0)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, 'Show.S01E01.en.srt')))
+
+
+class SubtitlePrefetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.download = subtitle_prefetch.downloadSubtitles
+        subtitle_prefetch.downloadSubtitles = lambda paths, *args, **kwargs: self.batches.append(list(paths))
+        self.subliminal = subtitle_prefetch.subliminal
+        subtitle_prefetch.subliminal = self.subliminal or object()
+
+    def tearDown(self):
+        subtitle_prefetch.downloadSubtitles = self.download
+        subtitle_prefetch.subliminal = self.subliminal
+
+    def test_batches(self):
+        prefetcher = SubtitlePrefetcher()
+        paths = [os.path.abspath("video%d.mkv" % i) for i in range(subtitle_prefetch.BATCH_SIZE + 2)]
+        prefetcher.prefetch(paths, set(['eng']), ['local'], {})
+        for path in paths:
+            self.assertTrue(prefetcher.wait(path, 5))
+        self.assertEqual(self.batches, [paths[:subtitle_prefetch.BATCH_SIZE], paths[subtitle_prefetch.BATCH_SIZE:]])
+
+    def test_queued_once(self):
+        prefetcher = SubtitlePrefetcher()
+        prefetcher.prefetch(['a.mkv', 'a.mkv'], set(['eng']), ['local'], {})
+        prefetcher.wait('a.mkv', 5)
+        self.assertEqual(self.batches, [[os.path.abspath('a.mkv')]])
+
+    def test_not_queued(self):
+        self.assertFalse(SubtitlePrefetcher().wait('b.mkv', 0))
+        SubtitlePrefetcher().prefetch(['c.mkv'], set(), ['local'], {})
+        self.assertEqual(self.batches, [])
+
+
+class PrefetchSubtitlesTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.prefetch = subtitle_prefetch.subtitlePrefetcher.prefetch
+        subtitle_prefetch.subtitlePrefetcher.prefetch = lambda *args: self.calls.append(args)
+
+    def tearDown(self):
+        subtitle_prefetch.subtitlePrefetcher.prefetch = self.prefetch
+
+    @unittest.skipIf(subliminal is None, "subliminal is not installed")
+    def test_queues_languages_and_providers(self):
+        MkvtoMp4(swl=['eng'], providers=['local'], downloadsubs=True).prefetchSubtitles(['a.mkv'])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0][0], ['a.mkv'])
+        self.assertEqual(self.calls[0][1], set([Language('eng')]))
+        self.assertEqual(self.calls[0][2], ['local'])
+
+    def test_disabled(self):
+        MkvtoMp4(swl=['eng'], providers=['local'], downloadsubs=False).prefetchSubtitles(['a.mkv'])
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
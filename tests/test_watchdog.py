@@ -0,0 +1,50 @@
+import unittest
+
+from converter.watchdog import StallWatchdog, expected_speed
+from mkvtomp4 import MkvtoMp4
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def converter(fraction=0.1, window=120):
+    # stallWatchdog only reads the stall settings, skip the settings parsing of the constructor
+    c = MkvtoMp4.__new__(MkvtoMp4)
+    c.stall_fraction = fraction
+    c.stall_window = window
+    return c
+
+
+class StallWatchdogTest(unittest.TestCase):
+    def test_slow_encode_is_flagged(self):
+        clock = Clock()
+        w = StallWatchdog(expected_speed('h264', 1920, 1080), fraction=0.1, window=120, clock=clock)
+        clock.now += 200
+        w.update(10.0, 240)
+        self.assertIsNotNone(w.check())
+
+    def test_encode_at_speed_is_healthy(self):
+        clock = Clock()
+        w = StallWatchdog(expected_speed('h264', 1920, 1080), fraction=0.1, window=120, clock=clock)
+        clock.now += 200
+        w.update(300.0, 7200)
+        self.assertIsNone(w.check())
+
+    def test_remux_is_not_watched(self):
+        # A copy from a slow share runs well below any expected remux speed and must not be killed
+        self.assertIsNone(converter().stallWatchdog({'video': {'codec': 'copy'}}))
+
+    def test_encode_is_watched(self):
+        self.assertIsNotNone(converter().stallWatchdog({'video': {'codec': 'h264'}}))
+
+    def test_disabled(self):
+        self.assertIsNone(converter(fraction=0).stallWatchdog({'video': {'codec': 'h264'}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,17 +14,41 @@ try:
 except:
     import json as simplejson
 
+import os
+import time
 import operator
 import requests
 
+try:
+    from tvdb_api.tvdb_cache import SQLiteCache
+    from preemption import privateDirectory, makePrivate
+except ImportError:
+    SQLiteCache = None
+
 config = {}
 
-def configure(api_key, language='en'):
+# Seconds responses are reused for before asking themoviedb.org again
+CONFIG_TTL = 86400
+MOVIE_TTL = 86400
+SEARCH_TTL = 21600
+
+# Keep-alive session shared by every request
+_session = None
+
+def configure(api_key, language='en', cache_location=None):
+    reset = config.get('apikey') != api_key or 'api' not in config
     config['apikey'] = api_key
     config['language'] = language
+    if cache_location is None:
+        # The cached urls contain the api key, keep them where only this user can read them
+        cache_location = privateDirectory("tmdb_api") if SQLiteCache is not None else None
+    if config.get('cache_location') != cache_location:
+        config['cache_location'] = cache_location
+        config['cache'] = None
     config['urls'] = {}
     config['urls']['movie.search'] = "https://api.themoviedb.org/3/search/movie?query=%%s&api_key=%(apikey)s&page=%%s" % (config)
     config['urls']['movie.info'] = "https://api.themoviedb.org/3/movie/%%s?api_key=%(apikey)s" % (config)
+    config['urls']['movie.full'] = "https://api.themoviedb.org/3/movie/%%s?api_key=%(apikey)s&append_to_response=casts,releases" % (config)
     config['urls']['people.search'] = "https://api.themoviedb.org/3/search/person?query=%%s&api_key=%(apikey)s&page=%%s" % (config)
     config['urls']['collection.info'] = "https://api.themoviedb.org/3/collection/%%s&api_key=%(apikey)s" % (config)
     config['urls']['movie.alternativetitles'] = "https://api.themoviedb.org/3/movie/%%s/alternative_titles?api_key=%(apikey)s" % (config)
@@ -40,17 +64,47 @@ def configure(api_key, language='en'):
     config['urls']['request.token'] = "https://api.themoviedb.org/3/authentication/token/new?api_key=%(apikey)s" % (config)
     config['urls']['session.id'] = "https://api.themoviedb.org/3/authentication/session/new?api_key=%(apikey)s&request_token=%%s" % (config)
     config['urls']['movie.add.rating'] = "https://api.themoviedb.org/3/movie/%%s/rating?session_id=%%s&api_key=%(apikey)s" % (config)
-    config['api'] = {}
-    config['api']['backdrop.sizes'] = ""
-    config['api']['base.url'] = ""
-    config['api']['poster.sizes'] = ""
-    config['api']['profile.sizes'] = ""
-    config['api']['session.id'] = ""
+    # Keep the image configuration and session id when only the language changes
+    if reset:
+        config['api'] = {}
+        config['api']['backdrop.sizes'] = ""
+        config['api']['base.url'] = ""
+        config['api']['poster.sizes'] = ""
+        config['api']['profile.sizes'] = ""
+        config['api']['session.id'] = ""
+        config['api']['updated'] = 0
+
+def session():
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+def cache():
+    if config.get('cache') is None and SQLiteCache is not None:
+        try:
+            makePrivate(config['cache_location'])
+            config['cache'] = SQLiteCache(os.path.join(config['cache_location'], "tmdb_api.sqlite3"))
+        except Exception:
+            config['cache'] = False
+    return config.get('cache') or None
 
 class Core(object):
-    def getJSON(self, url, language=None):
+    def getJSON(self, url, language=None, ttl=SEARCH_TTL):
         language = language or config['language']
-        page = requests.get(url, params={'language': language}).content
+        key = "%s&language=%s" % (url, language)
+        store = cache()
+        if store is not None and ttl:
+            entry = store.get(key)
+            if entry is not None and time.time() - entry.stored < ttl:
+                return self.loads(entry.body)
+        resp = session().get(url, params={'language': language})
+        page = resp.content
+        if store is not None and ttl and resp.status_code == 200:
+            store.put(key, resp.headers, page)
+        return self.loads(page)
+
+    def loads(self, page):
         try:
             return simplejson.loads(page)
         except:
@@ -62,11 +116,14 @@ class Core(object):
         return False
 
     def update_configuration(self):
-        c = self.getJSON(config['urls']['config'])
+        if config['api']['base.url'] and time.time() - config['api']['updated'] < CONFIG_TTL:
+            return "ok"
+        c = self.getJSON(config['urls']['config'], ttl=CONFIG_TTL)
         config['api']['backdrop.sizes'] = c['images']['backdrop_sizes']
         config['api']['base.url'] = c['images']['base_url']
         config['api']['poster.sizes'] = c['images']['poster_sizes']
         config['api']['profile.sizes'] = c['images']['profile_sizes']
+        config['api']['updated'] = time.time()
         return "ok"
 
     def backdrop_sizes(self,img_size):
@@ -82,12 +139,12 @@ class Core(object):
         return size_list[img_size]
 
     def request_token(self):
-        req = self.getJSON(config['urls']['request.token'])
+        req = self.getJSON(config['urls']['request.token'], ttl=None)
         r = req["request_token"]
         return {"url":"http://themoviedb.org/authenticate/%s" % r,"request_token":r}
 
     def session_id(self,token):
-        sess = self.getJSON(config['urls']['session.id'] % token)
+        sess = self.getJSON(config['urls']['session.id'] % token, ttl=None)
         config['api']['session.id'] = sess["session_id"]
         return sess["session_id"]
 
@@ -120,9 +177,14 @@ class Movie(Core):
     def __init__(self, movie_id, language=None):
         self.movie_id = movie_id
         self.update_configuration()
-        self.movies = self.getJSON(config['urls']['movie.info'] % self.movie_id, language=language)
-        self.casts = self.getJSON(config['urls']['movie.casts'] % self.movie_id, language=language)
-        self.releases = self.getJSON(config['urls']['movie.releases'] % self.movie_id, language=language)
+        # Info, casts and releases in a single round trip
+        self.movies = self.getJSON(config['urls']['movie.full'] % self.movie_id, language=language, ttl=MOVIE_TTL)
+        self.casts = self.movies.pop('casts', None)
+        if self.casts is None:
+            self.casts = self.getJSON(config['urls']['movie.casts'] % self.movie_id, language=language, ttl=MOVIE_TTL)
+        self.releases = self.movies.pop('releases', None)
+        if self.releases is None:
+            self.releases = self.getJSON(config['urls']['movie.releases'] % self.movie_id, language=language, ttl=MOVIE_TTL)
 
     def is_adult(self):
         return self.movies['adult']
@@ -256,7 +318,7 @@ class Movie(Core):
                 return "PROBLEM_AUTH"
             sess_id = config["api"]["session.id"]
             data = {"value":float(value)}
-            req = requests.post(config['urls']['movie.add.rating'] % (self.movie_id,sess_id),data=data)
+            req = session().post(config['urls']['movie.add.rating'] % (self.movie_id,sess_id),data=data)
             res = simplejson.loads(bytes(req.content).decode())
             if res['status_message'] == "Success":
                 return True
@@ -296,7 +358,7 @@ class Person(Core):
     def __init__(self, person_id, language=None):
         self.person_id = person_id
         self.update_configuration()
-        self.person = self.getJSON(config['urls']['person.info'] % self.person_id, language=language)
+        self.person = self.getJSON(config['urls']['person.info'] % self.person_id, language=language, ttl=MOVIE_TTL)
 
     def get_id(self):
         return self.person_id
@@ -1,18 +1,15 @@
 import os
 import sys
-try:
-    from urllib.request import urlretrieve
-except ImportError:
-    from urllib import urlretrieve
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
-import tempfile
 import time
 import logging
 from tmdb_api import tmdb
 from mutagen.mp4 import MP4, MP4Cover
+from processed_marker import writeMarker
+from artwork_cache import artworkCache
 from extensions import valid_output_extensions, valid_poster_extensions, tmdb_api_key
 
 
@@ -36,6 +33,7 @@ class tmdb_mp4:
         self.imdbid = imdbid
 
         self.original = original
+        self.downloaded = {}
         for i in range(3):
             try:
                 tmdb.configure(tmdb_api_key, language=language)
@@ -59,7 +57,7 @@ class tmdb_mp4:
                 self.log.exception("Failed to connect to tMDB, trying again in 20 seconds.")
                 time.sleep(20)
 
-    def writeTags(self, mp4Path, artwork=True, thumbnail=False):
+    def writeTags(self, mp4Path, artwork=True, thumbnail=False, profile=None):
         self.log.info("Tagging file: %s." % mp4Path)
         ext = os.path.splitext(mp4Path)[1][1:]
         if ext not in valid_output_extensions:
@@ -101,10 +99,7 @@ class tmdb_mp4:
                     video["covr"] = [MP4Cover(cover, MP4Cover.FORMAT_PNG)]  # png poster
                 else:
                     video["covr"] = [MP4Cover(cover, MP4Cover.FORMAT_JPEG)]  # jpeg poster
-        if self.original:
-            video["\xa9too"] = "MDH:" + os.path.basename(self.original)
-        else:
-            video["\xa9too"] = "MDH:" + os.path.basename(mp4Path)
+        writeMarker(video, self.original or mp4Path, profile)
 
         for i in range(3):
             try:
@@ -190,16 +185,24 @@ class tmdb_mp4:
             head, tail = os.path.split(os.path.abspath(mp4Path))
             path = os.path.join(head, filename + os.extsep + e)
             if (os.path.exists(path)):
-                poster = path
+                poster = artworkCache.prepare(path)
                 self.log.info("Local artwork detected, using %s." % path)
                 break
-        # Pulls down all the poster metadata for the correct season and sorts them into the Poster object
         if poster is None:
-            try:
-                poster = urlretrieve(self.movie.get_poster("l"), os.path.join(tempfile.gettempdir(), "poster-%s.jpg" % self.imdbid))[0]
-            except Exception as e:
-                self.log.error("Exception while retrieving poster %s.", str(e))
-                poster = None
+            poster = self.downloadArtwork()
+        return poster
+
+    def downloadArtwork(self, thumbnail=False):
+        # Remote artwork is only downloaded once, so it can be fetched ahead of tagging while the file encodes. Movies have no thumbnails, the argument matches Tvdb_mp4
+        # Fetched again when the shared cache evicted the file since
+        if thumbnail in self.downloaded and (self.downloaded[thumbnail] is None or os.path.exists(self.downloaded[thumbnail])):
+            return self.downloaded[thumbnail]
+        try:
+            poster = artworkCache.fetch(self.movie.get_poster("l"))
+        except Exception as e:
+            self.log.error("Exception while retrieving poster %s.", str(e))
+            poster = None
+        self.downloaded[thumbnail] = poster
         return poster
 
 
@@ -30,6 +30,7 @@ if IS_PY2:
     from urllib import quote as url_quote
 else:
     import requests
+    from .tvdb_cache import CachedSession
     from urllib.parse import quote as url_quote
 import getpass
 import tempfile
@@ -37,6 +38,7 @@ import warnings
 import logging
 import datetime
 import zipfile
+from io import BytesIO
 
 try:
     import xml.etree.cElementTree as ElementTree
@@ -95,6 +97,9 @@ class Show(dict):
     def __init__(self):
         dict.__init__(self)
         self.data = {}
+        # Last season fully parsed when episode parsing stopped early, None
+        # when every episode was parsed
+        self.parsed_through = None
 
     def __repr__(self):
         return "<Show %s (containing %s seasons)>" % (
@@ -120,6 +125,14 @@ class Show(dict):
             # doesn't exist, so attribute error.
             raise tvdb_attributenotfound("Cannot find attribute %s" % (repr(key)))
 
+    def covers(self, season):
+        """Returns True if season was completely parsed, always the case
+        unless parsing stopped early
+        """
+        if self.parsed_through is None:
+            return True
+        return season is not None and season in self and season <= self.parsed_through
+
     def airedOn(self, date):
         ret = self.search(str(date), 'firstaired')
         if len(ret) == 0:
@@ -201,7 +214,27 @@ class Season(dict):
         if episode_number not in self:
             raise tvdb_episodenotfound("Could not find episode %s" % (repr(episode_number)))
         else:
-            return dict.__getitem__(self, episode_number)
+            episode = dict.__getitem__(self, episode_number)
+            if isinstance(episode, EpisodeRecord):
+                # Expand the compact record on first access
+                episode = episode.materialize(self)
+                dict.__setitem__(self, episode_number, episode)
+            return episode
+
+    def __reduce__(self):
+        # Pickle unexpanded records as is
+        return (self.__class__, (), self.__dict__, None, iter(dict.items(self)))
+
+    def get(self, episode_number, default = None):
+        if episode_number not in self:
+            return default
+        return self[episode_number]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
 
     def search(self, term = None, key = None):
         """Search all episodes in season, returns a list of matching Episode
@@ -280,6 +313,32 @@ class Episode(dict):
                 return self
 
 
+class EpisodeRecord(object):
+    """Compact storage for an episode that has not been accessed yet.
+
+    Holds the element names and values as tuples, the names tuple being
+    shared by every episode with the same layout. Season turns it into an
+    Episode the first time it is accessed.
+    """
+    __slots__ = ('tags', 'values')
+
+    def __init__(self, tags, values):
+        self.tags = tags
+        self.values = values
+
+    def __getstate__(self):
+        return (self.tags, self.values)
+
+    def __setstate__(self, state):
+        self.tags, self.values = state
+
+    def materialize(self, season = None):
+        episode = Episode(season = season)
+        for tag, value in zip(self.tags, self.values):
+            dict.__setitem__(episode, tag, value)
+        return episode
+
+
 class Actors(list):
     """Holds all Actor instances for a show
     """
@@ -345,9 +404,9 @@ class Tvdb:
 
             In Python 3, True/False enable or disable default
             caching. Passing string specified directory where to store
-            the "tvdb.sqlite3" cache file. Also a custom
+            the "tvdb_api.sqlite3" cache file. Also a custom
             requests.Session instance can be passed (e.g maybe a
-            customised instance of requests_cache.CachedSession)
+            customised instance of tvdb_cache.CachedSession)
 
         banners (True/False):
             Retrieves the banners for a show. These are accessed
@@ -430,30 +489,24 @@ class Tvdb:
         self.config['dvdorder'] = dvdorder
 
         if not IS_PY2: # FIXME: Allow using requests in Python 2?
-            import requests_cache
             if cache is True:
-                self.session = requests_cache.CachedSession(
-                    expire_after=21600, # 6 hours
-                    backend='sqlite',
-                    cache_name=self._getTempDir(),
-                    )
                 self.config['cache_enabled'] = True
+                self.config['cache_location'] = self._getTempDir()
+                self.session = CachedSession(self.config['cache_location'])
             elif cache is False:
                 self.session = requests.Session()
                 self.config['cache_enabled'] = False
             elif isinstance(cache, text_type):
                 # Specified cache path
-                self.session = requests_cache.CachedSession(
-                    expire_after=21600, # 6 hours
-                    backend='sqlite',
-                    cache_name=os.path.join(cache, "tvdb_api"),
-                    )
+                self.config['cache_enabled'] = True
+                self.config['cache_location'] = cache
+                self.session = CachedSession(self.config['cache_location'])
             else:
                 self.session = cache
                 try:
                     self.session.get
                 except AttributeError:
-                    raise ValueError("cache argument must be True/False, string as cache path or requests.Session-type object (e.g from requests_cache.CachedSession)")
+                    raise ValueError("cache argument must be True/False, string as cache path or requests.Session-type object (e.g from tvdb_cache.CachedSession)")
         else:
             # For backwards compatibility in Python 2.x
             if cache is True:
@@ -672,6 +725,17 @@ class Tvdb:
             self.shows[sid][seas][ep] = Episode(season = self.shows[sid][seas])
         self.shows[sid][seas][ep][attrib] = value
 
+    def _setEpisode(self, sid, seas, ep, record):
+        """Stores an EpisodeRecord, creating Show() and Season() as
+        required. Used by the streaming episode parser in place of
+        calling _setItem for every attribute
+        """
+        if sid not in self.shows:
+            self.shows[sid] = Show()
+        if seas not in self.shows[sid]:
+            self.shows[sid][seas] = Season(show = self.shows[sid])
+        dict.__setitem__(self.shows[sid][seas], ep, record)
+
     def _setShowData(self, sid, key, value):
         """Sets self.shows[sid] to a new Show instance, or sets the data
         """
@@ -699,7 +763,7 @@ class Tvdb:
         seriesEt = self._getetsrc(self.config['url_getSeries'] % (series))
         allSeries = []
         for series in seriesEt:
-            result = dict((k.tag.lower(), k.text) for k in series.getchildren())
+            result = dict((k.tag.lower(), k.text) for k in series)
             result['id'] = int(result['id'])
             result['lid'] = self.config['langabbv_to_id'][result['language']]
             if 'aliasnames' in result:
@@ -828,10 +892,13 @@ class Tvdb:
             cur_actors.append(curActor)
         self._setShowData(sid, '_actors', cur_actors)
 
-    def _getShowData(self, sid, language):
+    def _getShowData(self, sid, language, stop_after=None):
         """Takes a series ID, gets the epInfo URL and parses the TVDB
         XML file into the shows dict in layout:
         shows[series_id][season_number][episode_number]
+
+        stop_after limits episode parsing to the seasons up to and
+        including that season number
         """
 
         if self.config['language'] is None:
@@ -881,9 +948,43 @@ class Tvdb:
         else:
             url = self.config['url_epInfo'] % (sid, language)
 
-        epsEt = self._getetsrc( url, language=language)
+        self._parseEpisodes(sid, url, language, stop_after)
+
+    def _iterEpisodes(self, url, language=None):
+        """Streams the Episode elements of the episode XML, clearing each
+        one once the caller is done with it
+        """
+        src = self._loadUrl(url, language=language)
+        if not IS_PY2:
+            src = src.replace(b"\r", b"")
+        else:
+            src = src.rstrip("\r") # FIXME: this seems wrong
 
-        for cur_ep in epsEt.findall("Episode"):
+        try:
+            for event, elem in ElementTree.iterparse(BytesIO(src)):
+                if elem.tag == "Episode":
+                    yield elem
+                    elem.clear()
+        except SyntaxError:
+            # Episodes already yielded are simply stored again
+            log().debug("Streaming parse of %s failed, reloading" % url)
+            for elem in self._getetsrc(url, language=language).findall("Episode"):
+                yield elem
+
+    def _parseEpisodes(self, sid, url, language=None, stop_after=None):
+        """Parses the episode XML into compact EpisodeRecords.
+
+        With stop_after set to a season number, parsing ends at the first
+        episode of a later season once that season has been seen, as
+        thetvdb.com lists episodes in season order. That order is the aired
+        one, so DVD ordered shows are always parsed completely.
+        """
+        if self.config['dvdorder']:
+            stop_after = None
+        layouts = {}
+        seen = False
+        complete = True
+        for cur_ep in self._iterEpisodes(url, language=language):
 
             if self.config['dvdorder']:
                 log().debug('Using DVD ordering.')
@@ -901,7 +1002,7 @@ class Tvdb:
                     elem_seasnum, elem_epno))
                 log().debug(
                     " ".join(
-                        "%r is %r" % (child.tag, child.text) for child in cur_ep.getchildren()))
+                        "%r is %r" % (child.tag, child.text) for child in cur_ep))
                 # TODO: Should this happen?
                 continue # Skip to next episode
 
@@ -909,7 +1010,16 @@ class Tvdb:
             seas_no = int(float(elem_seasnum.text))
             ep_no = int(float(elem_epno.text))
 
-            for cur_item in cur_ep.getchildren():
+            if stop_after is not None:
+                if seas_no == stop_after:
+                    seen = True
+                elif seen and seas_no > stop_after:
+                    complete = False
+                    break
+
+            tags = []
+            values = []
+            for cur_item in cur_ep:
                 tag = cur_item.tag.lower()
                 value = cur_item.text
                 if value is not None:
@@ -917,7 +1027,14 @@ class Tvdb:
                         value = self.config['url_artworkPrefix'] % (value)
                     else:
                         value = self._cleanData(value)
-                self._setItem(sid, seas_no, ep_no, tag, value)
+                tags.append(tag)
+                values.append(value)
+            tags = tuple(tags)
+            tags = layouts.setdefault(tags, tags)
+            self._setEpisode(sid, seas_no, ep_no, EpisodeRecord(tags, tuple(values)))
+
+        if sid in self.shows:
+            self.shows[sid].parsed_through = None if complete else stop_after
 
     def _nameToSid(self, name):
         """Takes show name, returns the correct series ID (if the show has
@@ -938,15 +1055,22 @@ class Tvdb:
 
         return sid
 
+    def getShow(self, sid, stop_after=None):
+        """Returns the Show for a series id, only parsing episodes up to the
+        end of season stop_after when given. A show that was parsed
+        partially is fetched again if it does not cover stop_after.
+        """
+        if sid not in self.shows or not self.shows[sid].covers(stop_after):
+            self._getShowData(sid, self.config['language'], stop_after=stop_after)
+        return self.shows[sid]
+
     def __getitem__(self, key):
         """Handles tvdb_instance['seriesname'] calls.
         The dict index should be the show id
         """
         if isinstance(key, int_types):
             # Item is integer, treat as show id
-            if key not in self.shows:
-                self._getShowData(key, self.config['language'])
-            return self.shows[key]
+            return self.getShow(key)
         
         key = key.lower() # make key lower case
         sid = self._nameToSid(key)
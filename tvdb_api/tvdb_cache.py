@@ -6,8 +6,17 @@
 #license:unlicense (http://unlicense.org/)
 
 """
-urllib2 caching handler
-Modified from http://code.activestate.com/recipes/491261/
+SQLite backed HTTP cache
+
+All responses live in a single indexed database file instead of one header
+and body file per URL. Entries expire after max_age seconds, stale entries
+carrying an ETag or Last-Modified header are revalidated with a conditional
+request, and the least recently used entries are evicted once the stored
+bodies exceed max_size bytes. The database runs in WAL mode so any number
+of processes can read it while one of them writes.
+
+Python 2 uses CacheHandler as an urllib2 handler, Python 3 uses
+CachedSession as a drop in requests.Session.
 """
 from __future__ import with_statement
 
@@ -17,235 +26,330 @@ __version__ = "1.10"
 import os
 import time
 import errno
-import httplib
-import urllib2
-import StringIO
-from hashlib import md5
-from threading import RLock
-
-cache_lock = RLock()
-
-def locked_function(origfunc):
-    """Decorator to execute function under lock"""
-    def wrapped(*args, **kwargs):
-        cache_lock.acquire()
-        try:
-            return origfunc(*args, **kwargs)
-        finally:
-            cache_lock.release()
-    return wrapped
+import sqlite3
+import threading
+
+try:
+    import urllib2
+    import httplib
+    from StringIO import StringIO
+except ImportError:
+    urllib2 = None
+
+try:
+    import requests
+    from requests.structures import CaseInsensitiveDict
+except ImportError:
+    requests = None
+
+CACHE_FILENAME = "tvdb_api.sqlite3"
+DEFAULT_MAX_AGE = 21600 # 6 hours
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024 # 64MB of response bodies
+
+# Only bump the access time of an entry once a minute, so hot entries do
+# not turn every read into a write
+ACCESS_RESOLUTION = 60
 
-def calculate_cache_path(cache_location, url):
-    """Checks if [cache_location]/[hash_of_url].headers and .body exist
+
+def make_cache_dir(cache_location):
+    """Creates the cache directory, tolerating another process beating us
+    to it
     """
-    thumb = md5(url).hexdigest()
-    header = os.path.join(cache_location, thumb + ".headers")
-    body = os.path.join(cache_location, thumb + ".body")
-    return header, body
-
-def check_cache_time(path, max_age):
-    """Checks if a file has been created/modified in the [last max_age] seconds.
-    False means the file is too old (or doesn't exist), True means it is
-    up-to-date and valid"""
-    if not os.path.isfile(path):
-        return False
-    cache_modified_time = os.stat(path).st_mtime
-    time_now = time.time()
-    if cache_modified_time < time_now - max_age:
-        # Cache is old
-        return False
-    else:
-        return True
-
-@locked_function
-def exists_in_cache(cache_location, url, max_age):
-    """Returns if header AND body cache file exist (and are up-to-date)"""
-    hpath, bpath = calculate_cache_path(cache_location, url)
-    if os.path.exists(hpath) and os.path.exists(bpath):
-        return(
-            check_cache_time(hpath, max_age)
-            and check_cache_time(bpath, max_age)
-        )
-    else:
-        # File does not exist
-        return False
-
-@locked_function
-def store_in_cache(cache_location, url, response):
-    """Tries to store response in cache."""
-    hpath, bpath = calculate_cache_path(cache_location, url)
-    try:
-        outf = open(hpath, "wb")
-        headers = str(response.info())
-        outf.write(headers)
-        outf.close()
-
-        outf = open(bpath, "wb")
-        outf.write(response.read())
-        outf.close()
-    except IOError:
-        return True
-    else:
-        return False
-        
-@locked_function
-def delete_from_cache(cache_location, url):
-    """Deletes a response in cache."""
-    hpath, bpath = calculate_cache_path(cache_location, url)
-    try:
-        if os.path.exists(hpath):
-            os.remove(hpath)
-        if os.path.exists(bpath):
-            os.remove(bpath)
-    except IOError:
-        return True
-    else:
-        return False
-
-class CacheHandler(urllib2.BaseHandler):
-    """Stores responses in a persistant on-disk cache.
-
-    If a subsequent GET request is made for the same URL, the stored
-    response is returned, saving time, resources and bandwidth
+    if not os.path.exists(cache_location):
+        try:
+            os.makedirs(cache_location)
+        except OSError as e:
+            if e.errno == errno.EEXIST and os.path.isdir(cache_location):
+                # File exists, and it's a directory,
+                # another process beat us to creating this dir, that's OK.
+                pass
+            else:
+                # Our target dir is already a file, or different error,
+                # relay the error!
+                raise
+
+
+def render_headers(headers):
+    """Flattens a header mapping into HTTP header lines"""
+    return "".join("%s: %s\r\n" % (k, v) for k, v in headers.items())
+
+
+def parse_headers(headerbuf):
+    """Splits HTTP header lines back into (name, value) pairs"""
+    headers = []
+    for line in headerbuf.splitlines():
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers.append((k.strip(), v.strip()))
+    return headers
+
+
+class CacheEntry(object):
+    """A cached response, as returned by SQLiteCache.get"""
+    __slots__ = ('url', 'headers', 'body', 'etag', 'last_modified', 'stored', 'fresh')
+
+    def __init__(self, url, headers, body, etag, last_modified, stored, fresh):
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = stored
+        self.fresh = fresh
+
+    def validators(self):
+        """Returns the headers to revalidate this entry with a conditional
+        GET
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class SQLiteCache(object):
+    """Stores responses in a single SQLite database file with TTL and a
+    size bounded LRU eviction policy
     """
-    @locked_function
-    def __init__(self, cache_location, max_age = 21600):
-        """The location of the cache directory"""
+    def __init__(self, path, max_age = DEFAULT_MAX_AGE, max_size = DEFAULT_MAX_SIZE):
+        self.path = path
         self.max_age = max_age
-        self.cache_location = cache_location
-        if not os.path.exists(self.cache_location):
-            try:
-                os.mkdir(self.cache_location)
-            except OSError, e:
-                if e.errno == errno.EEXIST and os.path.isdir(self.cache_location):
-                    # File exists, and it's a directory,
-                    # another process beat us to creating this dir, that's OK.
-                    pass
-                else:
-                    # Our target dir is already a file, or different error,
-                    # relay the error!
-                    raise
-
-    def default_open(self, request):
-        """Handles GET requests, if the response is cached it returns it
+        self.max_size = max_size
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "url TEXT PRIMARY KEY, headers TEXT, body BLOB, etag TEXT, last_modified TEXT, "
+                         "stored REAL, accessed REAL, size INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def connection(self):
+        """Returns the connection for the current thread and process,
+        sqlite connections must not be shared between either
         """
-        if request.get_method() is not "GET":
-            return None # let the next handler try to handle the request
-
-        if exists_in_cache(
-            self.cache_location, request.get_full_url(), self.max_age
-        ):
-            return CachedResponse(
-                self.cache_location,
-                request.get_full_url(),
-                set_cache_header = True
-            )
-        else:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout = 30)
+            conn.text_factory = str
+            try:
+                # WAL lets readers in other processes proceed while one process writes
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            except sqlite3.DatabaseError:
+                pass
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, url):
+        """Returns the CacheEntry for url, or None if it is not cached"""
+        conn = self.connection()
+        row = conn.execute("SELECT headers, body, etag, last_modified, stored, accessed FROM responses WHERE url = ?", (url,)).fetchone()
+        if row is None:
             return None
+        headers, body, etag, last_modified, stored, accessed = row
+        now = time.time()
+        if now - accessed > ACCESS_RESOLUTION:
+            with conn:
+                conn.execute("UPDATE responses SET accessed = ? WHERE url = ?", (now, url))
+        return CacheEntry(url, headers, bytes(body), etag, last_modified, stored, now - stored < self.max_age)
 
-    def http_response(self, request, response):
-        """Gets a HTTP response, if it was a GET request and the status code
-        starts with 2 (200 OK etc) it caches it and returns a CachedResponse
+    def put(self, url, headers, body):
+        """Stores a response, headers being a mapping of header names to
+        values, then evicts old entries if the cache grew too large
         """
-        if (request.get_method() == "GET"
-            and str(response.code).startswith("2")
-        ):
-            if 'x-local-cache' not in response.info():
-                # Response is not cached
-                set_cache_header = store_in_cache(
-                    self.cache_location,
-                    request.get_full_url(),
-                    response
-                )
-            else:
-                set_cache_header = True
+        lowered = dict((k.lower(), v) for k, v in headers.items())
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO responses (url, headers, body, etag, last_modified, stored, accessed, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (url, render_headers(headers), sqlite3.Binary(body), lowered.get('etag'), lowered.get('last-modified'), now, now, len(body)))
+        self.evict()
 
-            return CachedResponse(
-                self.cache_location,
-                request.get_full_url(),
-                set_cache_header = set_cache_header
-            )
-        else:
-            return response
+    def refresh(self, url):
+        """Marks an entry as fresh again after a 304 Not Modified"""
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute("UPDATE responses SET stored = ?, accessed = ? WHERE url = ?", (now, now, url))
 
-class CachedResponse(StringIO.StringIO):
-    """An urllib2.response-like object for cached responses.
+    def delete(self, url):
+        """Deletes a response in cache."""
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM responses WHERE url = ?", (url,))
 
-    To determine if a response is cached or coming directly from
-    the network, check the x-local-cache header rather than the object type.
-    """
+    # Same name as requests_cache, used by Tvdb._loadUrl for bad zip files
+    delete_url = delete
+
+    def evict(self):
+        """Removes the least recently used entries until the stored bodies
+        fit in max_size
+        """
+        if not self.max_size:
+            return
+        conn = self.connection()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+        expired = []
+        for url, size in conn.execute("SELECT url, size FROM responses ORDER BY accessed").fetchall():
+            if total <= self.max_size:
+                break
+            expired.append((url,))
+            total -= size
+        with conn:
+            conn.executemany("DELETE FROM responses WHERE url = ?", expired)
+
+    def clear(self):
+        """Deletes every cached response"""
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM responses")
+
+
+if urllib2 is not None:
+    class CacheHandler(urllib2.BaseHandler):
+        """Stores responses in a persistant on-disk cache.
+
+        If a subsequent GET request is made for the same URL, the stored
+        response is returned, saving time, resources and bandwidth
+        """
+        def __init__(self, cache_location, max_age = DEFAULT_MAX_AGE, max_size = DEFAULT_MAX_SIZE):
+            """The location of the cache directory"""
+            self.max_age = max_age
+            self.cache_location = cache_location
+            make_cache_dir(self.cache_location)
+            self.cache = SQLiteCache(os.path.join(self.cache_location, CACHE_FILENAME), max_age, max_size)
+
+        def default_open(self, request):
+            """Handles GET requests, if the response is cached and fresh it
+            returns it, if it is stale the request is made conditional
+            """
+            if request.get_method() != "GET":
+                return None # let the next handler try to handle the request
+
+            entry = self.cache.get(request.get_full_url())
+            if entry is None:
+                return None
+            if entry.fresh:
+                return CachedResponse(self.cache, entry, set_cache_header = True)
+            for k, v in entry.validators().items():
+                request.add_unredirected_header(k, v)
+            return None
 
-    @locked_function
-    def __init__(self, cache_location, url, set_cache_header=True):
-        self.cache_location = cache_location
-        hpath, bpath = calculate_cache_path(cache_location, url)
+        def http_response(self, request, response):
+            """Gets a HTTP response, if it was a GET request and the status code
+            starts with 2 (200 OK etc) it caches it and returns a CachedResponse.
+            A 304 Not Modified is answered from the cache
+            """
+            if request.get_method() != "GET" or 'x-local-cache' in response.info():
+                return response
 
-        StringIO.StringIO.__init__(self, file(bpath, "rb").read())
+            url = request.get_full_url()
+            if response.code == 304:
+                entry = self.cache.get(url)
+                if entry is not None:
+                    self.cache.refresh(url)
+                    return CachedResponse(self.cache, entry, set_cache_header = True)
+            elif str(response.code).startswith("2"):
+                self.cache.put(url, response.info(), response.read())
+                return CachedResponse(self.cache, self.cache.get(url), set_cache_header = True)
+            return response
+
+        https_response = http_response
 
-        self.url     = url
-        self.code    = 200
-        self.msg     = "OK"
-        headerbuf = file(hpath, "rb").read()
-        if set_cache_header:
-            headerbuf += "x-local-cache: %s\r\n" % (bpath)
-        self.headers = httplib.HTTPMessage(StringIO.StringIO(headerbuf))
+    class CachedResponse(StringIO):
+        """An urllib2.response-like object for cached responses.
 
-    def info(self):
-        """Returns headers
+        To determine if a response is cached or coming directly from
+        the network, check the x-local-cache header rather than the object type.
         """
-        return self.headers
+        def __init__(self, cache, entry, set_cache_header=True):
+            StringIO.__init__(self, entry.body)
+            self.cache = cache
+            self.url     = entry.url
+            self.code    = 200
+            self.msg     = "OK"
+            headerbuf = entry.headers
+            if set_cache_header:
+                headerbuf += "x-local-cache: %s\r\n" % (cache.path)
+            self.headers = httplib.HTTPMessage(StringIO(headerbuf))
+
+        def info(self):
+            """Returns headers
+            """
+            return self.headers
+
+        def geturl(self):
+            """Returns original URL
+            """
+            return self.url
+
+        def recache(self):
+            new_request = urllib2.urlopen(self.url)
+            self.cache.put(self.url, new_request.info(), new_request.read())
+            CachedResponse.__init__(self, self.cache, self.cache.get(self.url), True)
+
+        def delete_cache(self):
+            self.cache.delete(self.url)
+
 
-    def geturl(self):
-        """Returns original URL
+if requests is not None:
+    class CachedSession(requests.Session):
+        """A requests.Session answering GET requests from the SQLite cache,
+        revalidating stale entries with conditional requests
         """
-        return self.url
-
-    @locked_function
-    def recache(self):
-        new_request = urllib2.urlopen(self.url)
-        set_cache_header = store_in_cache(
-            self.cache_location,
-            new_request.url,
-            new_request
-        )
-        CachedResponse.__init__(self, self.cache_location, self.url, True)
-
-    @locked_function
-    def delete_cache(self):
-        delete_from_cache(
-            self.cache_location,
-            self.url
-        )
-    
+        def __init__(self, cache_location, max_age = DEFAULT_MAX_AGE, max_size = DEFAULT_MAX_SIZE):
+            requests.Session.__init__(self)
+            make_cache_dir(cache_location)
+            self.cache = SQLiteCache(os.path.join(cache_location, CACHE_FILENAME), max_age, max_size)
+
+        def _cachedResponse(self, entry):
+            resp = requests.Response()
+            resp.status_code = 200
+            resp.reason = "OK"
+            resp.url = entry.url
+            resp._content = entry.body
+            resp.headers = CaseInsensitiveDict(parse_headers(entry.headers))
+            resp.headers['x-local-cache'] = self.cache.path
+            return resp
+
+        def get(self, url, **kwargs):
+            entry = self.cache.get(url)
+            if entry is not None and entry.fresh:
+                return self._cachedResponse(entry)
+
+            headers = dict(kwargs.pop('headers', None) or {})
+            if entry is not None:
+                headers.update(entry.validators())
+            resp = requests.Session.get(self, url, headers = headers, **kwargs)
+            if resp.status_code == 304 and entry is not None:
+                self.cache.refresh(url)
+                return self._cachedResponse(entry)
+            if 200 <= resp.status_code < 300:
+                self.cache.put(url, resp.headers, resp.content)
+            return resp
+
 
 if __name__ == "__main__":
     def main():
-        """Quick test/example of CacheHandler"""
-        opener = urllib2.build_opener(CacheHandler("/tmp/"))
-        response = opener.open("http://google.com")
-        print response.headers
-        print "Response:", response.read()
-
-        response.recache()
-        print response.headers
-        print "After recache:", response.read()
-
-        # Test usage in threads
-        from threading import Thread
-        class CacheThreadTest(Thread):
-            lastdata = None
-            def run(self):
-                req = opener.open("http://google.com")
-                newdata = req.read()
-                if self.lastdata is None:
-                    self.lastdata = newdata
-                assert self.lastdata == newdata, "Data was not consistent, uhoh"
-                req.recache()
-        threads = [CacheThreadTest() for x in range(50)]
-        print "Starting threads"
-        [t.start() for t in threads]
-        print "..done"
-        print "Joining threads"
-        [t.join() for t in threads]
-        print "..done"
+        """Quick test/example of the cache"""
+        import tempfile
+        if urllib2 is not None:
+            opener = urllib2.build_opener(CacheHandler(tempfile.gettempdir()))
+            response = opener.open("http://google.com")
+            print(response.headers)
+            print("Response: %s" % response.read())
+
+            response.recache()
+            print(response.headers)
+            print("After recache: %s" % response.read())
+        else:
+            session = CachedSession(tempfile.gettempdir())
+            response = session.get("http://google.com")
+            print(response.headers)
+            response = session.get("http://google.com")
+            print("Cached: %s" % response.headers.get('x-local-cache'))
     main()
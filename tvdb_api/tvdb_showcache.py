@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:tvdb_api
+#license:unlicense (http://unlicense.org/)
+
+"""Process wide cache of parsed Show objects, so every episode of a series
+reuses one download of the series, episode, banner and actor data.
+
+Shows are held in memory for the life of the process, keyed on (series id,
+language). Separate hook processes handling the same season pack share the
+raw responses through the SQLite HTTP cache of tvdb_cache instead, so only
+data is ever read back from disk.
+
+>>> from tvdb_api.tvdb_showcache import showCache
+>>> show = showCache.getShow(76156, 'en')
+>>> showCache.stats()['misses']
+1
+"""
+
+import time
+import logging
+import threading
+
+from .tvdb_api import Tvdb
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def log():
+    return logging.getLogger("tvdb_api.showcache")
+
+
+class ShowCache(object):
+    """Caches Show instances in memory with a time to live
+    """
+    def __init__(self, ttl=21600):
+        """ttl (int):
+            Seconds a cached show is considered fresh. Defaults to 6 hours,
+            matching the tvdb_api HTTP cache.
+        """
+        self.ttl = ttl
+        self.shows = {}
+        # Event of the fetch in flight for a key, set once it is done
+        self.fetching = {}
+        self.lock = threading.RLock()
+        self.metrics = {'memory_hits': 0, 'misses': 0, 'expired': 0, 'errors': 0, 'fetch_time': 0.0}
+
+    def _key(self, show, language):
+        """Series ids are used as is, series names are matched case
+        insensitively
+        """
+        if isinstance(show, (text_type, str)):
+            show = show.strip()
+            show = int(show) if show.isdigit() else show.lower()
+        return (show, language or 'en')
+
+    def _fresh(self, stored):
+        return self.ttl is None or time.time() - stored < self.ttl
+
+    def _fetch(self, show, language, season=None):
+        t = Tvdb(interactive=False, cache=True, banners=True, actors=True, forceConnect=True, language=language)
+        if isinstance(show, int):
+            return t.getShow(show, stop_after=season)
+        return t[show]
+
+    def getShow(self, show, language='en', season=None):
+        """Returns the Show (including banners and actors) for a series id
+        or name, downloading it only if no fresh copy is cached.
+
+        With season set, episodes of later seasons are not parsed; a cached
+        show that stopped before season is fetched again. Lookups of one
+        series wait for a fetch of it in flight, other series do not.
+        """
+        key = self._key(show, language)
+        while True:
+            with self.lock:
+                cached = self.shows.get(key)
+                if cached is not None and self._fresh(cached[0]) and cached[1].covers(season):
+                    self.metrics['memory_hits'] += 1
+                    return cached[1]
+                if cached is not None:
+                    if not self._fresh(cached[0]):
+                        self.metrics['expired'] += 1
+                    del self.shows[key]
+                event = self.fetching.get(key)
+                if event is None:
+                    event = self.fetching[key] = threading.Event()
+                    self.metrics['misses'] += 1
+                    break
+            # Look again once the other fetch is done, it may have failed or stopped before season
+            event.wait()
+
+        try:
+            start = time.time()
+            try:
+                data = self._fetch(key[0], key[1], season)
+            except Exception:
+                with self.lock:
+                    self.metrics['errors'] += 1
+                raise
+            with self.lock:
+                self.metrics['fetch_time'] += time.time() - start
+                self.shows[key] = (time.time(), data)
+            return data
+        finally:
+            with self.lock:
+                del self.fetching[key]
+            event.set()
+
+    def invalidate(self, show, language='en'):
+        """Drops a show from the cache
+        """
+        key = self._key(show, language)
+        with self.lock:
+            self.shows.pop(key, None)
+
+    def stats(self):
+        """Returns cache effectiveness counters, including the hit ratio
+        """
+        with self.lock:
+            stats = dict(self.metrics)
+        lookups = stats['memory_hits'] + stats['misses']
+        stats['lookups'] = lookups
+        stats['hit_ratio'] = float(stats['memory_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+showCache = ShowCache()
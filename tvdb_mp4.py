@@ -1,19 +1,16 @@
 import os
 import sys
-try:
-    from urllib.request import urlretrieve
-except ImportError:
-    from urllib import urlretrieve
 import urllib
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
-import tempfile
 import time
 import logging
-from tvdb_api.tvdb_api import Tvdb
+from tvdb_api.tvdb_showcache import showCache
 from mutagen.mp4 import MP4, MP4Cover
+from processed_marker import writeMarker
+from artwork_cache import artworkCache
 from extensions import valid_output_extensions, valid_poster_extensions
 
 
@@ -25,9 +22,9 @@ class Tvdb_mp4:
         else:
             self.log = logging.getLogger(__name__)
 
+        self.downloaded = {}
         for i in range(3):
             try:
-                self.tvdb_show = Tvdb(interactive=False, cache=False, banners=True, actors=True, forceConnect=True, language=language)
                 self.show = show
                 self.showid = show
                 self.season = season
@@ -36,8 +33,8 @@ class Tvdb_mp4:
                 self.HD = None
                 self.original = original
 
-                # Gather information from theTVDB
-                self.showdata = self.tvdb_show[self.show]
+                # Gather information from theTVDB, shared by every episode of the series in this process
+                self.showdata = showCache.getShow(self.show, language, season=int(self.season))
                 self.seasondata = self.showdata[self.season]
                 self.episodedata = self.seasondata[self.episode]
 
@@ -54,12 +51,15 @@ class Tvdb_mp4:
 
                 # Generate XML tags for Actors/Writers/Directors
                 self.xml = self.xmlTags()
+                self.log.debug("TVDB series cache: %s." % showCache.stats())
                 break
             except Exception as e:
                 self.log.exception("Failed to connect to TVDB, trying again in 20 seconds.")
+                # Cached series data may predate the episode, fetch it fresh on the next attempt
+                showCache.invalidate(self.showid, language)
                 time.sleep(20)
 
-    def writeTags(self, mp4Path, artwork=True, thumbnail=False):
+    def writeTags(self, mp4Path, artwork=True, thumbnail=False, profile=None):
         self.log.info("Tagging file: %s." % mp4Path)
         ext = os.path.splitext(mp4Path)[1][1:]
         if ext not in valid_output_extensions:
@@ -102,10 +102,7 @@ class Tvdb_mp4:
                     video["covr"] = [MP4Cover(cover, MP4Cover.FORMAT_PNG)]  # png poster
                 else:
                     video["covr"] = [MP4Cover(cover, MP4Cover.FORMAT_JPEG)]  # jpeg poster
-        if self.original:
-            video["\xa9too"] = "MDH:" + os.path.basename(self.original)
-        else:
-            video["\xa9too"] = "MDH:" + os.path.basename(mp4Path)
+        writeMarker(video, self.original or mp4Path, profile)
         MP4(mp4Path).delete(mp4Path)
         for i in range(3):
             try:
@@ -199,32 +196,42 @@ class Tvdb_mp4:
             head, tail = os.path.split(os.path.abspath(mp4Path))
             path = os.path.join(head, filename + os.extsep + e)
             if (os.path.exists(path)):
-                poster = path
+                poster = artworkCache.prepare(path)
                 self.log.info("Local artwork detected, using %s." % path)
                 break
-        # Pulls down all the poster metadata for the correct season and sorts them into the Poster object
         if poster is None:
-            if thumbnail:
-                try:
-                    poster = urlretrieve(self.episodedata['filename'], os.path.join(tempfile.gettempdir(), "poster-%s.jpg" % self.title))[0]
-                except Exception as e:
-                    self.log.error("Exception while retrieving poster %s.", str(e))
-                    poster = None
-            else:
-                posters = posterCollection()
-                try:
-                    for bannerid in self.showdata['_banners']['season']['season'].keys():
-                        if str(self.showdata['_banners']['season']['season'][bannerid]['season']) == str(self.season):
-                            poster = Poster()
-                            poster.ratingcount = int(self.showdata['_banners']['season']['season'][bannerid]['ratingcount'])
-                            if poster.ratingcount > 0:
-                                poster.rating = float(self.showdata['_banners']['season']['season'][bannerid]['rating'])
-                            poster.bannerpath = self.showdata['_banners']['season']['season'][bannerid]['_bannerpath']
-                            posters.addPoster(poster)
-
-                    poster = urlretrieve(posters.topPoster().bannerpath, os.path.join(tempfile.gettempdir(), "poster-%s.jpg" % self.title))[0]
-                except:
-                    poster = None
+            poster = self.downloadArtwork(thumbnail)
+        return poster
+
+    def downloadArtwork(self, thumbnail=False):
+        # Remote artwork is only downloaded once, so it can be fetched ahead of tagging while the file encodes
+        # Fetched again when the shared cache evicted the file since
+        if thumbnail in self.downloaded and (self.downloaded[thumbnail] is None or os.path.exists(self.downloaded[thumbnail])):
+            return self.downloaded[thumbnail]
+        poster = None
+        # Pulls down all the poster metadata for the correct season and sorts them into the Poster object
+        if thumbnail:
+            try:
+                poster = artworkCache.fetch(self.episodedata['filename'])
+            except Exception as e:
+                self.log.error("Exception while retrieving poster %s.", str(e))
+                poster = None
+        else:
+            posters = posterCollection()
+            try:
+                for bannerid in self.showdata['_banners']['season']['season'].keys():
+                    if str(self.showdata['_banners']['season']['season'][bannerid]['season']) == str(self.season):
+                        poster = Poster()
+                        poster.ratingcount = int(self.showdata['_banners']['season']['season'][bannerid]['ratingcount'])
+                        if poster.ratingcount > 0:
+                            poster.rating = float(self.showdata['_banners']['season']['season'][bannerid]['rating'])
+                        poster.bannerpath = self.showdata['_banners']['season']['season'][bannerid]['_bannerpath']
+                        posters.addPoster(poster)
+
+                poster = artworkCache.fetch(posters.topPoster().bannerpath)
+            except:
+                poster = None
+        self.downloaded[thumbnail] = poster
         return poster
 
 